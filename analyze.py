@@ -2,47 +2,514 @@
 This file is meant for analyzing audio and finding interesting features and/or points in audio
 """
 
-# import torch
-# import torchaudio
+import os
+import time
 from pydub import utils, AudioSegment
 try:
-    from utilities import Logger, FolderDefinitions, FileFormats
+    from cache import AnalysisCache, PcmCache, open_audio, open_librosa
+    from decode import DecodedAudio, probe_audio, stream_audio
+    from utilities import AnalysisProfiles, Logger, LogLevel, FolderDefinitions, FileFormats, Settings
 except:
-    from VibeMatch.utilities import Logger, FolderDefinitions, FileFormats
+    from VibeMatch.cache import AnalysisCache, PcmCache, open_audio, open_librosa
+    from VibeMatch.decode import DecodedAudio, probe_audio, stream_audio
+    from VibeMatch.utilities import AnalysisProfiles, Logger, LogLevel, FolderDefinitions, FileFormats, Settings
 
 
-def load_analysis(file_name, audio: AudioSegment = None):
+def load_analysis(file_name, audio=None, profile=None, info=None):
     """
-    Loads a file to the format used by librosa
+    Loads a file to the format used by librosa, decoding it only once
     Args:
         file_name: (string) the file name to load
-        audio: (AudioSegment) the optional audio data to grab the existing frame rate from
+        audio: (AudioSegment|DecodedAudio) the optional audio that has already been decoded,
+            converted instead of decoding again
+        profile: (string|dict) the AnalysisProfiles to decode with, if given, otherwise the file's own rate and channels
+        info: (AudioInfo) the stream information, if it has already been probed
 
     Returns:
-        (tuple of ndarray and float) the audio data returned from librosa.load
+        (tuple of ndarray and float) the audio data in the form returned from librosa.load
     """
-    from librosa import load
-    if not audio:
-        audio = AudioSegment.from_file(file_name)
-    audio_data = load(file_name, sr=audio.frame_rate)
+    if audio is None and profile is not None:
+        profile = AnalysisProfiles.get(profile)
+        info = info if info else probe_audio(file_name)
+        offset = get_analysis_offset(info.duration, profile)
+        audio_data = open_librosa(file_name, info, profile["sample_rate"], 1 if profile["mono"] else None, offset,
+                                  profile["duration"])
+    elif audio is None:
+        audio_data = open_librosa(file_name, info)
+    else:
+        audio_data = (DecodedAudio.from_audio_segment(audio) if isinstance(audio, AudioSegment) else audio).to_librosa()
     Logger.write(f"Loaded '{file_name}'")
     return audio_data
 
 
-def get_tempo_and_beat_indices(audio_data):
+TempoParameters = {"analysis": "tempo", "aggregate": "median", "features": ["onset_env", "rms", "low_rms"],
+                   "low_frequency": Settings.LowFrequency}  # with the analysis profile, part of the analysis cache key
+
+
+def get_analysis_offset(duration, profile):
+    """
+    Args:
+        duration: (float) the length of the song in seconds
+        profile: (dict) the analysis profile
+
+    Returns:
+        (float) how many seconds into the song the profile's analysis window starts, so that the window is centred
+    """
+    if not profile["duration"] or duration <= profile["duration"]:
+        return 0
+    return round((duration - profile["duration"]) / 2, 3)
+
+
+def get_full_profile(profile=None):
+    """
+    Gets a profile that analyzes the whole song, for sections and drops that are found relative to its length
+    Args:
+        profile: (string|dict) the AnalysisProfiles to use, defaults to Settings.AnalysisProfile
+
+    Returns:
+        (dict) the profile if it isn't windowed, otherwise the standard profile
+    """
+    profile = AnalysisProfiles.get(profile)
+    return profile if not profile["duration"] else AnalysisProfiles.Standard
+
+
+def is_windowed(analysis):
+    """
+    Args:
+        analysis: (dict) the tempo analysis, as returned from get_tempo_analysis
+
+    Returns:
+        (bool) if the analysis only covers a window of the song, so where its sections are can't be told from it
+    """
+    return float(analysis.get("offset", 0)) > 0
+
+
+def get_sample_rate(audio):
+    """
+    Gets the sample rate of audio in any of the forms it is passed around in
+    Args:
+        audio: (tuple of ndarray and float|AudioSegment|DecodedAudio) the audio
+
+    Returns:
+        (int) the sample rate
+    """
+    if isinstance(audio, tuple):
+        return int(audio[1])
+    return audio.frame_rate if isinstance(audio, AudioSegment) else audio.sample_rate
+
+
+def get_low_rms(power, sr, n_fft):
+    """
+    Args:
+        power: (ndarray) a power spectrogram, frequency by frames
+        sr: (int) the sample rate of the audio
+        n_fft: (int) samples per transform window
+
+    Returns:
+        (ndarray) the rms of the bins below Settings.LowFrequency, the kick and bass, per frame on the spectrogram's scale
+    """
+    import numpy as np
+    bins = max(1, int(Settings.LowFrequency * n_fft / sr))
+    return np.sqrt(power[:bins].mean(axis=0)).astype(np.float32)
+
+
+class FeatureExtractor:
+    """
+    Derives many frame-level features of a track from one short-time Fourier transform, rather than one per librosa call
+    Every feature shares the same frames, so feature i of each describes the same moment
+    """
+    Features = ("onset_env", "tempo", "rms", "low_rms", "chroma", "centroid", "flux", "hpss")
+    Requires = {"tempo": ("onset_env",)}  # features that are derived from other features
+
+    def __init__(self, features=None, n_fft=2048, hop_length=None):
+        """
+        Args:
+            features: (list of strings) the FeatureExtractor.Features to extract, defaults to all of them
+            n_fft: (int) samples per transform window
+            hop_length: (int) samples between frames, defaults to the standard profile's
+        """
+        features = list(features) if features else list(FeatureExtractor.Features)
+        unknown = [name for name in features if name not in FeatureExtractor.Features]
+        assert not unknown, f"Unknown features {unknown}, expected some of {FeatureExtractor.Features}"
+        for name in list(features):
+            features += [required for required in FeatureExtractor.Requires.get(name, ()) if required not in features]
+        self.features = features
+        self.n_fft = n_fft
+        self.hop_length = hop_length if hop_length else AnalysisProfiles.Standard["hop_length"]
+
+    def extract(self, audio_data):
+        """
+        Extracts the features from audio
+        Args:
+            audio_data: (tuple of ndarray and float) the audio data returned from librosa.load
+
+        Returns:
+            (dict) each feature asked for: onset_env, rms, low_rms, centroid and flux (ndarrays per frame),
+            chroma (12 by frames), tempo and beats (ndarray of seconds),
+            harmonic and percussive (soft masks the shape of the spectrogram),
+            plus the frame_rate and duration in seconds
+        """
+        from librosa import beat, decompose, feature, frames_to_time, onset, power_to_db, stft
+        import numpy as np
+        y, sr = audio_data
+        result = {"frame_rate": sr / self.hop_length, "duration": len(y) / sr}
+        if "rms" in self.features:  # framing the signal is cheaper than the transform, and gives the true rms
+            result["rms"] = feature.rms(y=y, frame_length=self.n_fft, hop_length=self.hop_length)[0]
+        if not set(self.features) - {"rms"}:
+            return result
+        magnitude = np.abs(stft(y, n_fft=self.n_fft, hop_length=self.hop_length))
+        power = magnitude ** 2
+        if "onset_env" in self.features:
+            mel = power_to_db(feature.melspectrogram(S=power, sr=sr))
+            result["onset_env"] = onset.onset_strength(S=mel, sr=sr, aggregate=np.median, n_fft=self.n_fft,
+                                                       hop_length=self.hop_length)
+        if "tempo" in self.features:
+            tempo, beats = beat.beat_track(onset_envelope=result["onset_env"], sr=sr, hop_length=self.hop_length)
+            result["tempo"] = round(float(np.atleast_1d(tempo)[0]), 2)
+            result["beats"] = frames_to_time(beats, sr=sr, hop_length=self.hop_length)
+        if "low_rms" in self.features:
+            result["low_rms"] = get_low_rms(power, sr, self.n_fft)
+        if "chroma" in self.features:
+            result["chroma"] = feature.chroma_stft(S=power, sr=sr, n_fft=self.n_fft)
+        if "centroid" in self.features:
+            result["centroid"] = feature.spectral_centroid(S=magnitude, sr=sr, n_fft=self.n_fft)[0]
+        if "flux" in self.features:  # the rise in magnitude from the last frame, summed over frequency
+            result["flux"] = np.concatenate([[0], np.maximum(0, np.diff(magnitude, axis=1)).sum(axis=0)])
+        if "hpss" in self.features:
+            result["harmonic"], result["percussive"] = decompose.hpss(magnitude, mask=True)
+        return result
+
+
+def compute_tempo_analysis(audio_data, hop_length=None):
+    """
+    Runs onset detection and beat tracking with librosa
+    Args:
+        audio_data: (tuple of ndarray and float) the audio data returned from librosa.load
+        hop_length: (int) samples between onset frames, defaults to the standard profile's
+
+    Returns:
+        (dict) the tempo, beats (ndarray of seconds), onset_env, rms and low_rms (ndarrays per frame), frames per second,
+        the offset of the first frame and duration in seconds
+    """
+    analysis = FeatureExtractor(("onset_env", "tempo", "rms", "low_rms"), hop_length=hop_length).extract(audio_data)
+    analysis["offset"] = 0.0
+    return analysis
+
+
+def stream_tempo_analysis(file_name, sample_rate=None, info=None, hop_length=None):
+    """
+    Runs onset detection and beat tracking a block at a time,
+    so memory stays bounded by the block size however long the file is
+    Each block's mel spectrogram is computed uncentered and overlaps the last by one window,
+    so the onset and rms frames of consecutive blocks line up exactly and are simply concatenated
+    Beat tracking then runs once on the stitched onset envelope, which is hundreds of times smaller than the audio
+    Args:
+        file_name: (string) the audio file
+        sample_rate: (int) the sample rate to analyze at, defaults to the file's own
+        info: (AudioInfo) the stream information, if it has already been probed
+        hop_length: (int) samples between onset frames, defaults to the standard profile's
+
+    Returns:
+        (dict) the tempo, beats (ndarray of seconds), onset_env, rms and low_rms (ndarrays per frame), frames per second,
+        the offset of the first frame and duration in seconds
+    """
+    from librosa import beat, feature, frames_to_time, power_to_db, stft
+    import numpy as np
+    info = info if info else probe_audio(file_name)
+    sr = sample_rate if sample_rate else info.sample_rate
+    hop_length = hop_length if hop_length else AnalysisProfiles.Standard["hop_length"]
+    n_fft = 4 * hop_length
+    block_frames = max(1, int(Settings.StreamBlockSeconds * sr / hop_length))
+    overlap = n_fft - hop_length
+    onset_envs, rms, low_rms = [], [], []
+    previous = None
+    samples = 0
+    for block in stream_audio(file_name, (block_frames - 1) * hop_length + n_fft, overlap, sr, info):
+        samples += len(block) - (overlap if previous is not None else 0)
+        if len(block) < n_fft:
+            block = np.pad(block, (0, n_fft - len(block)))
+        power = np.abs(stft(block, n_fft=n_fft, hop_length=hop_length, center=False)) ** 2
+        spectrogram = power_to_db(feature.melspectrogram(S=power, sr=sr))
+        low_rms.append(get_low_rms(power, sr, n_fft))
+        lagged = np.concatenate([previous if previous is not None else spectrogram[:, :1], spectrogram], axis=1)
+        onset_envs.append(np.median(np.maximum(0, np.diff(lagged, axis=1)), axis=0).astype(np.float32))
+        rms.append(feature.rms(y=block, frame_length=n_fft, hop_length=hop_length, center=False)[0])
+        previous = spectrogram[:, -1:]
+    assert onset_envs, f"'{file_name}' has no audio"
+    # shift the uncentered frames to where librosa's centered frames are, so both paths give the same beat times
+    onset_env = np.pad(np.concatenate(onset_envs), (n_fft // hop_length, 0))
+    rms = np.pad(np.concatenate(rms), (n_fft // (2 * hop_length), 0), mode="edge")
+    low_rms = np.pad(np.concatenate(low_rms), (n_fft // (2 * hop_length), 0), mode="edge")
+    tempo, beats = beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
+    return {"tempo": round(float(np.atleast_1d(tempo)[0]), 2), "beats": frames_to_time(beats, sr=sr, hop_length=hop_length),
+            "onset_env": onset_env, "rms": rms, "low_rms": low_rms, "frame_rate": sr / hop_length, "offset": 0.0,
+            "duration": samples / sr}
+
+
+def get_tempo_parameters(file_name, audio=None, profile=None):
+    """
+    Gets every parameter a tempo analysis depends on, which together with the file's contents make its cache key
+    Args:
+        file_name: (string) the audio file
+        audio: (tuple of ndarray and float|AudioSegment|DecodedAudio) the optional audio that has already been decoded
+        profile: (string|dict) the AnalysisProfiles to use, defaults to Settings.AnalysisProfile
+
+    Returns:
+        (tuple of dict, int and AudioInfo|None) the parameters, the sample rate analyzed at,
+        and the stream information if the file was probed
+    """
+    profile = AnalysisProfiles.get(profile)
+    parameters = dict(TempoParameters, hop_length=profile["hop_length"], mono=False, offset=0, duration=None, streaming=False)
+    if audio is not None:
+        return parameters, get_sample_rate(audio), None
+    info = probe_audio(file_name)
+    offset = get_analysis_offset(info.duration, profile)
+    streaming = not profile["duration"] and info.duration > Settings.StreamMinDuration
+    parameters.update(mono=profile["mono"] or streaming, offset=offset, duration=profile["duration"] if offset else None,
+                      streaming=streaming)
+    if streaming:
+        parameters["block_seconds"] = Settings.StreamBlockSeconds
+    return parameters, profile["sample_rate"] if profile["sample_rate"] else info.sample_rate, info
+
+
+def get_tempo_analysis(file_name, audio=None, profile=None):
+    """
+    Gets the tempo, beats and onset envelope of a file from the analysis cache, only decoding and analyzing it on a miss
+    Files are decoded as the analysis profile says, while audio already decoded for playback is analyzed at its own rate
+    Whole files longer than Settings.StreamMinDuration, such as hour-long mixes, are analyzed a block at a time instead
+    Args:
+        file_name: (string) the audio file
+        audio: (tuple of ndarray and float|AudioSegment|DecodedAudio) the optional audio that has already been decoded
+        profile: (string|dict) the AnalysisProfiles to use, defaults to Settings.AnalysisProfile
+
+    Returns:
+        (dict) the tempo, beats (ndarray of seconds), onset_env, rms and low_rms (ndarrays per frame), frames per second,
+        the offset of the first frame and duration in seconds
+    """
+    profile = AnalysisProfiles.get(profile)
+    cache = AnalysisCache.get_instance()
+    parameters, sample_rate, info = get_tempo_parameters(file_name, audio, profile)
+    key = cache.get_key(file_name, sample_rate, parameters)
+    cached = cache.load(key)
+    if cached is not None:
+        for name in ("tempo", "frame_rate", "offset", "duration"):
+            cached[name] = float(cached[name])
+        return cached
+    if parameters["streaming"]:
+        analysis = stream_tempo_analysis(file_name, sample_rate, info, profile["hop_length"])
+    else:
+        if audio is None:
+            audio_data = load_analysis(file_name, profile=profile, info=info)
+        else:
+            audio_data = audio if isinstance(audio, tuple) else load_analysis(file_name, audio)
+        analysis = compute_tempo_analysis(audio_data, profile["hop_length"])
+        if parameters["offset"]:  # the times are relative to the window, not the song
+            analysis["beats"] = analysis["beats"] + parameters["offset"]
+            analysis["offset"], analysis["duration"] = parameters["offset"], info.duration
+    cache.save(key, **analysis)
+    return analysis
+
+
+def get_tempo_and_beat_indices(audio_data, file_name=None):
     """
     Gets the bpm from the audio analysis
     Args:
         audio_data: (tuple of ndarray and float) the audio data returned from librosa.load
+        file_name: (string) the file the audio came from, if given the result is looked up in and saved to the analysis cache
 
     Returns: (tuple of float, ndarray) the bpm and seconds indices of the beats
 
     """
-    from librosa import beat, frames_to_time, onset
-    import numpy as np
-    onset_env = onset.onset_strength(y=audio_data[0], sr=audio_data[1], aggregate=np.median)
-    tempo, beats = beat.beat_track(onset_envelope=onset_env, sr=audio_data[1])
-    return round(float(tempo), 2), frames_to_time(beats, sr=audio_data[1])
+    analysis = get_tempo_analysis(file_name, audio_data) if file_name else compute_tempo_analysis(audio_data)
+    return analysis["tempo"], analysis["beats"]
+
+
+def analyze_file(file_name, profile=None):
+    """
+    Runs the analysis that gets saved to the database on a song file, skipping decoding entirely if it's cached
+    Args:
+        file_name: (string) the file name to analyze
+        profile: (string|dict) the AnalysisProfiles to use, defaults to Settings.AnalysisProfile
+
+    Returns:
+        (dict) the file_name, tempo, beats (ndarray of seconds), duration in seconds, intro_ms, outro_ms and avg_db,
+        intro_ms and outro_ms are None when the profile only analyzes a window of the song
+    """
+    analysis = get_tempo_analysis(file_name, profile=profile)
+    return dict(find_sections(analysis), file_name=file_name, tempo=analysis["tempo"], beats=analysis["beats"],
+                duration=analysis["duration"])
+
+
+WorkerThreadVariables = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+                         "NUMEXPR_NUM_THREADS", "NUMBA_NUM_THREADS")
+
+
+def limit_worker_threads():
+    """
+    Pins a batch analysis worker process to a single BLAS and numba thread, so the workers don't oversubscribe the cpu
+    The environment variables are also set before the workers start, since BLAS reads them when numpy is imported
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+    try:
+        import numba
+        numba.set_num_threads(1)
+    except (ImportError, ValueError):
+        pass
+
+
+def init_worker():
+    """
+    Sets up a batch analysis worker process, pinning it to a single thread, and only letting it read decoded songs
+    from the decoded audio cache, since every worker would otherwise fill the cache with a copy of each song it analyzes
+    """
+    limit_worker_threads()
+    PcmCache.get_instance().store = False
+
+
+def get_worker_pool(workers):
+    """
+    Starts a pool of analysis worker processes, each pinned to a single thread and only reading the decoded audio cache
+    Args:
+        workers: (int) how many worker processes to start
+
+    Returns:
+        (multiprocessing.Pool) the pool
+    """
+    import multiprocessing
+    previous = {name: os.environ.get(name) for name in WorkerThreadVariables}
+    os.environ.update({name: "1" for name in WorkerThreadVariables})  # inherited by the workers as they start
+    try:
+        return multiprocessing.get_context("spawn").Pool(workers, initializer=init_worker)
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name)
+            else:
+                os.environ[name] = value
+
+
+def analyze_file_safely(file_name, profile=None):
+    """
+    Analyzes a file in a batch analysis worker, returning the error rather than raising it so one bad file can't stop the batch
+    Args:
+        file_name: (string) the file name to analyze
+        profile: (string) the AnalysisProfiles name to use
+
+    Returns:
+        (tuple of dict|None and string|None) the analysis row, or None and the error
+    """
+    try:
+        return analyze_file(file_name, profile), None
+    except Exception as e:
+        return None, f"{file_name}: {e}"
+
+
+def find_audio_files(folder):
+    """
+    Finds every audio file in a folder, recursively
+    Args:
+        folder: (string) the folder to search
+
+    Returns:
+        (list of strings) the audio file paths, sorted
+    """
+    from library import AudioExtensions
+    return sorted(os.path.join(dir_path, file_name) for dir_path, _, file_names in os.walk(folder)
+                  for file_name in file_names if file_name.lower().endswith(AudioExtensions))
+
+
+def remove_duplicate_files(file_names, kept):
+    """
+    Fingerprints songs, dropping any that are the same recording as a song that's already analyzed or kept before it
+    Args:
+        file_names: (list of strings) the songs to fingerprint
+        kept: (set of strings) the normalized paths of the songs already analyzed
+
+    Returns:
+        (list of strings) the songs that aren't copies of another
+    """
+    from fingerprint import FingerprintIndex
+    from library import normalize_path
+    index = FingerprintIndex.get_instance()
+    kept = set(kept)
+    unique = []
+    for file_name in file_names:
+        try:
+            index.add(file_name)
+            duplicates = [path for path in index.get_duplicates(file_name) if path in kept]
+        except Exception:  # left for the workers to report
+            duplicates = []
+        if duplicates:
+            Logger.write(f"Skipping '{file_name}', the same recording as '{duplicates[0]}'", LogLevel.Debug)
+            continue
+        kept.add(normalize_path(file_name))
+        unique.append(file_name)
+    return unique
+
+
+def analyze_library(folder=None, workers=None, reanalyze=False, profile=None, skip_duplicates=False):
+    """
+    Analyzes every song in a folder with a pool of worker processes, saving the results to the database in batches
+    Args:
+        folder: (string) the folder to analyze recursively, defaults to the songs folder
+        workers: (int) how many worker processes to use, defaults to the cpu count
+        reanalyze: (bool) whether or not to analyze songs already in the database again
+        profile: (string) the AnalysisProfiles to use, defaults to Settings.AnalysisProfile
+        skip_duplicates: (bool) whether or not to fingerprint the songs first, skipping other copies of the same recording
+
+    Returns:
+        (dict) how many songs were analyzed, failed and skipped, and the songs analyzed per second
+    """
+    import functools
+    from database import FeaturesDatabase
+    from library import normalize_path
+    folder = folder if folder else FolderDefinitions.Songs
+    workers = workers if workers else os.cpu_count() or 1
+    profile = AnalysisProfiles.get(profile)["name"]  # the workers don't share this process's Settings
+    database = FeaturesDatabase.get_instance()
+    file_names = find_audio_files(folder)
+    skipped = 0
+    if not reanalyze:
+        analyzed = database.get_analyzed_file_names()
+        skipped = len(file_names)
+        file_names = [file_name for file_name in file_names if normalize_path(file_name) not in analyzed]
+        skipped -= len(file_names)
+    if skip_duplicates:
+        unique = remove_duplicate_files(file_names, database.get_analyzed_file_names())
+        skipped += len(file_names) - len(unique)
+        file_names = unique
+    Logger.write(f"Analyzing {len(file_names)} songs in '{folder}' with {workers} workers and the {profile} profile " +
+                 f"({skipped} already analyzed)")
+    start = time.perf_counter()
+    counts = {"analyzed": 0, "failed": 0, "skipped": skipped}
+    pool = get_worker_pool(workers)
+    with pool:
+        rows = []
+        chunk_size = max(1, min(8, len(file_names) // (workers * 4)))
+        analyze_one = functools.partial(analyze_file_safely, profile=profile)
+        for row, error in pool.imap_unordered(analyze_one, file_names, chunksize=chunk_size):
+            if error:
+                counts["failed"] += 1
+                Logger.write(f"Unable to analyze {error}", LogLevel.Error)
+                continue
+            rows.append(row)
+            if len(rows) >= Settings.AnalysisBatchSize:
+                counts["analyzed"] += database.save_analysis_to_db(rows)
+                rows = []
+                elapsed = time.perf_counter() - start
+                Logger.write(f"Analyzed {counts['analyzed']}/{len(file_names)} songs, " +
+                             f"{counts['analyzed'] / elapsed:.2f} songs/s")
+        if rows:
+            counts["analyzed"] += database.save_analysis_to_db(rows)
+    elapsed = time.perf_counter() - start
+    counts["songs_per_second"] = counts["analyzed"] / elapsed if elapsed else 0
+    Logger.write(f"Analyzed {counts['analyzed']} songs ({counts['failed']} failed, {skipped} already analyzed) " +
+                 f"in {elapsed:.1f} seconds, {counts['songs_per_second']:.2f} songs/s")
+    return counts
 
 
 def show_beat_analysis(audio_data, percent=100):
@@ -95,57 +562,162 @@ def write_audio(file_name, y, sr, file_format=FileFormats.Wav):
     soundfile.write(file_name, y[12 * sr:17 * sr], sr, format=file_format)
 
 
-def vocal_separation(y, sr, track, metric="cosine", time_width=2, margin_i=2, margin_v=10, power=2):
-    import numpy as np
-    import librosa
+SeparationParameters = {"analysis": "repetition filter", "n_fft": 2048, "hop_length": 512, "aggregate": "median"}
 
 
-    # write_audio("test.wav", y, sr, file_format=FileFormats.Wav)
+def get_repetition_filter(magnitude, sr, metric="cosine", time_width=2, file_name=None):
+    """
+    Estimates the repeating background of a magnitude spectrogram, the median of each frame's nearest neighbours
+    The neighbours are found within overlapping chunks of Settings.SeparationChunk seconds, because comparing every frame
+    with every other grows with the square of the track's length. The middle of each chunk is kept
+    Args:
+        magnitude: (ndarray) the magnitude spectrogram, frequency by frames
+        sr: (int) the sample rate of the audio
+        metric: (string) the distance metric to compare frames by
+        time_width: (float) the fewest seconds between similar frames, so neighbours aren't just the frames either side
+        file_name: (string) the file the spectrogram is of, if given the filter is looked up in and saved to the analysis cache
 
-    # And compute the spectrogram magnitude and phase
-    S_full, phase = librosa.magphase(librosa.stft(y))
+    Returns:
+        (ndarray) the filtered spectrogram, the same shape as magnitude
+    """
+    import librosa
+    import numpy as np
+    width = int(librosa.time_to_frames(time_width, sr=sr, hop_length=SeparationParameters["hop_length"]))
+    chunk = max(int(librosa.time_to_frames(Settings.SeparationChunk, sr=sr, hop_length=SeparationParameters["hop_length"])),
+                4 * width)
+    overlap = chunk // 4
+    parameters = dict(SeparationParameters, metric=metric, time_width=time_width, chunk=chunk, overlap=overlap)
+    cache = AnalysisCache.get_instance()
+    key = cache.get_key(file_name, sr, parameters) if file_name else None
+    cached = cache.load(key) if key else None
+    if cached is not None and cached["filter"].shape == magnitude.shape:
+        return cached["filter"]
+    frames = magnitude.shape[1]
+    filtered = np.empty_like(magnitude)
+    kept = 0
+    start = 0
+    while kept < frames:
+        start = max(0, min(start, frames - chunk))  # the last chunk is full length, overlapping its neighbour more
+        end = min(frames, start + chunk)
+        chunk_filter = librosa.decompose.nn_filter(magnitude[:, start:end], aggregate=np.median, metric=metric, width=width)
+        keep = frames if end == frames else end - overlap // 2
+        filtered[:, kept:keep] = chunk_filter[:, kept - start:keep - start]
+        kept = keep
+        start += chunk - overlap
+    filtered = np.minimum(magnitude, filtered)  # the background can't be louder than the whole, if the parts are additive
+    if key:
+        cache.save(key, filter=filtered)
+    return filtered
 
-    # We'll compare frames using cosine similarity, and aggregate similar frames
-    # by taking their (per-frequency) median value.
-    #
-    # To avoid being biased by local continuity, we constrain similar frames to be
-    # separated by at least 2 seconds.
-    #
-    # This suppresses sparse/non-repetetitive deviations from the average spectrum,
-    # and works well to discard vocal elements.
 
-    S_filter = librosa.decompose.nn_filter(S_full,
-                                           aggregate=np.median,
-                                           metric=metric,
-                                           width=int(librosa.time_to_frames(time_width, sr=sr)))
+def separate_vocals(y, sr, metric="cosine", time_width=2, margin_i=2, margin_v=10, power=2, file_name=None, spectrogram=None):
+    """
+    Separates the vocals, which don't repeat, from the instruments, which do, by soft masking the spectrogram
+    Args:
+        y: (ndarray) the mono audio samples
+        sr: (int) the sample rate of the audio
+        metric: (string) the distance metric to compare frames by
+        time_width: (float) the fewest seconds between similar frames
+        margin_i: (float) how much louder the background has to be than the foreground to count as instruments
+        margin_v: (float) how much louder the foreground has to be than the background to count as vocals
+        power: (float) the exponent of the soft masks, higher is closer to a hard mask
+        file_name: (string) the file the audio is of, if given the repetition filter is cached
+        spectrogram: (tuple of ndarrays) the magnitude and phase of the audio, if they've already been computed
 
-    # The output of the filter shouldn't be greater than the input
-    # if we assume signals are additive.  Taking the pointwise minimum
-    # with the input spectrum forces this.
-    S_filter = np.minimum(S_full, S_filter)
+    Returns:
+        (tuple of ndarrays) the foreground (vocals) and background (instruments) samples
+    """
+    import librosa
+    magnitude, phase = spectrogram if spectrogram else librosa.magphase(
+        librosa.stft(y, n_fft=SeparationParameters["n_fft"], hop_length=SeparationParameters["hop_length"]))
+    repeating = get_repetition_filter(magnitude, sr, metric, time_width, file_name)
+    # the margins reduce bleed between the masks, and need not be equal
+    mask_i = librosa.util.softmask(repeating, margin_i * (magnitude - repeating), power=power)
+    mask_v = librosa.util.softmask(magnitude - repeating, margin_v * repeating, power=power)
+    hop_length, length = SeparationParameters["hop_length"], len(y)
+    return (librosa.istft(mask_v * magnitude * phase, hop_length=hop_length, length=length),
+            librosa.istft(mask_i * magnitude * phase, hop_length=hop_length, length=length))
 
-    # We can also use a margin to reduce bleed between the vocals and instrumentation masks.
-    # Note: the margins need not be equal for foreground and background separation
 
-    mask_i = librosa.util.softmask(S_filter,
-                                   margin_i * (S_full - S_filter),
-                                   power=power)
+def vocal_separation(y, sr, track, metric="cosine", time_width=2, margin_i=2, margin_v=10, power=2, spectrogram=None):
+    """
+    Separates the vocals from a track and writes a five second excerpt of each part, named after the parameters used
+    Args:
+        y: (ndarray) the mono audio samples
+        sr: (int) the sample rate of the audio
+        track: (string) the file the audio is of, its repetition filter is cached
+        metric, time_width, margin_i, margin_v, power: the separation parameters, as separate_vocals takes them
+        spectrogram: (tuple of ndarrays) the magnitude and phase of the audio, if they've already been computed
+    """
+    y_foreground, y_background = separate_vocals(y, sr, metric, time_width, margin_i, margin_v, power, track, spectrogram)
+    write_audio(f"test_foreground_{metric}_{time_width}_{margin_i}_{margin_v}_{power}.wav", y_foreground, sr, file_format=FileFormats.Wav)
+    write_audio(f"test_background_{metric}_{time_width}_{margin_i}_{margin_v}_{power}.wav", y_background, sr, file_format=FileFormats.Wav)
 
-    mask_v = librosa.util.softmask(S_full - S_filter,
-                                   margin_v * S_filter,
-                                   power=power)
 
-    # Once we have the masks, multiply them with the input spectrum to separate the components
-    S_foreground = mask_v * S_full
-    S_background = mask_i * S_full
+def run_separation_sweep(task):
+    """
+    Runs every separation that shares a repetition filter in a sweep worker,
+    so the audio, spectrogram and filter are computed once
+    Args:
+        task: (tuple) the file name, metric, time width, and list of (margin_i, margin_v, power) to separate with
 
-    y_background = librosa.istft(S_background * phase)
+    Returns:
+        (list of dicts) the parameters, seconds taken and error, if any, of each separation
+    """
+    import librosa
+    file_name, metric, time_width, masks = task
+    runs = []
+    try:
+        y, sr = load_analysis(file_name, profile=AnalysisProfiles.Standard)
+        spectrogram = librosa.magphase(librosa.stft(y, n_fft=SeparationParameters["n_fft"],
+                                                    hop_length=SeparationParameters["hop_length"]))
+    except Exception as e:
+        return [{"metric": metric, "time_width": time_width, "margin_i": margin_i, "margin_v": margin_v, "power": power,
+                 "seconds": 0, "error": str(e)} for margin_i, margin_v, power in masks]
+    for margin_i, margin_v, power in masks:
+        start = time.perf_counter()
+        error = None
+        try:
+            vocal_separation(y, sr, file_name, metric, time_width, margin_i, margin_v, power, spectrogram)
+        except Exception as e:
+            error = str(e)
+        runs.append({"metric": metric, "time_width": time_width, "margin_i": margin_i, "margin_v": margin_v, "power": power,
+                     "seconds": time.perf_counter() - start, "error": error})
+    return runs
 
-    y_foreground = librosa.istft(S_foreground * phase)
-    # Play back a 5-second excerpt with only vocals
-    write_audio(f"test_foreground_{metric}_{time_width}_{margin_i}_{margin_v}_{power}.wav", y_foreground, sr, file_format=FileFormats.Wav)
-    # Play back a 5-second excerpt without vocals
-    write_audio(f"test_background_{metric}_{time_width}_{margin_i}_{margin_v}_{power}.wav", y_background, sr, file_format=FileFormats.Wav)
+
+def sweep_vocal_separation(file_name, metrics=("cosine",), time_widths=(2,), margins_i=(2,), margins_v=(10,), powers=(2,),
+                           workers=None):
+    """
+    Tries every combination of separation parameters on a track, spread over a pool of worker processes
+    Combinations sharing a metric and time width run in the same worker, reusing their repetition filter
+    Args:
+        file_name: (string) the track to separate
+        metrics, time_widths, margins_i, margins_v, powers: (lists) the values of each parameter to try
+        workers: (int) how many worker processes to use, defaults to the cpu count
+
+    Returns:
+        (list of dicts) the parameters, seconds taken and error, if any, of each separation
+    """
+    import itertools
+    masks = list(itertools.product(margins_i, margins_v, powers))
+    tasks = [(file_name, metric, time_width, masks) for metric, time_width in itertools.product(metrics, time_widths)]
+    workers = min(workers if workers else os.cpu_count() or 1, len(tasks))
+    Logger.write(f"Sweeping {len(tasks) * len(masks)} separations of '{file_name}' with {workers} workers")
+    start = time.perf_counter()
+    runs = []
+    pool = get_worker_pool(workers)
+    with pool:
+        for task_runs in pool.imap_unordered(run_separation_sweep, tasks):
+            for run in task_runs:
+                parameters = f"{run['metric']}, {run['time_width']}, {run['margin_i']}, {run['margin_v']}, {run['power']}"
+                if run["error"]:
+                    Logger.write(f"Failed to separate with params {parameters}: {run['error']}", LogLevel.Error)
+                else:
+                    Logger.write(f"Separated with params {parameters} in {run['seconds']:.1f} seconds")
+            runs += task_runs
+    Logger.write(f"Swept {len(runs)} separations in {time.perf_counter() - start:.1f} seconds")
+    return runs
 
 
 def get_metadata(audio):
@@ -160,45 +732,651 @@ def get_metadata(audio):
     return utils.mediainfo(audio)
 
 
+def get_section_analysis(audio):
+    """
+    Gets the frame-level features sections are found from, in any of the forms audio is passed around in
+    Files are analyzed whole, with the standard profile if Settings.AnalysisProfile is windowed
+    Args:
+        audio: (dict|string|AudioSegment|DecodedAudio|tuple of ndarray and float) a tempo analysis, an audio file,
+            or decoded audio
+
+    Returns:
+        (dict) the tempo analysis
+    """
+    if isinstance(audio, dict):
+        return audio
+    if isinstance(audio, str):
+        return get_tempo_analysis(audio, profile=get_full_profile())
+    if isinstance(audio, AudioSegment):
+        audio = DecodedAudio.from_audio_segment(audio)
+    return compute_tempo_analysis(audio if isinstance(audio, tuple) else audio.to_librosa())
+
+
+def get_beat_features(analysis):
+    """
+    Averages the frame features of a tempo analysis between beats, so each value describes one beat
+    Args:
+        analysis: (dict) the tempo analysis, as returned from get_tempo_analysis
+
+    Returns:
+        (dict) times (ndarray of seconds) and times_ms (ndarray of ints) when each beat starts, then energy and low
+        (the rms and low frequency rms in dB) and flux (the onset strength) per beat
+    """
+    import numpy as np
+    frame_count = min(len(analysis["rms"]), len(analysis["onset_env"]))
+    frame_rate, offset = float(analysis["frame_rate"]), float(analysis["offset"])
+    frames = np.unique(np.clip(np.round((np.asarray(analysis["beats"]) - offset) * frame_rate).astype(int), 0,
+                               max(0, frame_count - 1)))
+    times = frames / frame_rate + offset
+    features = {"times": times, "times_ms": np.round(times * 1000).astype(int)}
+    if not len(frames):
+        return dict(features, energy=np.zeros(0), low=np.zeros(0), flux=np.zeros(0))
+    lengths = np.diff(np.append(frames, frame_count))
+
+    def per_beat(values):
+        return np.add.reduceat(np.asarray(values[:frame_count], dtype=np.float64), frames) / lengths
+    # averaged in dB, so a beat tracked a little late isn't made loud by the start of the next section
+    features["energy"] = per_beat(20 * np.log10(np.asarray(analysis["rms"][:frame_count], dtype=np.float64) + 1e-5))
+    low = analysis.get("low_rms")
+    features["low"] = per_beat(20 * np.log10(np.asarray(low[:frame_count], dtype=np.float64) + 1e-5)) if low is not None \
+        else features["energy"]
+    features["flux"] = per_beat(analysis["onset_env"])
+    return features
+
+
+def get_changes(values, candidates, window):
+    """
+    Args:
+        values: (ndarray) a value per beat
+        candidates: (ndarray of ints) the beats to measure the change at
+        window: (int) how many beats either side to average
+
+    Returns:
+        (ndarray) the mean of the window after each candidate minus the mean of the window before, in standard deviations
+    """
+    import numpy as np
+    cumulative = np.concatenate([[0], np.cumsum((values - values.mean()) / (values.std() + 1e-10))])
+    return (cumulative[candidates + window] - 2 * cumulative[candidates] + cumulative[candidates - window]) / window
+
+
+GridParameters = {"analysis": "beat grid", "beats_per_bar": 4, "phrase_bars": [8, 16, 32]}
+
+
+class BeatGrid:
+    """
+    The beats, downbeats and phrase starts of a song, as sorted arrays so the nearest to any time is a binary search
+    Downbeats are indices into the beats, and phrase starts are indices into the downbeats, so the grid stays compact
+    """
+    def __init__(self, beats, downbeats, phrases):
+        """
+        Args:
+            beats: (ndarray) the seconds of every beat, in order
+            downbeats: (ndarray of ints) the index of the beat each bar starts on
+            phrases: (dict) phrase length in bars: (ndarray of ints) the index of the bar each phrase starts on
+        """
+        import numpy as np
+        self.beats = np.asarray(beats, dtype=np.float64)
+        self.downbeats = np.asarray(downbeats, dtype=np.int32)
+        self.phrases = {int(bars): np.asarray(starts, dtype=np.int32) for bars, starts in phrases.items()}
+
+    def to_arrays(self):
+        """
+        Returns:
+            (dict of ndarrays) the grid as named arrays, for AnalysisCache.save
+        """
+        return dict({f"phrases_{bars}": starts for bars, starts in self.phrases.items()}, beats=self.beats,
+                    downbeats=self.downbeats)
+
+    @staticmethod
+    def from_arrays(arrays):
+        """
+        Args:
+            arrays: (dict of ndarrays) the grid, as returned from to_arrays
+
+        Returns:
+            (BeatGrid) the grid
+        """
+        phrases = {int(name.split("_")[1]): starts for name, starts in arrays.items() if name.startswith("phrases_")}
+        return BeatGrid(arrays["beats"], arrays["downbeats"], phrases)
+
+    @property
+    def downbeat_times(self):
+        """
+        Returns:
+            (ndarray) the seconds each bar starts at
+        """
+        return self.beats[self.downbeats]
+
+    def get_phrase_times(self, bars=16):
+        """
+        Args:
+            bars: (int) the phrase length in bars, one of GridParameters["phrase_bars"]
+
+        Returns:
+            (ndarray) the seconds each phrase starts at
+        """
+        assert bars in self.phrases, f"No {bars} bar phrases, expected one of {sorted(self.phrases)}"
+        return self.downbeat_times[self.phrases[bars]]
+
+    @staticmethod
+    def get_nearest(times, t):
+        """
+        Args:
+            times: (ndarray) sorted seconds
+            t: (float|ndarray) the seconds to look up
+
+        Returns:
+            (int|ndarray of ints) the index of the nearest of the times to each t, -1 if there are no times
+        """
+        import numpy as np
+        if not len(times):
+            return -1 if np.isscalar(t) else np.full(np.shape(t), -1)
+        after = np.clip(np.searchsorted(times, t), 1, max(1, len(times) - 1))
+        nearest = np.where(np.abs(times[after - 1] - t) <= np.abs(times[np.minimum(after, len(times) - 1)] - t), after - 1,
+                           np.minimum(after, len(times) - 1))
+        return int(nearest) if np.isscalar(t) else nearest
+
+    def nearest_beat(self, t):
+        """
+        Args:
+            t: (float) seconds into the song
+
+        Returns:
+            (float|None) the seconds of the nearest beat, None if there are no beats
+        """
+        index = BeatGrid.get_nearest(self.beats, t)
+        return float(self.beats[index]) if index >= 0 else None
+
+    def nearest_downbeat(self, t):
+        """
+        Args:
+            t: (float) seconds into the song
+
+        Returns:
+            (float|None) the seconds of the nearest bar start, None if there are no bars
+        """
+        times = self.downbeat_times
+        index = BeatGrid.get_nearest(times, t)
+        return float(times[index]) if index >= 0 else None
+
+    def nearest_phrase(self, t, bars=16):
+        """
+        Args:
+            t: (float) seconds into the song
+            bars: (int) the phrase length in bars
+
+        Returns:
+            (float|None) the seconds of the nearest phrase start, None if there are no phrases
+        """
+        times = self.get_phrase_times(bars)
+        index = BeatGrid.get_nearest(times, t)
+        return float(times[index]) if index >= 0 else None
+
+    def next_downbeat(self, t):
+        """
+        Args:
+            t: (float) seconds into the song
+
+        Returns:
+            (float|None) the seconds of the first bar start at or after t, None if there are no bars after t
+        """
+        import numpy as np
+        times = self.downbeat_times
+        index = int(np.searchsorted(times, t))
+        return float(times[index]) if index < len(times) else None
+
+    def get_bar(self, t):
+        """
+        Args:
+            t: (float) seconds into the song
+
+        Returns:
+            (int) the index of the bar playing at t, -1 before the first bar
+        """
+        import numpy as np
+        return int(np.searchsorted(self.downbeat_times, t, side="right")) - 1
+
+    def get_bar_times(self, bar, bars=1):
+        """
+        Args:
+            bar: (int) the index of the first bar
+            bars: (int) how many bars
+
+        Returns:
+            (tuple of floats) the seconds the bars start and end at, the last bar ending a bar's length after it starts
+        """
+        import numpy as np
+        times = self.downbeat_times
+        assert 0 <= bar < len(times), f"Bar {bar} is outside the {len(times)} bars of the song"
+        if bar + bars < len(times):
+            return float(times[bar]), float(times[bar + bars])
+        bar_length = float(times[-1] - times[-2]) if len(times) > 1 else float(self.beats[-1] - self.beats[0]) + \
+            float(np.diff(self.beats).mean() if len(self.beats) > 1 else 0)
+        return float(times[bar]), float(times[-1] + (bar + bars - len(times) + 1) * bar_length)
+
+
+def estimate_beat_grid(audio, beats=None):
+    """
+    Estimates which beats start bars and phrases from the frame features, assuming a constant number of beats per bar
+    The downbeats are the phase of the bar the energy and bass changes peak on, since sections start on bars,
+    with the loudest bass breaking ties. Phrases of each length are the phase of the bars where the peaks add up most
+    Args:
+        audio: (dict|string|AudioSegment|DecodedAudio|tuple of ndarray and float) a tempo analysis, an audio file,
+            or decoded audio
+        beats: (dict) the beat features of the audio, if they have already been found with get_beat_features
+
+    Returns:
+        (BeatGrid) the beat grid
+    """
+    import numpy as np
+    from scipy.signal import find_peaks
+    beats = beats if beats is not None else get_beat_features(get_section_analysis(audio))
+    beats_per_bar = GridParameters["beats_per_bar"]
+    count = len(beats["times"])
+    window = min(Settings.SectionBeats, max(1, (count - 1) // 2))
+    novelty = np.zeros(count)
+    if count >= 2 * window + 1:
+        candidates = np.arange(window, count - window + 1)
+        novelty[candidates] = sum(np.abs(get_changes(beats[name], candidates, window)) for name in ("low", "energy"))
+    # a change is spread over the window either side, so only its peak says where it is
+    peaks = find_peaks(novelty, distance=beats_per_bar)[0]
+    accent = (beats["low"] - beats["low"].mean()) / (beats["low"].std() + 1e-10) if count else novelty
+    scores = [novelty[peaks[peaks % beats_per_bar == phase]].sum() + 0.1 * accent[phase::beats_per_bar].mean()
+              if phase < count else -np.inf for phase in range(beats_per_bar)]
+    downbeats = np.arange(int(np.argmax(scores)) if count else 0, count, beats_per_bar)
+    bar_novelty = np.zeros(len(downbeats))
+    bar_novelty[np.isin(downbeats, peaks)] = novelty[downbeats[np.isin(downbeats, peaks)]]
+    phrases = {}
+    for bars in GridParameters["phrase_bars"]:
+        phase = int(np.argmax([bar_novelty[start::bars].sum() for start in range(min(bars, len(downbeats)))])) \
+            if len(downbeats) else 0
+        phrases[bars] = np.arange(phase, len(downbeats), bars)
+    return BeatGrid(beats["times"], downbeats, phrases)
+
+
+def get_beat_grid(file_name, profile=None, analysis=None, beats=None):
+    """
+    Gets the beat grid of a file from the analysis cache, so cutting and looping on the beat never analyzes a song again
+    The grid is cached apart from the frame features it is estimated from, so a lookup only reads the compact grid
+    Args:
+        file_name: (string) the audio file
+        profile: (string|dict) the AnalysisProfiles to use, defaults to Settings.AnalysisProfile,
+            or the standard profile if that is windowed, so the grid covers the whole song
+        analysis: (dict) the file's tempo analysis with the profile, if it has already been loaded
+        beats: (dict) the beat features of the analysis, if they have already been found
+
+    Returns:
+        (BeatGrid) the beat grid
+    """
+    cache = AnalysisCache.get_instance()
+    profile = profile if profile else get_full_profile()
+    parameters, sample_rate, _ = get_tempo_parameters(file_name, profile=profile)
+    key = cache.get_key(file_name, sample_rate, dict(parameters, **GridParameters, window=Settings.SectionBeats))
+    cached = cache.load(key)
+    if cached is not None:
+        return BeatGrid.from_arrays(cached)
+    grid = estimate_beat_grid(analysis if analysis is not None else get_tempo_analysis(file_name, profile=profile), beats)
+    cache.save(key, **grid.to_arrays())
+    return grid
+
+
+def get_bar_candidates(audio, analysis, beats, window):
+    """
+    Gets the bars sections can change on, from the cached beat grid when the audio is a file,
+    or else from the beat features that have already been found, so the frame features are only averaged once
+    Args:
+        audio: (dict|string|AudioSegment|DecodedAudio|tuple of ndarray and float) the audio passed to find_sections
+            or find_drops
+        analysis: (dict) the tempo analysis of the audio
+        beats: (dict) the beat features of the analysis, as returned from get_beat_features
+        window: (int) how many beats either side of a candidate must be in the song
+
+    Returns:
+        (ndarray of ints) the index of the beat each bar starts on, that has a window of beats either side
+    """
+    if isinstance(audio, str):
+        downbeats = get_beat_grid(audio, analysis=analysis, beats=beats).downbeats
+    else:
+        downbeats = estimate_beat_grid(analysis, beats).downbeats
+    return downbeats[(downbeats >= window) & (downbeats <= len(beats["times"]) - window)]
+
+
+def find_sections(audio):
+    """
+    Finds the end of the intro, the beginning of the outro and the average loudness of a song,
+    in one pass over its frame features
+    The rms energy and spectral flux are averaged between beats, and the section changes are where the mean of the next
+    Settings.SectionBeats beats differs most from the mean of the last, only considering the downbeats of the beat grid
+    The intro ends with the biggest change where the song gets louder,
+    and the outro starts with the biggest where it gets quieter
+    Args:
+        audio: (dict|string|AudioSegment|DecodedAudio|tuple of ndarray and float) a tempo analysis, an audio file,
+            or decoded audio
+
+    Returns:
+        (dict) intro_ms and outro_ms (ints, on a beat), and avg_db (float) the loudness of the non-silent frames in dBFS
+        intro_ms and outro_ms are None for an analysis that only covers a window of the song
+    """
+    import numpy as np
+    analysis = get_section_analysis(audio)
+    duration_ms = int(round(float(analysis["duration"]) * 1000))
+    power = np.square(analysis["rms"], dtype=np.float64) * 2  # rms of a full scale sine is 0 dBFS
+    audible = power > 10 ** (Settings.SilenceDb / 10)
+    avg_db = round(float(10 * np.log10(power[audible].mean())), 2) if audible.any() else float(Settings.SilenceDb)
+    if is_windowed(analysis):  # the intro and outro are usually outside the window
+        return {"intro_ms": None, "outro_ms": None, "avg_db": avg_db}
+    beats = get_beat_features(analysis)
+    first_ms = int(beats["times_ms"][0]) if len(beats["times_ms"]) else 0
+    window = Settings.SectionBeats
+    if len(beats["times_ms"]) < 2 * window + 1:  # too short to have sections
+        return {"intro_ms": first_ms, "outro_ms": duration_ms, "avg_db": avg_db}
+
+    candidates = get_bar_candidates(audio, analysis, beats, window)
+    loudness = get_changes(beats["energy"], candidates, window)
+    novelty = np.abs(loudness) + np.abs(get_changes(beats["flux"], candidates, window))
+    times_ms = beats["times_ms"][candidates]
+
+    intro_ms = first_ms
+    searched = (times_ms <= duration_ms * Settings.SectionSearch) & (loudness > 0) & (novelty >= Settings.SectionNovelty)
+    if searched.any():
+        intro_ms = int(times_ms[searched][np.argmax(novelty[searched])])
+    outro_ms = duration_ms
+    searched = (times_ms >= duration_ms * (1 - Settings.SectionSearch)) & (times_ms > intro_ms) & (loudness < 0) & \
+               (novelty >= Settings.SectionNovelty)
+    if searched.any():
+        outro_ms = int(times_ms[searched][np.argmax(novelty[searched])])
+    return {"intro_ms": intro_ms, "outro_ms": outro_ms, "avg_db": avg_db}
+
+
+def find_drops(audio):
+    """
+    Finds the drops, breakdowns and build-ups of a song from its cached frame features, on the downbeats of its beat grid
+    A drop is where the kick and bass, and the overall energy, come in much harder than the Settings.SectionBeats beats before,
+    a breakdown is where they drop out, and a build-up is where the onsets start rising in the bars before a drop
+    Args:
+        audio: (dict|string|AudioSegment|DecodedAudio|tuple of ndarray and float) a tempo analysis, an audio file,
+            or decoded audio
+
+    Returns:
+        (list of dicts) the type (drop, breakdown or buildup), ms and confidence (0 to 1) of each, in order,
+        only those in the window for an analysis that only covers a window of the song
+    """
+    import numpy as np
+    from scipy.signal import find_peaks
+    analysis = get_section_analysis(audio)
+    beats = get_beat_features(analysis)
+    window = Settings.SectionBeats
+    if len(beats["times_ms"]) < 2 * window + 1:
+        return []
+    candidates = get_bar_candidates(audio, analysis, beats, window)
+    change = (get_changes(beats["low"], candidates, window) + get_changes(beats["energy"], candidates, window)) / 2
+    events = []
+    for event_type, score in (("drop", change), ("breakdown", -change)):
+        peaks, properties = find_peaks(score, height=Settings.DropNovelty, distance=max(1, window // 4))
+        events += [{"type": event_type, "ms": int(beats["times_ms"][candidates[peak]]),
+                    "confidence": round(float(height / (1 + height)), 3)}
+                   for peak, height in zip(peaks, properties["peak_heights"])]
+    alternating = []
+    for event in sorted(events, key=lambda event: event["ms"]):  # two drops without a breakdown between are one drop
+        if alternating and alternating[-1]["type"] == event["type"]:
+            if event["confidence"] > alternating[-1]["confidence"]:
+                alternating[-1] = event
+        else:
+            alternating.append(event)
+    events = alternating
+    for drop in [event for event in events if event["type"] == "drop"]:
+        end = int(np.searchsorted(beats["times_ms"], drop["ms"]))
+        starts = np.arange(end - 4, max(8, end - 2 * window) - 1, -4)  # bar starts before the drop, nearest first
+        starts = starts[starts >= 8]
+        if not len(starts):
+            continue
+        cumulative = np.concatenate([[0], np.cumsum(beats["flux"] / (beats["flux"].std() + 1e-10))])
+        rise = (cumulative[end] - cumulative[starts]) / (end - starts) - (cumulative[starts] - cumulative[starts - 8]) / 8
+        if rise.max() >= Settings.DropNovelty / 2:
+            best = int(np.argmax(rise))
+            events.append({"type": "buildup", "ms": int(beats["times_ms"][starts[best]]),
+                           "confidence": round(float(rise[best] / (1 + rise[best])), 3)})
+    return sorted(events, key=lambda event: event["ms"])
+
+
+def find_drops_safely(file_name, profile=None):
+    """
+    Finds the drops of a file in a batch worker, returning the error rather than raising it,
+    so one bad file can't stop the batch
+    Args:
+        file_name: (string) the file name to analyze
+        profile: (string) the AnalysisProfiles name to use, the standard profile is used instead of a windowed one
+
+    Returns:
+        (tuple of string, list of dicts|None and string|None) the file name, and its drops or the error
+    """
+    try:
+        profile = get_full_profile(profile)
+        return file_name, find_drops(get_tempo_analysis(file_name, profile=profile)), None
+    except Exception as e:
+        return file_name, None, f"{file_name}: {e}"
+
+
+def find_library_drops(folder=None, workers=None, profile=None):
+    """
+    Finds the drops, breakdowns and build-ups of every song in a folder with a pool of worker processes
+    Songs already in the analysis cache are only read from it, not decoded
+    Args:
+        folder: (string) the folder to search recursively, defaults to the songs folder
+        workers: (int) how many worker processes to use, defaults to the cpu count
+        profile: (string) the AnalysisProfiles to use, defaults to Settings.AnalysisProfile,
+            the standard profile is used instead of a windowed one so drops are found in the whole song
+
+    Returns:
+        (dict) file name: list of events, as returned from find_drops
+    """
+    import functools
+    file_names = find_audio_files(folder if folder else FolderDefinitions.Songs)
+    profile = AnalysisProfiles.get(profile)["name"]
+    drops = {}
+    with get_worker_pool(workers if workers else os.cpu_count() or 1) as pool:
+        for file_name, events, error in pool.imap_unordered(functools.partial(find_drops_safely, profile=profile), file_names):
+            if error:
+                Logger.write(f"Unable to find the drops of {error}", LogLevel.Error)
+            else:
+                drops[file_name] = events
+    Logger.write(f"Found the drops of {len(drops)}/{len(file_names)} songs")
+    return drops
+
+
 def find_intro_ms(audio_segment):
     """
     Attempts to find the millisecond position of the end of the intro
     Args:
-        audio_segment: (AudioSegment) the audio to analyze
+        audio_segment: (dict|string|AudioSegment) the tempo analysis, file or audio to analyze
 
     Returns:
         (int) the end of the introduction section
     """
-    return 0
+    return find_sections(audio_segment)["intro_ms"]
 
 
 def find_outro_ms(audio_segment):
     """
     Attempts to find the millisecond position of the beginning of the outro
     Args:
-        audio_segment: (AudioSegment) the audio to analyze
+        audio_segment: (dict|string|AudioSegment) the tempo analysis, file or audio to analyze
 
     Returns:
         (int) the beginning of the outro section
     """
-    return 0
+    return find_sections(audio_segment)["outro_ms"]
 
 
 def get_avg_db(audio_segment):
     """
     Gets the average decibel value of the audio segment
     Args:
-        audio_segment: (AudioSegment)
+        audio_segment: (dict|string|AudioSegment) the tempo analysis, file or audio to analyze
 
     Returns:
         (float) the decibel value
     """
-    return 0
+    return find_sections(audio_segment)["avg_db"]
+
+
+LoudnessParameters = {"analysis": "loudness", "block": 0.4, "step": 0.1, "short_term": 3.0, "gate": -70, "relative_gate": -10}
+
+
+def get_k_weighting(sample_rate):
+    """
+    Builds the ITU-R BS.1770 K-weighting filter, a high shelf modelling the head followed by a high pass, for any sample rate
+    Args:
+        sample_rate: (int) samples per second
+
+    Returns:
+        (ndarray) the filter as second-order sections, for scipy.signal.sosfilt
+    """
+    import numpy as np
+    gain, frequency, q = 10 ** (4.0 / 40), 1500.0, 1 / np.sqrt(2)  # the shelf
+    w0 = 2 * np.pi * frequency / sample_rate
+    alpha, cos = np.sin(w0) / (2 * q), np.cos(w0)
+    root = 2 * np.sqrt(gain) * alpha
+    shelf = [gain * ((gain + 1) + (gain - 1) * cos + root), -2 * gain * ((gain - 1) + (gain + 1) * cos),
+             gain * ((gain + 1) + (gain - 1) * cos - root),
+             (gain + 1) - (gain - 1) * cos + root, 2 * ((gain - 1) - (gain + 1) * cos), (gain + 1) - (gain - 1) * cos - root]
+    frequency, q = 38.0, 0.5  # the high pass
+    w0 = 2 * np.pi * frequency / sample_rate
+    alpha, cos = np.sin(w0) / (2 * q), np.cos(w0)
+    high_pass = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2, 1 + alpha, -2 * cos, 1 - alpha]
+    sos = np.array([shelf, high_pass])
+    return sos / sos[:, 3:4]  # normalize so a0 is 1
+
+
+def compute_loudness(audio):
+    """
+    Measures integrated loudness and the short-term loudness envelope as ITU-R BS.1770 describes, in one pass over the audio
+    Each channel is K-weighted and its power summed per Settings step, so the 400ms gating blocks and 3s short-term windows
+    are sums of a few steps rather than passes over the samples again
+    Args:
+        audio: (DecodedAudio|AudioSegment) the decoded audio, with all of its channels
+
+    Returns:
+        (dict) the integrated loudness in LUFS, short_term (ndarray of LUFS, one per step, each over the next 3 seconds)
+        and the step in seconds
+    """
+    import numpy as np
+    from scipy.signal import sosfilt
+    if isinstance(audio, AudioSegment):
+        audio = DecodedAudio.from_audio_segment(audio)
+    samples = audio.samples
+    step = max(1, int(round(LoudnessParameters["step"] * audio.sample_rate)))
+    steps = len(samples) // step
+    sos = get_k_weighting(audio.sample_rate)
+    scale = 1 / float(2 ** (8 * audio.sample_width - 1))
+    power = np.zeros(steps)
+    for channel in range(audio.channels):
+        weight = 1.41 if audio.channels == 6 and channel >= 4 else 0.0 if audio.channels == 6 and channel == 3 else 1.0
+        if weight:  # the low frequency effects channel isn't counted, and surround channels count more
+            filtered = sosfilt(sos, samples[:steps * step, channel] * scale)
+            power += weight * np.square(filtered).reshape(steps, step).mean(axis=1)
+
+    def get_windows(length):  # the mean power of every window of length steps, starting at each step
+        cumulative = np.concatenate([[0], np.cumsum(power)])
+        return (cumulative[length:] - cumulative[:-length]) / length if steps >= length else np.zeros(0)
+
+    def to_lufs(mean_power):
+        return -0.691 + 10 * np.log10(np.maximum(mean_power, 1e-12))
+    blocks = get_windows(int(round(LoudnessParameters["block"] / LoudnessParameters["step"])))
+    gated = blocks[to_lufs(blocks) > LoudnessParameters["gate"]]
+    integrated = LoudnessParameters["gate"]
+    if len(gated):
+        gated = gated[to_lufs(gated) > to_lufs(gated.mean()) + LoudnessParameters["relative_gate"]]
+        integrated = round(float(to_lufs(gated.mean())), 2)
+    short_term = to_lufs(get_windows(int(round(LoudnessParameters["short_term"] / LoudnessParameters["step"]))))
+    return {"integrated": integrated, "short_term": np.maximum(short_term, LoudnessParameters["gate"]).astype(np.float32),
+            "step": step / audio.sample_rate}
+
+
+def get_loudness(file_name, audio=None):
+    """
+    Gets the integrated loudness and short-term loudness envelope of a file from the analysis cache, measuring it on a miss
+    Loudness is always measured at the file's own sample rate and channels, whatever the analysis profile
+    Args:
+        file_name: (string) the audio file
+        audio: (DecodedAudio|AudioSegment) the optional audio that has already been decoded
+
+    Returns:
+        (dict) the integrated loudness in LUFS, short_term (ndarray of LUFS, one per step) and the step in seconds
+    """
+    cache = AnalysisCache.get_instance()
+    key = cache.get_key(file_name, probe_audio(file_name).sample_rate if audio is None else get_sample_rate(audio),
+                        LoudnessParameters)
+    cached = cache.load(key)
+    if cached is not None:
+        cached["integrated"], cached["step"] = float(cached["integrated"]), float(cached["step"])
+        return cached
+    loudness = compute_loudness(audio if audio is not None else open_audio(file_name))
+    cache.save(key, **loudness)
+    return loudness
+
+
+KeyParameters = {"analysis": "key", "chroma": "stft", "templates": "krumhansl", "sample_rate": 22050, "n_fft": 4096,
+                 "hop_length": 2048}
+KeyTemplates = {1: [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],  # mode: Krumhansl-Kessler
+                0: [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]}  # profile starting on the tonic
+
+
+def detect_key(audio_data, chroma=None):
+    """
+    Finds the key and mode of audio by correlating its average chroma with every major and minor key profile
+    Args:
+        audio_data: (tuple of ndarray and float) the audio data returned from librosa.load
+        chroma: (ndarray) the chroma of the audio, 12 by frames, if a FeatureExtractor has already computed it
+
+    Returns:
+        (dict) the key and mode, encoded as json_schema.features encodes them, and the confidence, the correlation of the
+        chroma with the best key profile from -1 to 1. the key is -1 if there's no pitched sound
+    """
+    import numpy as np
+    from librosa import feature
+    y, sr = audio_data
+    no_key = {"key": -1, "mode": 1, "confidence": 0.0}
+    if not len(y) or np.abs(y).max() < 1e-4:
+        return no_key
+    if chroma is None:
+        chroma = feature.chroma_stft(y=y, sr=sr, n_fft=KeyParameters["n_fft"], hop_length=KeyParameters["hop_length"])
+    chroma = chroma.mean(axis=1)
+    if chroma.std() < 1e-6:
+        return no_key
+    tonics = (np.arange(12)[None, :] - np.arange(12)[:, None]) % 12  # row k is the profile shifted to start on k
+    templates = np.concatenate([np.asarray(KeyTemplates[mode])[tonics] for mode in (1, 0)])
+    templates = (templates - templates.mean(axis=1, keepdims=True)) / templates.std(axis=1, keepdims=True)
+    correlations = templates @ ((chroma - chroma.mean()) / chroma.std()) / 12
+    best = int(np.argmax(correlations))
+    return {"key": best % 12, "mode": 1 if best < 12 else 0, "confidence": round(float(correlations[best]), 3)}
+
+
+def get_key(file_name, window=None):
+    """
+    Gets the key and mode of a file from the analysis cache, only decoding the middle of the song on a miss
+    Args:
+        file_name: (string) the audio file
+        window: (float) the seconds from the middle of the song to analyze, defaults to Settings.KeyWindow, 0 for all of it
+
+    Returns:
+        (dict) the key, mode and confidence, as returned from detect_key
+    """
+    window = Settings.KeyWindow if window is None else window
+    info = probe_audio(file_name)
+    offset = get_analysis_offset(info.duration, {"duration": window})
+    cache = AnalysisCache.get_instance()
+    cache_key = cache.get_key(file_name, KeyParameters["sample_rate"], dict(KeyParameters, window=window if offset else None))
+    cached = cache.load(cache_key)
+    if cached is not None:
+        return {"key": int(cached["tonic"]), "mode": int(cached["mode"]), "confidence": float(cached["confidence"])}
+    result = detect_key(open_librosa(file_name, info, KeyParameters["sample_rate"], 1, offset, window if offset else None))
+    cache.save(cache_key, tonic=result["key"], mode=result["mode"], confidence=result["confidence"])
+    return result
 
 
 if __name__ == "__main__":
     import sklearn.neighbors as neighbors  # for getting nn_filter params
-    import datetime
 
     song_name = f"{FolderDefinitions.Songs}/Will Sparks - Come With Me.{FileFormats.Default}"
     # metadata = get_metadata(song_name)
@@ -230,25 +1408,4 @@ if __name__ == "__main__":
     #     "mahalanobis": { 2*60*60 }, # yet to complete after 2.1 hours
     # }
     # metrics = [metric for metric in metrics if metric not in time_taken]
-    # for v in range(0, 1):
-    #     for i in range(1, 2):
-    #         for t in range(1, 2):
-    #             for m in metrics:
-    #                 for p in range(1, 2):
-    #                     start = datetime.datetime.now()
-    #                     Logger.write(f"Running with params {m}, {t}, {i}, {v}, {p} at {start}")
-    #                     try:
-    #                         vocal_separation(y, sr, song_name, metric=m, time_width=t, margin_i=i, margin_v=v, power=p)
-    #                         try:
-    #                             end = datetime.datetime.now()
-    #                             Logger.write(f"Created with params {m}, {t}, {i}, {v}, {p} at {end} in {end-start}")
-    #                             with open(f"{m}.txt", 'w') as f:
-    #                                 f.write(f"{end-start}")
-    #                         except:
-    #                             pass
-    #                     except Exception as e:
-    #                         try:
-    #                             Logger.write(f"Failed to create with params {m}, {t}, {i}, {v}, {p}: {e} at {datetime.datetime.now()}")
-    #                         except:
-    #                             pass
-
+    # sweep_vocal_separation(song_name, metrics=metrics, time_widths=[1], margins_i=[1], margins_v=[0], powers=[1])
@@ -0,0 +1,377 @@
+"""
+This file is responsible for caching the results of expensive audio analysis, and decoded audio, on disk
+Results are keyed by the contents of the audio file rather than its name, plus the sample rate and the analysis parameters,
+so renamed or re-downloaded copies of a song share a result and changed parameters never return a stale one
+Each result is a compressed NumPy archive, and the least recently used results are evicted once the cache folder is over
+its size, which is counted as results are written and read from the folder again every Settings.CacheScanWrites writes,
+or when the count goes over, so results written by other processes count too
+Decoded audio is kept as raw pcm behind a small header, and memory-mapped when opened again, so reopening a song
+doesn't run ffmpeg, and every process reading the same song shares the operating system's page cache
+"""
+
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import numpy as np
+try:
+    from decode import DecodedAudio, load_audio, load_samples, probe_audio
+    from utilities import Logger, LogLevel, FolderDefinitions, Settings, get_file_hash
+except:
+    from VibeMatch.decode import DecodedAudio, load_audio, load_samples, probe_audio
+    from VibeMatch.utilities import Logger, LogLevel, FolderDefinitions, Settings, get_file_hash
+
+
+class AnalysisCache:
+    """
+    A size-bounded, least recently used cache of analysis results, stored as .npz files
+    """
+    _instance = None
+    extension = ".npz"
+
+    @staticmethod
+    def get_instance():
+        if AnalysisCache._instance:
+            return AnalysisCache._instance
+        else:
+            AnalysisCache._instance = AnalysisCache()
+            return AnalysisCache._instance
+
+    def __init__(self, folder=None, max_size=None):
+        """
+        Builds an analysis cache, reading the size of any results already cached
+        Args:
+            folder: (string) the folder to keep results in
+            max_size: (int) the most bytes to keep before evicting the least recently used results
+        """
+        self.folder = folder if folder else os.path.join(FolderDefinitions.Cache, "analysis")
+        self.max_size = max_size if max_size else Settings.AnalysisCacheSize
+        self.lock = threading.Lock()
+        self.hashes = {}  # (path, size, mtime): content hash, so unchanged files aren't hashed again
+        os.makedirs(self.folder, exist_ok=True)
+        self.sizes = {}
+        self.size = 0
+        self.writes = 0
+        self.scan()
+        self.hits = 0
+        self.misses = 0
+
+    def get_file_hash(self, file_name):
+        """
+        Gets the content hash of a file, only reading the file again if its size or modification time changed
+        Args:
+            file_name: (string) the audio file
+
+        Returns:
+            (string) the hex digest of the file contents
+        """
+        stat = os.stat(file_name)
+        identity = (os.path.abspath(file_name), stat.st_size, stat.st_mtime)
+        if identity not in self.hashes:
+            self.hashes[identity] = get_file_hash(file_name)
+        return self.hashes[identity]
+
+    def get_key(self, file_name, sample_rate, parameters):
+        """
+        Builds the cache key for an analysis of a file
+        Args:
+            file_name: (string) the audio file
+            sample_rate: (int) the sample rate the audio is analyzed at
+            parameters: (dict) every parameter that changes the result, including the kind of analysis
+
+        Returns:
+            (string) the cache key
+        """
+        description = json.dumps([self.get_file_hash(file_name), sample_rate, parameters], sort_keys=True, default=str)
+        return hashlib.blake2b(description.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get_path(self, key):
+        """
+        Args:
+            key: (string) the cache key
+
+        Returns:
+            (string) the file the result is kept in
+        """
+        return os.path.join(self.folder, f"{key}{self.extension}")
+
+    def load(self, key):
+        """
+        Loads a cached result, marking it as recently used
+        Args:
+            key: (string) the cache key
+
+        Returns:
+            (dict of ndarrays|None) the cached arrays, or None if the result isn't cached
+        """
+        path = self.get_path(key)
+        try:
+            with np.load(path) as archive:
+                result = {name: archive[name] for name in archive.files}
+            os.utime(path)
+        except (OSError, ValueError):  # not cached, or evicted or corrupted since
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return result
+
+    def save(self, key, **arrays):
+        """
+        Saves a result, then evicts the least recently used results if the cache is over its size
+        Args:
+            key: (string) the cache key
+            **arrays: (ndarray|float) the named arrays of the result
+        """
+        path = self.get_path(key)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temporary, path)  # readers never see a partially written result
+        self.check_size(path)
+
+    def scan(self):
+        """
+        Reads the size and last use of every result in the folder, including results written by other processes,
+        which each count only their own writes otherwise
+        Returns:
+            (list of tuples of float, int and string) the last use, size and file of each result
+        """
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(self.extension):
+                try:
+                    stat = entry.stat()
+                except OSError:  # evicted by another process since it was listed
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        self.sizes = {path: size for _, size, path in entries}
+        self.size = sum(self.sizes.values())
+        return entries
+
+    def check_size(self, path):
+        """
+        Counts a result that was just written, and evicts the least recently used results if the cache is over its size
+        The folder is only scanned when the count is over, or every Settings.CacheScanWrites writes,
+        so writing a result doesn't stat every other one
+        Args:
+            path: (string) the file the result was written to
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:  # already evicted by another process
+            return
+        with self.lock:
+            self.size += size - self.sizes.get(path, 0)
+            self.sizes[path] = size
+            self.writes += 1
+            if self.size <= self.max_size and self.writes % Settings.CacheScanWrites:
+                return
+            entries = self.scan()
+            if self.size > self.max_size:
+                self.evict(entries)
+
+    def evict(self, entries):
+        """
+        Deletes the least recently used results until the cache is under its size, called with the lock held
+        Args:
+            entries: (list of tuples of float, int and string) the last use, size and file of each result, from scan
+        """
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # already evicted by another process
+                pass
+            self.size -= self.sizes.pop(path)
+            evicted += 1
+        Logger.write(f"Evicted {evicted} results from the cache in '{self.folder}'", LogLevel.Debug)
+
+    def clear(self):
+        """
+        Deletes every cached result
+        """
+        with self.lock:
+            for _, _, path in self.scan():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.sizes = {}
+            self.size = 0
+
+
+PcmHeader = struct.Struct("<8sIHHQ8x")  # magic, sample rate, channels, sample width, frames, padded to 32 bytes
+PcmMagic = b"VMPCM001"
+
+
+class PcmCache(AnalysisCache):
+    """
+    A size-bounded, least recently used cache of whole decoded songs, stored as raw pcm files that are memory-mapped
+    """
+    _instance = None
+    extension = ".pcm"
+
+    @staticmethod
+    def get_instance():
+        if PcmCache._instance:
+            return PcmCache._instance
+        else:
+            PcmCache._instance = PcmCache()
+            return PcmCache._instance
+
+    def __init__(self, folder=None, max_size=None, store=True):
+        """
+        Builds a decoded audio cache, reading the size of any songs already cached
+        Args:
+            folder: (string) the folder to keep decoded songs in
+            max_size: (int) the most bytes to keep before evicting the least recently used songs
+            store: (bool) whether or not songs decoded on a miss are cached, or only read from the cache
+        """
+        super().__init__(folder if folder else os.path.join(FolderDefinitions.Cache, "pcm"),
+                         max_size if max_size else Settings.PcmCacheSize)
+        self.store = store
+
+    def load(self, key):
+        """
+        Memory-maps a cached song, marking it as recently used
+        Args:
+            key: (string) the cache key
+
+        Returns:
+            (DecodedAudio|None) the song, backed by the memory map, or None if it isn't cached
+        """
+        path = self.get_path(key)
+        try:
+            audio = PcmCache.map_file(path)
+            os.utime(path)
+        except (OSError, ValueError, AssertionError, struct.error):  # not cached, or evicted, corrupted or truncated since
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return audio
+
+    @staticmethod
+    def map_file(path):
+        """
+        Args:
+            path: (string) a cached pcm file
+
+        Returns:
+            (DecodedAudio) the audio, backed by a read-only memory map of the file
+        """
+        with open(path, "rb") as f:
+            magic, sample_rate, channels, sample_width, frames = PcmHeader.unpack(f.read(PcmHeader.size))
+        assert magic == PcmMagic and os.path.getsize(path) == PcmHeader.size + frames * channels * sample_width, \
+            f"'{path}' isn't a whole cached pcm file"
+        pcm = np.memmap(path, dtype=np.uint8, mode="r", offset=PcmHeader.size) if frames else b""
+        return DecodedAudio(pcm, sample_rate, channels, sample_width)
+
+    def save(self, key, audio: DecodedAudio):
+        """
+        Saves a decoded song, then evicts the least recently used songs if the cache is over its size
+        Args:
+            key: (string) the cache key
+            audio: (DecodedAudio) the decoded song
+        """
+        path = self.get_path(key)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        frames = len(audio.pcm) // (audio.channels * audio.sample_width)
+        with open(temporary, "wb") as f:
+            f.write(PcmHeader.pack(PcmMagic, audio.sample_rate, audio.channels, audio.sample_width, frames))
+            f.write(audio.pcm)
+        os.replace(temporary, path)  # readers never map a partially written song
+        self.check_size(path)
+
+    def get(self, file_name, sample_rate=None, channels=None):
+        """
+        Args:
+            file_name: (string) the audio file
+            sample_rate: (int) the sample rate it was decoded at, None for the file's own
+            channels: (int) how many channels it was decoded to, None for the file's own
+
+        Returns:
+            (DecodedAudio|None) the whole song if it's cached, without decoding it if it isn't
+        """
+        return self.load(self.get_key(file_name, sample_rate, {"analysis": "pcm", "channels": channels, "sample_width": 2}))
+
+    def open(self, file_name, info=None, sample_rate=None, channels=None, offset=0, duration=None):
+        """
+        Opens an audio file from the cache, only decoding it on a miss
+        Whole songs are cached once decoded, unless the cache doesn't store them, while sections are cut from a cached song,
+        or decoded alone if it isn't cached, so analyzing a short window of a song never decodes all of it
+        Args:
+            file_name: (string) the audio file
+            info: (AudioInfo) the stream information, if it has already been probed
+            sample_rate: (int) the sample rate to decode at, defaults to the file's own
+            channels: (int) how many channels to decode to, defaults to the file's own
+            offset: (float) seconds into the file to start from
+            duration: (float) the most seconds to open, defaults to the rest of the file
+
+        Returns:
+            (DecodedAudio) the 16 bit pcm audio
+        """
+        audio = self.get(file_name, sample_rate, channels)
+        if audio is not None:
+            return audio.get_section(offset, duration)
+        if offset or duration or not self.store:
+            return load_audio(file_name, info, sample_rate, channels, offset, duration)
+        audio = load_audio(file_name, info, sample_rate, channels)
+        key = self.get_key(file_name, sample_rate, {"analysis": "pcm", "channels": channels, "sample_width": 2})
+        self.save(key, audio)
+        try:
+            return PcmCache.map_file(self.get_path(key))  # mapped, so the decoded bytes can be freed
+        except OSError:  # evicted straight away, since it's bigger than the whole cache
+            return audio
+
+
+def open_audio(file_name, info=None, sample_rate=None, channels=None, offset=0, duration=None):
+    """
+    Opens an audio file through the decoded audio cache, taking the same arguments as decode.load_audio
+    Args:
+        file_name: (string) the audio file
+        info: (AudioInfo) the stream information, if it has already been probed
+        sample_rate: (int) the sample rate to decode at, defaults to the file's own
+        channels: (int) how many channels to decode to, defaults to the file's own
+        offset: (float) seconds into the file to start from
+        duration: (float) the most seconds to open, defaults to the rest of the file
+
+    Returns:
+        (DecodedAudio) the 16 bit pcm audio
+    """
+    return PcmCache.get_instance().open(file_name, info, sample_rate, channels, offset, duration)
+
+
+def open_librosa(file_name, info=None, sample_rate=None, channels=None, offset=0, duration=None):
+    """
+    Opens an audio file as the float32 mono samples librosa works on, through the decoded audio cache
+    A window of a song that isn't cached, or a whole song the cache doesn't store, is decoded by ffmpeg straight to float32,
+    so it never passes through 16 bit pcm
+    Args:
+        file_name: (string) the audio file
+        info: (AudioInfo) the stream information, if it has already been probed
+        sample_rate: (int) the sample rate to decode at, defaults to the file's own
+        channels: (int) how many channels ffmpeg decodes to before they're mixed down, defaults to the file's own
+        offset: (float) seconds into the file to start from
+        duration: (float) the most seconds to open, defaults to the rest of the file
+
+    Returns:
+        (tuple of ndarray and float) the audio data in the form returned from librosa.load
+    """
+    pcm_cache = PcmCache.get_instance()
+    cached = pcm_cache.get(file_name, sample_rate, channels)
+    if cached is not None:
+        return cached.get_section(offset, duration).to_librosa()
+    if not offset and not duration and pcm_cache.store:
+        return pcm_cache.open(file_name, info, sample_rate, channels).to_librosa()
+    info = info if info else probe_audio(file_name)
+    samples = load_samples(file_name, info, sample_rate, channels, offset, duration)
+    samples = samples if samples.ndim == 1 else samples.mean(axis=1, dtype=np.float32)
+    return samples, sample_rate if sample_rate else info.sample_rate
@@ -0,0 +1,266 @@
+"""
+This file is responsible for crawling spotify recommendations to build up a library of songs
+The frontier and the set of visited tracks are stored in sqlite, so tracks are never fetched twice,
+and an interrupted crawl picks up where it left off when it is run again with the same name
+"""
+
+
+import sqlite3
+import time
+try:
+    from utilities import Logger, LogLevel, Settings
+except:
+    from VibeMatch.utilities import Logger, LogLevel, Settings
+
+
+class CrawlOrder:
+    """
+    The orders the frontier can be expanded in
+    """
+    BreadthFirst = "breadth"  # closest to the seed track first
+    Priority = "priority"  # most popular tracks first, wherever they were found
+
+
+# how many times each step has failed for a track, added to crawl databases made before they existed
+CrawlFailureColumns = {"expanded_failures": "Integer default 0", "fetched_failures": "Integer default 0",
+                       "downloaded_failures": "Integer default 0"}
+
+
+class LibraryCrawler:
+    """
+    A deduplicated, resumable crawler over track recommendations
+    """
+    def __init__(self, seed_id, recommend, fetch_features=None, download=None, name=None, order=CrawlOrder.BreadthFirst,
+                 db_file=None):
+        """
+        Builds a crawler, resuming any existing crawl with the same name
+        Args:
+            seed_id: (string) the track uri to start from
+            recommend: (function) takes a track uri and a count, returns a list of recommended track dicts
+            fetch_features: (function) takes a list of track uris, returns a list of audio feature dicts
+            download: (function) takes a list of track uris and downloads them
+            name: (string) the name of the crawl, used to resume it. defaults to the seed track uri
+            order: (CrawlOrder) the order to expand the frontier in
+            db_file: (string) the sqlite database file to keep crawl state in
+        """
+        assert order in (CrawlOrder.BreadthFirst, CrawlOrder.Priority), f"Unknown crawl order '{order}'"
+        self.seed_id = seed_id
+        self.recommend = recommend
+        self.fetch_features = fetch_features
+        self.download = download
+        self.name = name if name else seed_id
+        self.order = order
+        self.con = sqlite3.connect(db_file if db_file else Settings.CrawlDatabase)
+        self.create_tables()
+        self.add_tracks([seed_id], depth=0)
+
+    def create_tables(self):
+        """
+        Creates the crawl state table if it doesn't exist yet, adding any columns an older database is missing
+        """
+        cursor = self.con.cursor()
+        cursor.execute("Create Table if not exists CrawlTracks (crawl Varchar(64), id Varchar(32), depth Integer, " +
+                       "priority Real, expanded Integer default 0, fetched Integer default 0, downloaded Integer default 0, " +
+                       "added Real, Unique(crawl, id))")
+        columns = {row[1] for row in cursor.execute("Pragma table_info(CrawlTracks)").fetchall()}
+        for column, column_type in CrawlFailureColumns.items():
+            if column not in columns:
+                cursor.execute(f"Alter Table CrawlTracks Add Column {column} {column_type}")
+        cursor.execute("Create Index if not exists CrawlFrontier on CrawlTracks (crawl, expanded, depth)")
+        self.con.commit()
+
+    def close(self):
+        """
+        Closes the sqlite database connection
+        """
+        self.con.close()
+
+    def add_tracks(self, track_ids, depth, priorities=None):
+        """
+        Adds tracks to the frontier, ignoring any that have already been seen in this crawl
+        Args:
+            track_ids: (list of strings) the track uris
+            depth: (int) how many recommendations away from the seed the tracks are
+            priorities: (list of floats) the priority of each track, higher is expanded first
+
+        Returns:
+            (int) how many new tracks were added
+        """
+        priorities = priorities if priorities else [0] * len(track_ids)
+        now = time.time()
+        cursor = self.con.cursor()
+        cursor.executemany("Insert or Ignore into CrawlTracks (crawl, id, depth, priority, added) values (?, ?, ?, ?, ?)",
+                           [(self.name, tid, depth, priority, now) for tid, priority in zip(track_ids, priorities)])
+        self.con.commit()
+        return cursor.rowcount
+
+    def _count(self, condition=""):
+        cursor = self.con.cursor()
+        cursor.execute(f"Select count(*) From CrawlTracks where crawl=? and depth > 0 {condition}", (self.name,))
+        return cursor.fetchone()[0]
+
+    def get_library_size(self):
+        """
+        Returns:
+            (int) how many tracks have been found, not including the seed
+        """
+        return self._count()
+
+    def get_library(self):
+        """
+        Returns:
+            (list of strings) the uris of every track found, not including the seed, in the order they were found
+        """
+        cursor = self.con.cursor()
+        cursor.execute("Select id From CrawlTracks where crawl=? and depth > 0 order by rowid", (self.name,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def is_visited(self, track_id):
+        """
+        Checks if a track has already been seen in this crawl
+        Args:
+            track_id: (string) the track uri
+
+        Returns:
+            (bool) whether or not the track is already known
+        """
+        cursor = self.con.cursor()
+        cursor.execute("Select 1 From CrawlTracks where crawl=? and id=?", (self.name, track_id))
+        return cursor.fetchone() is not None
+
+    def next_frontier(self, max_depth=None):
+        """
+        Gets the next track to expand, skipping tracks whose recommendations have failed too many times
+        Args:
+            max_depth: (int) the deepest layer to expand, or None for no limit
+
+        Returns:
+            (tuple of string and int|None) the track uri and its depth, or None if the frontier is empty
+        """
+        order = "depth, rowid" if self.order == CrawlOrder.BreadthFirst else "priority desc, depth, rowid"
+        depth_filter = "and depth < ?" if max_depth is not None else ""
+        params = (self.name, Settings.CrawlAttempts) + ((max_depth,) if max_depth is not None else ())
+        cursor = self.con.cursor()
+        cursor.execute("Select id, depth From CrawlTracks where crawl=? and expanded=0 and expanded_failures < ? " +
+                       f"{depth_filter} order by {order} limit 1", params)
+        return cursor.fetchone()
+
+    def _pending(self, column, limit):
+        cursor = self.con.cursor()
+        cursor.execute(f"Select id From CrawlTracks where crawl=? and depth > 0 and {column}=0 and {column}_failures < ? " +
+                       "order by rowid limit ?", (self.name, Settings.CrawlAttempts, limit))
+        return [row[0] for row in cursor.fetchall()]
+
+    def _mark(self, column, track_ids):
+        self.con.cursor().executemany(f"Update CrawlTracks set {column}=1 where crawl=? and id=?",
+                                      [(self.name, tid) for tid in track_ids])
+        self.con.commit()
+
+    def _fail(self, column, track_ids):
+        self.con.cursor().executemany(f"Update CrawlTracks set {column}_failures={column}_failures + 1 where crawl=? and id=?",
+                                      [(self.name, tid) for tid in track_ids])
+        self.con.commit()
+
+    def expand(self, track_id, depth, n, budget):
+        """
+        Gets recommendations for a track and adds the unseen ones to the frontier, without going over the budget
+        A track whose recommendations can't be fetched stays in the frontier, until it fails Settings.CrawlAttempts times
+        Args:
+            track_id: (string) the track uri to expand
+            depth: (int) the depth of the track being expanded
+            n: (int) how many recommendations to ask for
+            budget: (int) the most tracks that can still be added
+
+        Returns:
+            (int|None) how many new tracks were added, or None if the recommendations couldn't be fetched
+        """
+        try:
+            recommended = self.recommend(track_id, n) or []
+        except Exception as e:
+            Logger.write(f"Unable to get recommendations for {track_id}: {e}", LogLevel.Error)
+            self._fail("expanded", [track_id])
+            return None
+        new_tracks = []
+        seen = set()
+        for track in recommended:
+            tid = track["id"]
+            if tid in seen or self.is_visited(tid):
+                continue
+            seen.add(tid)
+            new_tracks.append(track)
+            if len(new_tracks) >= budget:
+                break
+        added = self.add_tracks([track["id"] for track in new_tracks], depth + 1,
+                                [track.get("popularity", 0) for track in new_tracks])
+        self._mark("expanded", [track_id])
+        return added
+
+    def fetch_pending(self, final=False):
+        """
+        Fetches audio features, and optionally downloads, for found tracks in batches
+        A batch that fails is left pending and stops that step, so it's retried on the next call,
+        until its tracks have failed Settings.CrawlAttempts times
+        Args:
+            final: (bool) whether or not to flush partially filled batches too
+
+        Returns:
+            (list of dicts) the audio features fetched
+        """
+        features = []
+        if self.fetch_features:
+            batch = self._pending("fetched", Settings.CrawlBatchSize)
+            while batch and (final or len(batch) >= Settings.CrawlBatchSize):
+                try:
+                    features.extend(feature for feature in self.fetch_features(batch) if feature)
+                except Exception as e:
+                    Logger.write(f"Unable to get features for {len(batch)} tracks: {e}", LogLevel.Error)
+                    self._fail("fetched", batch)
+                    break
+                self._mark("fetched", batch)
+                batch = self._pending("fetched", Settings.CrawlBatchSize)
+        if self.download:
+            batch = self._pending("downloaded", Settings.CrawlBatchSize)
+            while batch and (final or len(batch) >= Settings.CrawlBatchSize):
+                try:
+                    self.download(batch)
+                except Exception as e:
+                    Logger.write(f"Unable to download {len(batch)} tracks: {e}", LogLevel.Error)
+                    self._fail("downloaded", batch)
+                    break
+                self._mark("downloaded", batch)
+                batch = self._pending("downloaded", Settings.CrawlBatchSize)
+        return features
+
+    def run(self, max_tracks, n=None, max_depth=None):
+        """
+        Crawls until the library holds exactly max_tracks tracks, the frontier runs out, or recommendations fail
+        Anything that failed is left pending, so running the crawl again retries it
+        Args:
+            max_tracks: (int) the track budget, not including the seed
+            n: (int) how many recommendations to ask for per track
+            max_depth: (int) the deepest layer to expand, or None for no limit
+
+        Returns:
+            (list of dicts) the audio features fetched during this run
+        """
+        n = n if n else Settings.CrawlRecommendations
+        start = time.perf_counter()
+        resumed = self.get_library_size()
+        if resumed:
+            Logger.write(f"Resuming crawl '{self.name}' with {resumed} tracks already found")
+        features = []
+        while self.get_library_size() < max_tracks:
+            frontier = self.next_frontier(max_depth)
+            if not frontier:
+                Logger.write(f"Crawl '{self.name}' ran out of tracks to expand", LogLevel.Error)
+                break
+            track_id, depth = frontier
+            if self.expand(track_id, depth, n, max_tracks - self.get_library_size()) is None:
+                Logger.write(f"Stopping crawl '{self.name}' until it's run again", LogLevel.Error)
+                break
+            features.extend(self.fetch_pending())
+        features.extend(self.fetch_pending(final=True))
+        found = self.get_library_size()
+        elapsed = time.perf_counter() - start
+        Logger.write(f"Crawl '{self.name}' has {found} tracks ({found - resumed} new) in {elapsed:.1f} seconds")
+        return features
@@ -1,18 +1,25 @@
 """
 This file is responsible for connecting to the sqlite database and inserting/extracting data
-Currently, only the Features table exists and is usable
+The Features table holds audio features from spotify, and the Analysis table holds our own analysis of downloaded files
 """
 
 
 import sqlite3
+import threading
 try:
     from json_schema import features
+    from library import normalize_path
     from utilities import Logger
 except:
     from VibeMatch.json_schema import features
+    from VibeMatch.library import normalize_path
     from VibeMatch.utilities import Logger
 
 
+AnalysisColumns = {"id": "Varchar(32)", "file_name": "VarChar(128)", "tempo": "Real", "beats": "Blob", "duration": "Real",
+                   "intro_ms": "Integer", "outro_ms": "Integer", "avg_db": "Real"}  # column: type, in table order
+
+
 class FeaturesDatabase:
     _instance = None
 
@@ -24,13 +31,20 @@ class FeaturesDatabase:
             FeaturesDatabase._instance = FeaturesDatabase()
             return FeaturesDatabase._instance
 
-    def __init__(self):
+    def __init__(self, db_file=None):
+        """
+        Args:
+            db_file: (string) the sqlite database file, defaults to spotify.db
+        """
         if FeaturesDatabase._instance:
             Logger.write("Features database wrapper already exists")
         else:
+            self.db_file = db_file if db_file else 'spotify.db'
+            self.lock = threading.RLock()  # the connection is shared by the download and ingest threads
             self.con = self.get_features_db()
             self.created = False
             self.create_features_table()
+            self.create_analysis_table()
 
     def get_features_db(self):
         """
@@ -38,7 +52,7 @@ class FeaturesDatabase:
         Returns:
             (Sqlite Connection) the database connection object
         """
-        self.con = sqlite3.connect('spotify.db')
+        self.con = sqlite3.connect(self.db_file, check_same_thread=False)
         return self.con
 
     def close_db(self):
@@ -73,14 +87,88 @@ class FeaturesDatabase:
             (int) how many rows were added. this should always be 1
         """
         assert json_data.keys() == features.keys(), "Supplied feature data doesn't match the expected keys from json_schema.features"
-        cursor = self.con.cursor()
         empty = ", ".join(['?'] * len(features.keys()))
         split_data = tuple(json_data[key] for key in features.keys())
-        cursor.execute(f"Insert or Ignore into Features values ({empty})", split_data)
-        self.con.commit()
-        rows = cursor.rowcount
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute(f"Insert or Ignore into Features values ({empty})", split_data)
+            self.con.commit()
+            rows = cursor.rowcount
         return rows
 
+    def create_analysis_table(self):
+        """
+        Creates the audio analysis table in the sqlite database, adding any columns an older database is missing
+        Beat times are stored as float32 bytes, and file names as normalized absolute paths,
+        so every spelling of a file finds the same row. rows saved before then are renamed to their normalized paths
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Create Table if not exists Analysis (id Varchar(32), file_name VarChar(128) UNIQUE, " +
+                           "tempo Real, beats Blob, duration Real, intro_ms Integer, outro_ms Integer, avg_db Real)")
+            columns = {row[1] for row in cursor.execute("Pragma table_info(Analysis)").fetchall()}
+            for column, column_type in AnalysisColumns.items():
+                if column not in columns:
+                    cursor.execute(f"Alter Table Analysis Add Column {column} {column_type}")
+            self.con.create_function("normalize_path", 1, normalize_path, deterministic=True)
+            cursor.execute("Update or Replace Analysis set file_name=normalize_path(file_name) " +
+                           "where file_name != normalize_path(file_name)")
+            self.con.commit()
+
+    def save_analysis_to_db(self, rows):
+        """
+        Saves the analysis of many files at once, replacing any earlier analysis of the same files
+        Args:
+            rows: (list of dicts) each with the id, file_name, tempo, beats (ndarray of seconds) and duration,
+                and optionally the intro_ms, outro_ms and avg_db
+
+        Returns:
+            (int) how many rows were saved
+        """
+        import numpy as np
+        values = [(row.get("id"), normalize_path(row["file_name"]), row["tempo"],
+                   np.asarray(row["beats"], dtype=np.float32).tobytes(), row["duration"], row.get("intro_ms"),
+                   row.get("outro_ms"), row.get("avg_db")) for row in rows]
+        columns = ", ".join(AnalysisColumns)
+        with self.lock:
+            cursor = self.con.cursor()
+            placeholders = ", ".join(["?"] * len(AnalysisColumns))
+            cursor.executemany(f"Insert or Replace into Analysis ({columns}) values ({placeholders})", values)
+            self.con.commit()
+        return len(values)
+
+    def get_analyzed_file_names(self):
+        """
+        Returns:
+            (set of strings) the normalized path of every song that has been analyzed
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Select file_name From Analysis")
+            return {row[0] for row in cursor.fetchall()}
+
+    def get_analysis_from_file_name(self, file_name):
+        """
+        Grabs the saved analysis of a file
+        Args:
+            file_name: (string) file name of the song, in any spelling of its path
+
+        Returns:
+            (dict|None) the id, file_name (normalized), tempo, beats (ndarray of seconds), duration, intro_ms, outro_ms
+            and avg_db, else None
+        """
+        import numpy as np
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute(f"Select {', '.join(AnalysisColumns)} From Analysis where file_name=?",
+                           (normalize_path(file_name),))
+            result = cursor.fetchone()
+        if not result:
+            return None
+        analysis = dict(zip(AnalysisColumns, result))
+        analysis["beats"] = np.frombuffer(analysis["beats"], dtype=np.float32)
+        return analysis
+
     def get_features_from_file_name(self, file_name):
         """
         Grabs audio features where the file name matches
@@ -90,9 +178,10 @@ class FeaturesDatabase:
         Returns:
             (dict|None) the audio features else None
         """
-        cursor = self.con.cursor()
-        cursor.execute(f"Select * From Features where file_name='{file_name}'")
-        results = cursor.fetchone()
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute(f"Select * From Features where file_name='{file_name}'")
+            results = cursor.fetchone()
         if isinstance(results, tuple):
             return dict(zip(features.keys(), results))
         else:
@@ -107,9 +196,10 @@ class FeaturesDatabase:
         Returns:
             (list of audio feature dictionaries) the audio features grabbed
         """
-        cursor = self.con.cursor()
-        cursor.execute("Select * From Features")
-        results = cursor.fetchmany(n)
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Select * From Features")
+            results = cursor.fetchmany(n)
         if isinstance(results, list) and len(results) > 0 and isinstance(results[0], tuple):
             return [dict(zip(features.keys(), result)) for result in results]
         else:
@@ -0,0 +1,334 @@
+"""
+This file is responsible for decoding audio files once, into a form every other module can share
+The sample rate and channels are read from the container header without decoding anything,
+then ffmpeg decodes the file straight to 16 bit pcm. Those bytes back an AudioSegment without being copied,
+and are viewed as a NumPy array for the float32 mono buffer librosa works on
+Windows of a file that are only analyzed are decoded by ffmpeg straight to float32 in a NumPy buffer instead,
+seeking to the window so the rest of the file is never decoded
+"""
+
+
+import re
+import shutil
+import subprocess
+import numpy as np
+from pydub import AudioSegment, utils
+try:
+    from utilities import Logger, LogLevel
+except:
+    from VibeMatch.utilities import Logger, LogLevel
+
+
+SampleTypes = {1: np.int8, 2: np.int16, 4: np.int32}  # pcm sample width in bytes: numpy sample type
+
+
+class AudioInfo:
+    """
+    The stream information of an audio file, read from its header
+    """
+    def __init__(self, sample_rate, channels, duration):
+        """
+        Args:
+            sample_rate: (int) samples per second
+            channels: (int) how many channels the audio has
+            duration: (float) the length of the audio in seconds, 0 if the container doesn't say
+        """
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.duration = duration
+
+
+HasProber = bool(shutil.which("ffprobe") or shutil.which("avprobe"))
+ChannelLayouts = {"mono": 1, "stereo": 2, "2.1": 3, "quad": 4, "4.0": 4, "5.0": 5, "5.1": 6, "6.1": 7, "7.1": 8}
+
+
+def probe_audio(file_name):
+    """
+    Reads the sample rate, channels and duration of an audio file from its header, without decoding it
+    Uses ffprobe where it is installed, otherwise reads the stream description ffmpeg prints when given no output
+    Args:
+        file_name: (string) the audio file
+
+    Returns:
+        (AudioInfo) the stream information of the first audio stream
+    """
+    if HasProber:
+        info = utils.mediainfo_json(file_name)
+        streams = [stream for stream in info.get("streams", []) if stream.get("codec_type") == "audio"]
+        assert len(streams), f"'{file_name}' has no audio streams"
+        stream = streams[0]
+        duration = stream.get("duration", info.get("format", {}).get("duration", 0))
+        return AudioInfo(int(stream["sample_rate"]), int(stream["channels"]), float(duration or 0))
+    result = subprocess.run([AudioSegment.converter, "-hide_banner", "-nostdin", "-i", file_name],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    header = result.stderr.decode("utf-8", "ignore")
+    stream = re.search(r"Stream #\S+: Audio: [^\n]*?(\d+) Hz, ([^,\n]+)", header)
+    assert stream, f"'{file_name}' has no audio streams"
+    layout = stream.group(2).strip()
+    channels = ChannelLayouts.get(layout.split("(")[0], None)
+    if channels is None:
+        count = re.match(r"(\d+) channels", layout)
+        assert count, f"Unknown channel layout '{layout}' in '{file_name}'"
+        channels = int(count.group(1))
+    duration = re.search(r"Duration: (\d+):(\d+):([\d.]+)", header)
+    seconds = int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3)) if duration else 0
+    return AudioInfo(int(stream.group(1)), channels, seconds)
+
+
+class DecodedAudio:
+    """
+    Interleaved pcm audio decoded once, convertible to the forms pydub and librosa use
+    """
+    def __init__(self, pcm, sample_rate, channels, sample_width=2):
+        """
+        Args:
+            pcm: (bytes|ndarray) interleaved little-endian pcm samples, or a uint8 memory map of them
+            sample_rate: (int) samples per second
+            channels: (int) how many channels are interleaved
+            sample_width: (int) bytes per sample
+        """
+        assert sample_width in SampleTypes, f"Unsupported sample width {sample_width}"
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+
+    @staticmethod
+    def from_audio_segment(audio: AudioSegment):
+        """
+        Wraps audio that pydub has already decoded, so it doesn't need decoding again
+        Args:
+            audio: (AudioSegment) the decoded audio
+
+        Returns:
+            (DecodedAudio) the same samples, not copied
+        """
+        if audio.sample_width not in SampleTypes:  # 24 bit audio
+            audio = audio.set_sample_width(4)
+        return DecodedAudio(audio.raw_data, audio.frame_rate, audio.channels, audio.sample_width)
+
+    @property
+    def samples(self):
+        """
+        Returns:
+            (ndarray) a read-only view of the pcm bytes, shaped (frames, channels)
+        """
+        return np.frombuffer(self.pcm, dtype=SampleTypes[self.sample_width]).reshape(-1, self.channels)
+
+    def get_section(self, offset=0, duration=None):
+        """
+        Args:
+            offset: (float) seconds into the audio the section starts
+            duration: (float) the most seconds in the section, defaults to the rest of the audio
+
+        Returns:
+            (DecodedAudio) the section, sharing the pcm rather than copying it
+        """
+        frame_width = self.sample_width * self.channels
+        start = min(len(self.pcm), int(round(offset * self.sample_rate)) * frame_width)
+        end = len(self.pcm) if duration is None else \
+            min(len(self.pcm), start + int(round(duration * self.sample_rate)) * frame_width)
+        if start == 0 and end == len(self.pcm):
+            return self
+        pcm = memoryview(self.pcm)[start:end] if isinstance(self.pcm, bytes) else self.pcm[start:end]
+        return DecodedAudio(pcm, self.sample_rate, self.channels, self.sample_width)
+
+    @property
+    def duration(self):
+        """
+        Returns:
+            (float) the length of the audio in seconds
+        """
+        return len(self.pcm) / (self.sample_width * self.channels * self.sample_rate)
+
+    def to_audio_segment(self):
+        """
+        Returns:
+            (AudioSegment) the audio as a pydub AudioSegment, sharing the decoded bytes, or copying them out of a memory map
+        """
+        data = self.pcm if isinstance(self.pcm, bytes) else self.pcm.tobytes()
+        return AudioSegment(data=data, sample_width=self.sample_width, frame_rate=self.sample_rate, channels=self.channels)
+
+    def to_mono_float(self):
+        """
+        Mixes the channels down to mono float32 in [-1, 1), the same as librosa.load does
+        Only the one mono buffer is allocated, the channels are summed into it in place
+        Returns:
+            (ndarray) the float32 mono samples
+        """
+        samples = self.samples
+        mono = samples[:, 0].astype(np.float32)
+        for channel in range(1, self.channels):
+            mono += samples[:, channel]
+        mono *= 1 / (self.channels * float(2 ** (8 * self.sample_width - 1)))
+        return mono
+
+    def to_librosa(self):
+        """
+        Returns:
+            (tuple of ndarray and float) the audio in the form returned from librosa.load
+        """
+        return self.to_mono_float(), self.sample_rate
+
+
+def get_decode_command(file_name, sample_format, sample_rate, channels, offset=0, duration=None):
+    """
+    Builds the ffmpeg command that decodes a file to raw pcm on its standard output
+    Args:
+        file_name: (string) the audio file
+        sample_format: (string) the ffmpeg sample format, s16le or f32le
+        sample_rate: (int) the sample rate ffmpeg resamples to
+        channels: (int) how many channels ffmpeg mixes to
+        offset: (float) seconds into the file to seek to before decoding, so the audio before it is never decoded
+        duration: (float) the most seconds to decode, defaults to the rest of the file
+
+    Returns:
+        (list of strings) the command
+    """
+    command = [AudioSegment.converter, "-v", "error", "-nostdin"]
+    if offset:
+        command += ["-ss", str(offset)]
+    command += ["-i", file_name, "-vn"]
+    if duration:
+        command += ["-t", str(duration)]
+    codec = {"s16le": "pcm_s16le", "f32le": "pcm_f32le"}[sample_format]
+    return command + ["-f", sample_format, "-acodec", codec, "-ac", str(channels), "-ar", str(sample_rate), "-"]
+
+
+def read_pcm(command, expected_bytes=0):
+    """
+    Runs an ffmpeg decode, reading its output straight into a NumPy buffer rather than collecting it as bytes
+    The buffer is sized from how long the audio is expected to be, and only grows if ffmpeg outputs more than that
+    Args:
+        command: (list of strings) the ffmpeg command, writing raw pcm to its standard output
+        expected_bytes: (int) how many bytes ffmpeg is expected to output
+
+    Returns:
+        (ndarray) the uint8 pcm bytes
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    buffer = np.empty(max(int(expected_bytes), 1 << 16), dtype=np.uint8)
+    filled = 0
+    try:
+        while True:
+            if filled == len(buffer):
+                grown = np.empty(2 * len(buffer), dtype=np.uint8)
+                grown[:filled] = buffer[:filled]
+                buffer = grown
+            with memoryview(buffer) as view:
+                read = process.stdout.readinto(view[filled:])
+            if not read:
+                break
+            filled += read
+        errors = process.stderr.read()
+        process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+    if process.returncode != 0:
+        raise IOError(f"Unable to decode '{command[command.index('-i') + 1]}': {errors.decode('utf-8', 'ignore').strip()}")
+    return buffer[:filled] if filled > len(buffer) // 2 else buffer[:filled].copy()  # don't keep a mostly empty buffer
+
+
+def load_samples(file_name, info: AudioInfo = None, sample_rate=None, channels=1, offset=0, duration=None):
+    """
+    Decodes a window of an audio file straight to float32 samples, without going through 16 bit pcm or an AudioSegment
+    Seeking, resampling and mixing down are done by ffmpeg, so only the window is ever decoded
+    Args:
+        file_name: (string) the audio file
+        info: (AudioInfo) the stream information, if it has already been probed
+        sample_rate: (int) the sample rate to decode at, defaults to the file's own
+        channels: (int) how many channels to decode to, None for the file's own
+        offset: (float) seconds into the file to start decoding from
+        duration: (float) the most seconds to decode, defaults to the rest of the file
+
+    Returns:
+        (ndarray) the float32 samples in [-1, 1], shaped (frames,) for mono, otherwise (frames, channels)
+    """
+    info = info if info else probe_audio(file_name)
+    sample_rate = sample_rate if sample_rate else info.sample_rate
+    channels = channels if channels else info.channels
+    seconds = duration if duration else max(0.0, info.duration - offset)
+    if info.duration:
+        seconds = min(seconds, max(0.0, info.duration - offset))
+    expected = (int(seconds * sample_rate) + sample_rate // 10) * channels * 4  # a little spare, so it rarely grows
+    samples = read_pcm(get_decode_command(file_name, "f32le", sample_rate, channels, offset, duration), expected)
+    samples = samples[:len(samples) - len(samples) % (4 * channels)].view(np.float32)
+    seconds = len(samples) / channels / sample_rate
+    Logger.write(f"Decoded '{file_name}' ({seconds:.1f} seconds from {offset:.1f})", LogLevel.Debug)
+    return samples if channels == 1 else samples.reshape(-1, channels)
+
+
+def load_audio(file_name, info: AudioInfo = None, sample_rate=None, channels=None, offset=0, duration=None):
+    """
+    Decodes an audio file once, at its own sample rate and channel count unless others are asked for
+    Resampling, mixing down and seeking are done by ffmpeg while decoding, so the full-rate audio is never in memory
+    Args:
+        file_name: (string) the audio file
+        info: (AudioInfo) the stream information, if it has already been probed
+        sample_rate: (int) the sample rate to decode at, defaults to the file's own
+        channels: (int) how many channels to decode to, defaults to the file's own
+        offset: (float) seconds into the file to start decoding from
+        duration: (float) the most seconds to decode, defaults to the rest of the file
+
+    Returns:
+        (DecodedAudio) the decoded 16 bit pcm audio
+    """
+    info = info if info else probe_audio(file_name)
+    sample_rate = sample_rate if sample_rate else info.sample_rate
+    channels = channels if channels else info.channels
+    command = get_decode_command(file_name, "s16le", sample_rate, channels, offset, duration)
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)  # bytes, which pydub shares as they are
+    if result.returncode != 0:
+        raise IOError(f"Unable to decode '{file_name}': {result.stderr.decode('utf-8', 'ignore').strip()}")
+    frame_width = 2 * channels
+    pcm = result.stdout
+    if len(pcm) % frame_width:  # a truncated last frame
+        pcm = pcm[:len(pcm) - len(pcm) % frame_width]
+    Logger.write(f"Decoded '{file_name}' ({len(pcm) / frame_width / sample_rate:.1f} seconds)", LogLevel.Debug)
+    return DecodedAudio(pcm, sample_rate, channels)
+
+
+def stream_audio(file_name, block_length, overlap=0, sample_rate=None, info: AudioInfo = None):
+    """
+    Decodes a file a block at a time through an ffmpeg pipe, as mono float32, so the whole file is never in memory
+    Args:
+        file_name: (string) the audio file
+        block_length: (int) samples per block
+        overlap: (int) how many samples each block repeats from the end of the previous one
+        sample_rate: (int) the sample rate to decode at, defaults to the file's own
+        info: (AudioInfo) the stream information, if it has already been probed
+
+    Returns:
+        (generator of ndarrays) the blocks, all block_length samples long except possibly the last
+    """
+    assert 0 <= overlap < block_length, f"Overlap {overlap} must be shorter than the block length {block_length}"
+    info = info if info else probe_audio(file_name)
+    command = get_decode_command(file_name, "f32le", sample_rate if sample_rate else info.sample_rate, 1)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    buffer = bytearray(block_length * 4)
+    view = memoryview(buffer)
+    filled = 0  # bytes
+    first = True
+    try:
+        while True:
+            read = process.stdout.readinto(view[filled:])
+            filled += read
+            if read and filled < len(buffer):
+                continue
+            samples = filled // 4
+            if samples > overlap or (first and samples):
+                yield np.frombuffer(buffer, dtype=np.float32, count=samples).copy()
+            if not read:
+                break
+            first = False
+            view[:overlap * 4] = view[(samples - overlap) * 4:samples * 4]
+            filled = overlap * 4
+    finally:
+        view.release()
+        process.stdout.close()
+        process.kill()
+        process.wait()
@@ -0,0 +1,370 @@
+"""
+This file is responsible for downloading many songs from many sources at once
+Playlists, albums and artists are resolved to tracks concurrently, and each track is downloaded as soon as it is known,
+so the metadata requests for one source overlap with the transfers of another instead of waiting for them to finish
+Tracks are deduplicated across every source, and songs already in the library manifest are skipped
+"""
+
+
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+import os
+import threading
+import time
+try:
+    import spotify
+    from library import LibraryManifest
+    from utilities import Logger, LogLevel, Settings, FolderDefinitions, FileFormats, get_path_template
+except:
+    from VibeMatch import spotify
+    from VibeMatch.library import LibraryManifest
+    from VibeMatch.utilities import Logger, LogLevel, Settings, FolderDefinitions, FileFormats, get_path_template
+from spotdl.download.downloader import Downloader
+from spotdl.types.options import DownloaderOptions
+from spotdl.types.song import Song
+
+
+class SourceTypes:
+    """
+    The kinds of things that can be downloaded
+    """
+    Playlist = "playlist"
+    Album = "album"
+    Artist = "artist"
+    Track = "track"
+
+
+class DownloadStatus:
+    """
+    The outcomes of downloading a track
+    """
+    Downloaded = "downloaded"
+    Skipped = "skipped"  # already in the library
+    Failed = "failed"
+
+
+class DownloadResult:
+    """
+    The outcome of downloading one track
+    """
+    def __init__(self, track_id, status, path=None, elapsed=0.0, size=0, song=None):
+        """
+        Args:
+            track_id: (string) the track uri
+            status: (DownloadStatus) whether the track was downloaded, skipped or failed
+            path: (string) the file the song is in, or None if it failed
+            elapsed: (float) seconds spent getting the metadata and downloading
+            size: (int) the size of the file in bytes
+            song: (Song) the spotdl song metadata, if it was fetched
+        """
+        self.track_id = track_id
+        self.status = status
+        self.path = path
+        self.elapsed = elapsed
+        self.size = size
+        self.song = song
+
+    def __str__(self):
+        name = self.song.display_name if self.song else self.track_id
+        return f"{self.status} {name} ({self.size / 1e6:.1f} MB in {self.elapsed:.1f} seconds)"
+
+
+def get_source_type(source):
+    """
+    Gets the kind of source from a url, uri, or track data
+    Args:
+        source: (any) a playlist, album, artist or track url, a track uri, or track data from spotify
+
+    Returns:
+        (SourceTypes) the kind of source
+    """
+    if isinstance(source, str):
+        for source_type in (SourceTypes.Playlist, SourceTypes.Artist, SourceTypes.Album):
+            if f"{source_type}/" in source or f"{source_type}:" in source:
+                return source_type
+    return SourceTypes.Track
+
+
+class DownloadScheduler:
+    """
+    Downloads tracks from any number of sources with one bounded pool of transfers
+    """
+    def __init__(self, threads=None, custom_folder=None, on_result=None):
+        """
+        Builds a download scheduler, scanning the folder into the library manifest if it hasn't been yet,
+        so songs already in it are skipped, but nothing is downloaded until sources are added
+        Args:
+            threads: (int) the most songs downloaded at once, across every source
+            custom_folder: (string) a folder other than songs/
+            on_result: (function) called with each DownloadResult as soon as that track is done
+        """
+        self.threads = threads if threads else Settings.DownloadThreads
+        self.custom_folder = custom_folder
+        self.folder = custom_folder if custom_folder else FolderDefinitions.Songs
+        self.on_result = on_result
+        self.downloader = None
+        self.manifest = LibraryManifest.get_instance()
+        self.manifest.ensure_scanned(self.folder)
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.resolving = []
+        self.downloading = []
+        self.resolver = ThreadPoolExecutor(max_workers=Settings.SourceConcurrency)
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.queued = 0
+        self.skipped = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = None
+
+    def get_downloader(self):
+        """
+        Gets the spotdl downloader shared by every transfer, creating it the first time it is needed
+        Returns:
+            (Downloader) the spotdl downloader
+        """
+        with self.lock:
+            if not self.downloader:
+                spotify.SpotifyClientWrapper.get_client()
+                os.makedirs(self.folder, exist_ok=True)
+                self.downloader = Downloader(DownloaderOptions(
+                    format=FileFormats.M4a,
+                    output=get_path_template(self.folder),
+                    bitrate=Settings.Bitrate,
+                    threads=self.threads,
+                ))
+                self.downloader.progress_handler.set_song_count(self.queued)
+            return self.downloader
+
+    def add(self, source):
+        """
+        Adds a source to download, its tracks are looked up in the background
+        Args:
+            source: (any) a playlist, album, artist or track url, a track uri, or track data from spotify
+        """
+        if self.start is None:
+            self.start = time.perf_counter()
+        source_type = get_source_type(source)
+        if source_type == SourceTypes.Track:
+            self.enqueue([source])
+        else:
+            with self.lock:
+                self.resolving.append(self.resolver.submit(self.resolve, source, source_type))
+
+    def resolve(self, source, source_type):
+        """
+        Gets the tracks of a playlist, album or artist and queues them
+        An artist's albums are added as sources of their own, so the first album starts downloading straight away
+        Args:
+            source: (string) the playlist, album or artist url or uri
+            source_type: (SourceTypes) the kind of source
+        """
+        source_id = spotify.get_id_from_url(source if "open." in source else source.split(":")[-1])
+        try:
+            if source_type == SourceTypes.Playlist:
+                self.enqueue([item["track"] for item in spotify.get_playlist_tracks(source_id) if item.get("track")])
+            elif source_type == SourceTypes.Album:
+                self.enqueue(spotify.get_album_tracks(source_id))
+            elif source_type == SourceTypes.Artist:
+                for album in spotify.get_artist_albums(source_id):
+                    self.add(f"album:{album['id']}")
+        except Exception as e:
+            Logger.write(f"Unable to get the tracks of {source}: {e}", LogLevel.Error)
+
+    def enqueue(self, tracks):
+        """
+        Queues tracks for download, skipping any already queued or downloaded
+        Args:
+            tracks: (list) track uris, urls, or track data from spotify
+        """
+        with self.lock:
+            new_tracks = [tid for tid in map(self.get_new_track_id, tracks) if tid]
+            self.queued += len(new_tracks)
+            for tid in new_tracks:
+                self.track(self.pool.submit(self.download_track, tid))
+            if new_tracks and self.downloader:
+                self.downloader.progress_handler.set_song_count(self.queued)
+        if new_tracks and Settings.GetFeatures:
+            try:
+                spotify.get_multiple_audio_features(new_tracks, self.custom_folder)
+            except Exception as e:
+                Logger.write(f"Unable to get data for {len(new_tracks)} tracks: {e}")
+
+    def get_new_track_id(self, track):
+        """
+        Marks a track as seen, reporting it as skipped if it's already downloaded, called with the lock held
+        Args:
+            track: (string|dict) a track uri, url, or track data from spotify
+
+        Returns:
+            (string|None) the track uri if it still needs downloading, else None
+        """
+        try:
+            tid = track["id"] if isinstance(track, dict) else spotify.get_id_from_url(track)
+        except Exception as e:
+            Logger.write(f"Unable to download {track}: {e}", LogLevel.Error)
+            return None
+        if tid in self.seen:
+            return None
+        self.seen.add(tid)
+        if spotify.is_downloaded(track, self.custom_folder):
+            self.skipped += 1
+            skipped = Future()
+            skipped.set_result(DownloadResult(tid, DownloadStatus.Skipped, self.manifest.get_path(tid)))
+            self.track(skipped)
+            return None
+        return tid
+
+    def track(self, future):
+        """
+        Keeps track of a download, and reports its result when it is done
+        Args:
+            future: (Future) resolves to the DownloadResult of the track
+        """
+        self.downloading.append(future)
+        if self.on_result:
+            future.add_done_callback(self.report)
+
+    def report(self, future):
+        """
+        Passes a finished download to the result callback
+        Args:
+            future: (Future) the finished download
+        """
+        try:
+            self.on_result(future.result())
+        except Exception as e:
+            Logger.write(f"Download result callback failed: {e}", LogLevel.Error)
+
+    def transfer(self, track_id):
+        """
+        Gets the song metadata and downloads it
+        Args:
+            track_id: (string) the track uri
+
+        Returns:
+            (tuple of Song and Path|None) the song and the path it was downloaded to, or None if it failed
+        """
+        song = Song.from_url(f"https://open.spotify.com/track/{track_id}")
+        return self.get_downloader().search_and_download(song)
+
+    def download_track(self, track_id):
+        """
+        Downloads a track and records the outcome, run on the transfer pool
+        Args:
+            track_id: (string) the track uri
+
+        Returns:
+            (DownloadResult) the outcome of the download
+        """
+        start = time.perf_counter()
+        song, path = None, None
+        try:
+            song, path = self.transfer(track_id)
+        except Exception as e:
+            Logger.write(f"Unable to download {track_id}: {e}", LogLevel.Error)
+        path = str(path) if path else None
+        size = os.path.getsize(path) if path and os.path.exists(path) else 0
+        with self.lock:
+            if path:
+                self.completed += 1
+                self.bytes += size
+            else:
+                self.failed += 1
+        if path:
+            self.manifest.add(track_id, path)
+        return DownloadResult(track_id, DownloadStatus.Downloaded if path else DownloadStatus.Failed, path,
+                              time.perf_counter() - start, size, song)
+
+    def pending(self):
+        """
+        Returns:
+            (list of Futures) the lookups and downloads that aren't done yet
+        """
+        with self.lock:
+            return [future for future in self.resolving + self.downloading if not future.done()]
+
+    def iter_results(self):
+        """
+        Yields the result of each track as soon as it is done, until every source has been downloaded
+        Returns:
+            (generator of DownloadResults) the results, in the order they finish
+        """
+        reported = set()
+        while True:
+            with self.lock:
+                resolving = set(self.resolving)
+                futures = [future for future in self.resolving + self.downloading if future not in reported]
+            if not futures:
+                return
+            for future in as_completed(futures):
+                reported.add(future)
+                if future not in resolving:
+                    yield future.result()
+
+    def wait(self):
+        """
+        Waits for every source to be resolved and every queued track to be downloaded
+        Returns:
+            (list of DownloadResults) the result of each track
+        """
+        pending = self.pending()
+        while pending:
+            wait(pending)
+            pending = self.pending()
+        with self.lock:
+            results = [future.result() for future in self.downloading]
+        Logger.write(str(self))
+        return results
+
+    def run(self, sources):
+        """
+        Downloads every track from the sources given, then closes the scheduler
+        Args:
+            sources: (any) one or more playlist, album, artist or track urls, track uris, or track data from spotify
+
+        Returns:
+            (list of DownloadResults) the result of each track
+        """
+        for source in sources if isinstance(sources, list) else [sources]:
+            self.add(source)
+        try:
+            return self.wait()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops the worker threads, after any work already queued
+        """
+        self.resolver.shutdown()
+        self.pool.shutdown()
+
+    def get_elapsed(self):
+        """
+        Returns:
+            (float) seconds since the first source was added
+        """
+        return time.perf_counter() - self.start if self.start is not None else 0
+
+    def get_throughput(self):
+        """
+        Returns:
+            (dict) the download counts, and songs and megabytes per second so far
+        """
+        elapsed = max(self.get_elapsed(), 1e-9)
+        return {
+            "queued": self.queued,
+            "skipped": self.skipped,
+            "completed": self.completed,
+            "failed": self.failed,
+            "megabytes": self.bytes / 1e6,
+            "songs_per_second": self.completed / elapsed,
+            "megabytes_per_second": self.bytes / 1e6 / elapsed,
+        }
+
+    def __str__(self):
+        throughput = self.get_throughput()
+        return (f"Downloaded {throughput['completed']}/{throughput['queued']} songs ({throughput['failed']} failed, "
+                f"{throughput['skipped']} already downloaded) in {self.get_elapsed():.1f} seconds, "
+                f"{throughput['songs_per_second']:.2f} songs/s, {throughput['megabytes_per_second']:.2f} MB/s")
@@ -0,0 +1,390 @@
+"""
+This file is responsible for describing whole songs as fixed-size embeddings, for finding similar songs
+Each song is cut into a few fixed-length windows, and a small model turns the log-mel statistics of each window
+into a unit vector. Windows from many songs are batched into each forward pass, and a song's embedding is the
+normalized mean of its windows. The embeddings are rows of a memory-mapped matrix on disk, so the similarity of
+one song to the whole library is a single matrix product, without loading the matrix into memory
+
+Usage: python embedding.py <folder> to embed a folder and list the songs most similar to each
+"""
+
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import numpy as np
+import torch
+import torchaudio
+try:
+    from cache import open_audio
+    from decode import probe_audio
+    from library import normalize_path
+    from utilities import Logger, LogLevel, FolderDefinitions, Settings, get_file_hash
+except:
+    from VibeMatch.cache import open_audio
+    from VibeMatch.decode import probe_audio
+    from VibeMatch.library import normalize_path
+    from VibeMatch.utilities import Logger, LogLevel, FolderDefinitions, Settings, get_file_hash
+
+
+EmbeddingParameters = {"model": "log-mel statistics", "sample_rate": 16000, "n_fft": 1024, "hop_length": 320, "n_mels": 64,
+                       "window_seconds": 10, "windows": 6, "dimensions": 128, "seed": 0}
+
+
+def get_windows(file_name, info=None):
+    """
+    Decodes the fixed-length windows of a song that its embedding is made from, spread evenly through the song
+    Only the windows are decoded, and they aren't kept in the decoded audio cache, so embedding a library doesn't decode
+    every song whole or push the songs being analyzed out of the cache
+    Songs shorter than a window are padded with silence
+    Args:
+        file_name: (string) the audio file
+        info: (AudioInfo) the stream information, if it has already been probed
+
+    Returns:
+        (ndarray) the float32 windows, shaped (windows, samples per window)
+    """
+    info = info if info else probe_audio(file_name)
+    sample_rate, seconds = EmbeddingParameters["sample_rate"], EmbeddingParameters["window_seconds"]
+    length = sample_rate * seconds
+    count = max(1, min(EmbeddingParameters["windows"], int(info.duration // seconds)))
+    last = max(0.0, info.duration - seconds)
+    starts = np.linspace(0, last, count + 2)[1:-1] if count > 1 else [last / 2]
+    windows = np.zeros((count, length), dtype=np.float32)
+    for row, start in enumerate(starts):  # a section, so it's cut from a cached song or decoded alone, never cached
+        window = open_audio(file_name, info, sample_rate, 1, round(float(start), 3), seconds).samples[:length, 0]
+        windows[row, :len(window)] = window * (1 / 32768)
+    return windows
+
+
+class EmbeddingModel(torch.nn.Module):
+    """
+    Turns windows of audio into unit vectors, from the mean, deviation and movement of each mel band's log power
+    Without trained weights the projection is a fixed random one, which keeps the distances between the statistics
+    """
+    def __init__(self, weights=None):
+        """
+        Args:
+            weights: (string) a file of trained weights saved with torch.save(model.state_dict()), defaults to
+                Settings.EmbeddingWeights
+        """
+        super().__init__()
+        parameters = EmbeddingParameters
+        self.mel = torchaudio.transforms.MelSpectrogram(parameters["sample_rate"], n_fft=parameters["n_fft"],
+                                                        hop_length=parameters["hop_length"], n_mels=parameters["n_mels"])
+        statistics = 4 * parameters["n_mels"]
+        self.projection = torch.nn.Linear(statistics, parameters["dimensions"], bias=False)
+        generator = torch.Generator().manual_seed(parameters["seed"])
+        with torch.no_grad():
+            projection = torch.randn(parameters["dimensions"], statistics, generator=generator)
+            self.projection.weight.copy_(projection / statistics ** 0.5)
+        weights = weights if weights else Settings.EmbeddingWeights
+        if weights:
+            self.load_state_dict(torch.load(weights, map_location="cpu"))
+        self.eval()
+
+    def forward(self, windows):
+        """
+        Args:
+            windows: (Tensor) the audio windows, shaped (batch, samples)
+
+        Returns:
+            (Tensor) the unit embedding of each window, shaped (batch, dimensions)
+        """
+        log_mel = torch.log(self.mel(windows) + 1e-6)  # (batch, mels, frames)
+        level = log_mel.mean(dim=2)
+        movement = log_mel.diff(dim=2)
+        statistics = torch.cat([level - level.mean(dim=1, keepdim=True), log_mel.std(dim=2),  # louder copies embed the same
+                                movement.abs().mean(dim=2), movement.std(dim=2)], dim=1)
+        return torch.nn.functional.normalize(self.projection(statistics), dim=1)
+
+
+def get_model_id(weights=None):
+    """
+    Args:
+        weights: (string) the trained weights file, defaults to Settings.EmbeddingWeights
+
+    Returns:
+        (string) an id of the model and its weights, which changes whenever the embeddings it makes would
+    """
+    weights = weights if weights else Settings.EmbeddingWeights
+    description = json.dumps([EmbeddingParameters, get_file_hash(weights) if weights else None], sort_keys=True)
+    return hashlib.blake2b(description.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def decode_windows(file_names):
+    """
+    Decodes the windows of songs on a pool of threads, only a few songs ahead of the one being embedded,
+    so a whole library's windows are never in memory
+    Args:
+        file_names: (list of strings) the audio files
+
+    Yields:
+        (tuple of string and ndarray|None) each file name, in order, and its windows, or None if it couldn't be decoded
+    """
+    def decode(file_name):
+        try:
+            return file_name, get_windows(file_name)
+        except Exception as e:
+            Logger.write(f"Unable to embed '{file_name}': {e}", LogLevel.Error)
+            return file_name, None
+
+    with ThreadPoolExecutor(max_workers=Settings.EmbeddingDecoders) as pool:
+        remaining = iter(file_names)
+        decoding = deque(pool.submit(decode, file_name) for file_name in islice(remaining, 2 * Settings.EmbeddingDecoders))
+        while decoding:
+            decoded = decoding.popleft().result()
+            following = next(remaining, None)
+            if following is not None:
+                decoding.append(pool.submit(decode, following))
+            yield decoded
+
+
+def extract_embeddings(file_names, model=None, batch_size=None, threads=None):
+    """
+    Embeds many songs on the cpu, batching windows from several songs into each forward pass
+    Songs are decoded by a pool of threads while the model runs, since decoding is done by ffmpeg outside of python
+    Args:
+        file_names: (list of strings) the audio files
+        model: (EmbeddingModel) the model to use, built if not given
+        batch_size: (int) windows per forward pass, defaults to Settings.EmbeddingBatchSize
+        threads: (int) threads torch uses, defaults to Settings.EmbeddingThreads
+
+    Returns:
+        (dict) file name: (ndarray) the float32 unit embedding, for every file that could be decoded
+    """
+    torch.set_num_threads(threads if threads else Settings.EmbeddingThreads)
+    model = model if model else EmbeddingModel()
+    batch_size = batch_size if batch_size else Settings.EmbeddingBatchSize
+    sums = {}
+    pending, owners = [], []  # windows waiting for a forward pass, and the file each belongs to
+
+    def run_batch():
+        with torch.inference_mode():
+            embedded = model(torch.from_numpy(np.concatenate(pending))).numpy()
+        for file_name, embedding in zip(owners, embedded):
+            sums[file_name] = sums.get(file_name, 0) + embedding
+        pending.clear()
+        owners.clear()
+
+    for file_name, windows in decode_windows(file_names):
+        position = 0
+        while windows is not None and position < len(windows):  # a song's windows may be split over two batches
+            chunk = windows[position:position + batch_size - len(owners)]
+            pending.append(chunk)
+            owners.extend([file_name] * len(chunk))
+            position += len(chunk)
+            if len(owners) >= batch_size:
+                run_batch()
+    if pending:
+        run_batch()
+    return {file_name: (total / max(np.linalg.norm(total), 1e-10)).astype(np.float32) for file_name, total in sums.items()}
+
+
+class EmbeddingIndex:
+    """
+    The embedding of every indexed song, as rows of a memory-mapped matrix, with the row of each file kept in sqlite
+    """
+    _instance = None
+
+    @staticmethod
+    def get_instance():
+        if EmbeddingIndex._instance:
+            return EmbeddingIndex._instance
+        else:
+            EmbeddingIndex._instance = EmbeddingIndex()
+            return EmbeddingIndex._instance
+
+    def __init__(self, db_file=None, matrix_file=None, weights=None):
+        """
+        Args:
+            db_file: (string) the sqlite database file to keep the row of each file in
+            matrix_file: (string) the .npy file to keep the embeddings in
+            weights: (string) the trained model weights, defaults to Settings.EmbeddingWeights
+        """
+        self.con = sqlite3.connect(db_file if db_file else Settings.EmbeddingDatabase, check_same_thread=False)
+        self.matrix_file = matrix_file if matrix_file else Settings.EmbeddingMatrix
+        self.weights = weights
+        self.model_id = get_model_id(weights)
+        self.model = None
+        self.lock = threading.RLock()
+        self.create_tables()
+        self.matrix = None
+        self.open_matrix()
+
+    def create_tables(self):
+        """
+        Creates the index table if it doesn't exist yet
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Create Table if not exists EmbeddingFiles (path Varchar(512) UNIQUE, hash Varchar(64), " +
+                           "model Varchar(16), row Integer UNIQUE)")
+            self.con.commit()
+
+    def open_matrix(self, rows=0):
+        """
+        Maps the embedding matrix, creating it, or growing it by doubling, so it has room for a number of rows
+        Args:
+            rows: (int) how many rows the matrix must have room for
+        """
+        dimensions = EmbeddingParameters["dimensions"]
+        with self.lock:
+            if self.matrix is None and os.path.exists(self.matrix_file):
+                self.matrix = np.lib.format.open_memmap(self.matrix_file, mode="r+")
+                if self.matrix.shape[1] != dimensions:  # made with other parameters, so every row is stale
+                    self.matrix = None
+                    self.con.execute("Delete From EmbeddingFiles")
+                    self.con.commit()
+            capacity = 0 if self.matrix is None else len(self.matrix)
+            if self.matrix is not None and rows <= capacity:
+                return
+            capacity = max(Settings.EmbeddingCapacity, capacity)
+            while capacity < rows:
+                capacity *= 2
+            os.makedirs(os.path.dirname(os.path.abspath(self.matrix_file)), exist_ok=True)
+            temporary = f"{self.matrix_file}.tmp.npy"
+            grown = np.lib.format.open_memmap(temporary, mode="w+", dtype=np.float32, shape=(capacity, dimensions))
+            if self.matrix is not None:
+                grown[:len(self.matrix)] = self.matrix
+            grown.flush()
+            del grown
+            self.matrix = None  # unmapped before it's replaced
+            os.replace(temporary, self.matrix_file)
+            self.matrix = np.lib.format.open_memmap(self.matrix_file, mode="r+")
+
+    def close(self):
+        """
+        Flushes the embedding matrix, and closes the sqlite database connection
+        """
+        with self.lock:
+            if self.matrix is not None:
+                self.matrix.flush()
+                self.matrix = None
+            self.con.close()
+
+    def get_rows(self):
+        """
+        Returns:
+            (list of tuples) the path and row of every file embedded with the current model, by row
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Select path, row From EmbeddingFiles where model=? Order By row", (self.model_id,))
+            return cursor.fetchall()
+
+    def add(self, file_names, batch_size=None, threads=None):
+        """
+        Embeds files and stores their embeddings, skipping files whose contents were already embedded by the same model
+        Args:
+            file_names: (list of strings) the audio files
+            batch_size: (int) windows per forward pass, defaults to Settings.EmbeddingBatchSize
+            threads: (int) threads torch uses, defaults to Settings.EmbeddingThreads
+
+        Returns:
+            (int) how many files were embedded
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Select path, hash, model, row From EmbeddingFiles")
+            known = {path: (file_hash, model, row) for path, file_hash, model, row in cursor.fetchall()}
+        hashes = {file_name: get_file_hash(file_name) for file_name in file_names}
+        stale = [file_name for file_name in file_names
+                 if known.get(normalize_path(file_name), (None, None))[:2] != (hashes[file_name], self.model_id)]
+        if not stale:
+            return 0
+        self.model = self.model if self.model else EmbeddingModel(self.weights)
+        embeddings = extract_embeddings(stale, self.model, batch_size, threads)
+        with self.lock:
+            next_row = max([row for _, _, row in known.values()], default=-1) + 1
+            rows = {}
+            for file_name in embeddings:
+                path = normalize_path(file_name)
+                if path in known:
+                    rows[file_name] = known[path][2]
+                else:
+                    rows[file_name] = next_row
+                    next_row += 1
+            self.open_matrix(next_row)
+            for file_name, embedding in embeddings.items():
+                self.matrix[rows[file_name]] = embedding
+            self.matrix.flush()
+            cursor = self.con.cursor()
+            cursor.executemany("Insert or Replace into EmbeddingFiles (path, hash, model, row) values (?, ?, ?, ?)",
+                               [(normalize_path(file_name), hashes[file_name], self.model_id, rows[file_name])
+                                for file_name in embeddings])
+            self.con.commit()
+        Logger.write(f"Embedded {len(embeddings)}/{len(stale)} songs", LogLevel.Debug)
+        return len(embeddings)
+
+    def index_folder(self, folder=None, batch_size=None, threads=None):
+        """
+        Embeds every audio file in a folder, recursively, skipping files that haven't changed
+        Args:
+            folder: (string) the folder to index, defaults to the songs folder
+            batch_size: (int) windows per forward pass, defaults to Settings.EmbeddingBatchSize
+            threads: (int) threads torch uses, defaults to Settings.EmbeddingThreads
+
+        Returns:
+            (int) how many files were embedded
+        """
+        from analyze import find_audio_files
+        return self.add(find_audio_files(folder if folder else FolderDefinitions.Songs), batch_size, threads)
+
+    def get_embedding(self, file_name):
+        """
+        Args:
+            file_name: (string) the audio file
+
+        Returns:
+            (ndarray|None) the file's embedding, a view into the memory-mapped matrix, or None if it isn't embedded
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Select row From EmbeddingFiles where path=? and model=?",
+                           (normalize_path(file_name), self.model_id))
+            row = cursor.fetchone()
+        return self.matrix[row[0]] if row else None
+
+    def find_similar(self, audio, count=10):
+        """
+        Finds the indexed songs that sound most like a song, by the cosine similarity of their embeddings
+        Args:
+            audio: (string|ndarray) an audio file, embedded if it isn't indexed, or an embedding
+            count: (int) the most songs to return
+
+        Returns:
+            (list of tuples) the path and similarity (-1 to 1) of each song, most similar first, not including the song itself
+        """
+        path = None
+        if isinstance(audio, str):
+            path = normalize_path(audio)
+            embedding = self.get_embedding(audio)
+            if embedding is None:
+                self.model = self.model if self.model else EmbeddingModel(self.weights)
+                embedding = extract_embeddings([audio], self.model).get(audio)
+                if embedding is None:
+                    return []
+        else:
+            embedding = audio
+        indexed = self.get_rows()
+        if not indexed:
+            return []
+        paths, rows = zip(*indexed)
+        rows = np.asarray(rows)
+        similarities = (self.matrix[:rows[-1] + 1] @ embedding)[rows]  # reads the mapped rows in order, without copying them
+        order = np.argsort(-similarities)
+        return [(paths[index], float(similarities[index])) for index in order if paths[index] != path][:count]
+
+
+if __name__ == "__main__":
+    index = EmbeddingIndex.get_instance()
+    index.index_folder(sys.argv[1] if len(sys.argv) > 1 else None)
+    for song, _ in index.get_rows():
+        Logger.write(f"Most similar to '{song}': {index.find_similar(song, 3)}")
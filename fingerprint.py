@@ -0,0 +1,289 @@
+"""
+This file is responsible for recognizing the same recording across different files
+Each file is reduced to landmarks, pairs of spectral peaks hashed by their frequencies and the time between them,
+which survive re-encoding, and whose times shift together when a file is trimmed or extended
+The landmarks are kept in an sqlite table clustered by hash, so finding the files that share a file's landmarks
+is an index lookup per landmark rather than a comparison with every file in the library
+
+Usage: python fingerprint.py <folder> to index a folder and list its duplicates
+"""
+
+
+import sqlite3
+import sys
+import threading
+import numpy as np
+try:
+    from cache import open_audio
+    from library import normalize_path
+    from utilities import Logger, LogLevel, FolderDefinitions, Settings, get_file_hash
+except:
+    from VibeMatch.cache import open_audio
+    from VibeMatch.library import normalize_path
+    from VibeMatch.utilities import Logger, LogLevel, FolderDefinitions, Settings, get_file_hash
+
+
+FingerprintParameters = {"sample_rate": 11025, "n_fft": 1024, "hop_length": 256, "neighbourhood": (21, 21), "max_delta": 63}
+
+
+def get_landmarks(audio):
+    """
+    Finds the landmarks of audio: the strongest local peaks of its spectrogram, each paired with the next few peaks
+    Args:
+        audio: (string|tuple of ndarray and float) an audio file, or mono audio at FingerprintParameters["sample_rate"]
+
+    Returns:
+        (tuple of ndarrays) the int64 landmark hashes, and the frame each landmark starts at
+    """
+    from librosa import stft
+    from scipy.ndimage import maximum_filter
+    sr = FingerprintParameters["sample_rate"]
+    y = open_audio(audio, sample_rate=sr, channels=1).to_mono_float() if isinstance(audio, str) else audio[0]
+    spectrum = stft(y, n_fft=FingerprintParameters["n_fft"], hop_length=FingerprintParameters["hop_length"])
+    magnitude = np.log(np.abs(spectrum) + 1e-6)
+    neighbourhood = FingerprintParameters["neighbourhood"]
+    peaks = maximum_filter(magnitude, size=neighbourhood, mode="constant", cval=-np.inf) == magnitude
+    peaks &= magnitude > np.median(magnitude)
+    frequencies, frames = np.nonzero(peaks)
+    count = int(len(y) / sr * Settings.FingerprintPeaksPerSecond)
+    if len(frames) > count:  # the strongest peaks, which are the likeliest to survive re-encoding
+        strongest = np.argpartition(magnitude[frequencies, frames], -count)[-count:]
+        frequencies, frames = frequencies[strongest], frames[strongest]
+    order = np.lexsort((frequencies, frames))
+    frequencies, frames = frequencies[order].astype(np.int64), frames[order].astype(np.int64)
+    hashes, offsets = [], []
+    for fan in range(1, Settings.FingerprintFanOut + 1):
+        delta = frames[fan:] - frames[:-fan]
+        paired = (delta > 0) & (delta <= FingerprintParameters["max_delta"])
+        hashes.append((frequencies[:-fan][paired] << 16) | (frequencies[fan:][paired] << 6) | delta[paired])
+        offsets.append(frames[:-fan][paired])
+    return np.concatenate(hashes), np.concatenate(offsets)
+
+
+class FingerprintIndex:
+    """
+    An inverted index from landmark hashes to the files, and times in them, the landmarks are found at
+    """
+    _instance = None
+
+    @staticmethod
+    def get_instance():
+        if FingerprintIndex._instance:
+            return FingerprintIndex._instance
+        else:
+            FingerprintIndex._instance = FingerprintIndex()
+            return FingerprintIndex._instance
+
+    def __init__(self, db_file=None):
+        """
+        Args:
+            db_file: (string) the sqlite database file to keep the index in
+        """
+        self.con = sqlite3.connect(db_file if db_file else Settings.FingerprintDatabase, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.create_tables()
+
+    def create_tables(self):
+        """
+        Creates the index tables if they don't exist yet
+        Landmarks are stored without row ids, clustered by hash, so each lookup reads one run of the table
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Create Table if not exists FingerprintFiles (id Integer Primary Key, path Varchar(512) UNIQUE, " +
+                           "hash Varchar(64), landmarks Integer)")
+            cursor.execute("Create Table if not exists Fingerprints (hash Integer, file_id Integer, offset Integer, " +
+                           "Primary Key (hash, file_id, offset)) Without Rowid")
+            self.con.commit()
+
+    def close(self):
+        """
+        Closes the sqlite database connection
+        """
+        self.con.close()
+
+    def get_file(self, file_name):
+        """
+        Args:
+            file_name: (string) the audio file
+
+        Returns:
+            (tuple|None) the id, content hash and landmark count of the file if it's indexed, else None
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Select id, hash, landmarks From FingerprintFiles where path=?", (normalize_path(file_name),))
+            return cursor.fetchone()
+
+    def add(self, file_name, landmarks=None):
+        """
+        Adds a file's landmarks to the index, unless the same contents are already indexed under that path
+        Args:
+            file_name: (string) the audio file
+            landmarks: (tuple of ndarrays) the file's landmarks, if they have already been found
+
+        Returns:
+            (int) how many landmarks the file has
+        """
+        content_hash = get_file_hash(file_name)
+        known = self.get_file(file_name)
+        if known and known[1] == content_hash:
+            return known[2]
+        hashes, offsets = landmarks if landmarks else get_landmarks(file_name)
+        with self.lock:
+            cursor = self.con.cursor()
+            if known:
+                cursor.execute("Delete From Fingerprints where file_id=?", (known[0],))
+            cursor.execute("Insert or Replace into FingerprintFiles (id, path, hash, landmarks) values (?, ?, ?, ?)",
+                           (known[0] if known else None, normalize_path(file_name), content_hash, len(hashes)))
+            file_id = cursor.lastrowid if not known else known[0]
+            cursor.executemany("Insert or Ignore into Fingerprints values (?, ?, ?)",
+                               zip(hashes.tolist(), [file_id] * len(hashes), offsets.tolist()))
+            self.con.commit()
+        return len(hashes)
+
+    def get_indexed_landmarks(self, file_id):
+        """
+        Args:
+            file_id: (int) the id of an indexed file
+
+        Returns:
+            (tuple of ndarrays) the file's landmark hashes, and the frame each starts at
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Select hash, offset From Fingerprints where file_id=?", (file_id,))
+            landmarks = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+        return landmarks[:, 0], landmarks[:, 1]
+
+    def remove(self, file_name):
+        """
+        Removes a file from the index
+        Args:
+            file_name: (string) the audio file
+        """
+        known = self.get_file(file_name)
+        if not known:
+            return
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Delete From Fingerprints where file_id=?", (known[0],))
+            cursor.execute("Delete From FingerprintFiles where id=?", (known[0],))
+            self.con.commit()
+
+    def index_folder(self, folder=None):
+        """
+        Adds every audio file in a folder to the index, recursively, skipping files that haven't changed
+        Args:
+            folder: (string) the folder to index, defaults to the songs folder
+
+        Returns:
+            (int) how many files were indexed
+        """
+        from analyze import find_audio_files
+        file_names = find_audio_files(folder if folder else FolderDefinitions.Songs)
+        indexed = 0
+        for file_name in file_names:
+            try:
+                self.add(file_name)
+                indexed += 1
+            except Exception as e:
+                Logger.write(f"Unable to fingerprint '{file_name}': {e}", LogLevel.Error)
+        return indexed
+
+    def match(self, audio, min_ratio=None):
+        """
+        Finds the indexed files that are the same recording as some audio, even if re-encoded, trimmed or extended
+        A file matches when enough landmarks line up at one time offset, so shared hashes at random times don't count
+        Args:
+            audio: (string|tuple of ndarrays) an audio file, or its landmarks
+            min_ratio: (float) the fraction of the shorter recording's landmarks that must line up,
+                defaults to Settings.FingerprintMatchRatio
+
+        Returns:
+            (list of dicts) the path, score (landmarks lined up), ratio and offset in seconds of each matching file,
+            best first. the audio itself is included if it's indexed
+        """
+        min_ratio = Settings.FingerprintMatchRatio if min_ratio is None else min_ratio
+        hashes, offsets = get_landmarks(audio) if isinstance(audio, str) else audio
+        if not len(hashes):
+            return []
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Create Temp Table if not exists FingerprintQuery (hash Integer, offset Integer)")
+            cursor.execute("Delete From FingerprintQuery")
+            cursor.executemany("Insert into FingerprintQuery values (?, ?)", zip(hashes.tolist(), offsets.tolist()))
+            cursor.execute("Select f.file_id, f.offset - q.offset as delta, count(*) as score From FingerprintQuery q " +
+                           "Join Fingerprints f on f.hash = q.hash Group By f.file_id, delta")
+            alignments = cursor.fetchall()
+            cursor.execute("Select id, path, landmarks From FingerprintFiles")
+            files = {file_id: (path, landmarks) for file_id, path, landmarks in cursor.fetchall()}
+            self.con.commit()  # ends the transaction filling the query table, which would keep other connections from writing
+        counts = {}
+        for file_id, delta, score in alignments:
+            counts.setdefault(file_id, {})[delta] = score
+        best = {}
+        for file_id, deltas in counts.items():  # a trim that isn't a whole frame splits landmarks over two offsets
+            best[file_id] = max((score + deltas.get(delta + 1, 0), delta) for delta, score in deltas.items())
+        frame_seconds = FingerprintParameters["hop_length"] / FingerprintParameters["sample_rate"]
+        matches = []
+        for file_id, (score, delta) in best.items():
+            path, landmarks = files[file_id]
+            ratio = score / max(1, min(landmarks, len(hashes)))
+            if score >= Settings.FingerprintMinScore and ratio >= min_ratio:
+                matches.append({"path": path, "score": score, "ratio": round(ratio, 3), "offset": delta * frame_seconds})
+        return sorted(matches, key=lambda match: match["score"], reverse=True)
+
+    def get_duplicates(self, file_name):
+        """
+        Finds the indexed files that are the same recording as a file, so the file can be skipped
+        The file is only decoded if it isn't indexed already
+        Args:
+            file_name: (string) the audio file
+
+        Returns:
+            (list of strings) the paths of the other matching files, best first
+        """
+        path = normalize_path(file_name)
+        known = self.get_file(file_name)
+        landmarks = self.get_indexed_landmarks(known[0]) if known and known[1] == get_file_hash(file_name) else file_name
+        return [match["path"] for match in self.match(landmarks) if match["path"] != path]
+
+    def get_duplicate(self, file_name):
+        """
+        Args:
+            file_name: (string) the audio file
+
+        Returns:
+            (string|None) the path of the best matching other file, else None
+        """
+        duplicates = self.get_duplicates(file_name)
+        return duplicates[0] if duplicates else None
+
+    def find_duplicates(self):
+        """
+        Groups every indexed file with the other files that are the same recording
+        Groups are joined through any file they share, so an edit that only matches the original still joins its copies
+        Returns:
+            (list of lists of strings) the paths in each group of two or more duplicates
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Select id, path From FingerprintFiles Order By path")
+            files = cursor.fetchall()
+        groups = {path: {path} for _, path in files}
+        for file_id, path in files:
+            for match in self.match(self.get_indexed_landmarks(file_id)):
+                if groups[match["path"]] is not groups[path]:
+                    joined = groups[path] | groups[match["path"]]
+                    for member in joined:
+                        groups[member] = joined
+        unique = {id(group): group for group in groups.values() if len(group) > 1}
+        return sorted(sorted(group) for group in unique.values())
+
+
+if __name__ == "__main__":
+    index = FingerprintIndex.get_instance()
+    index.index_folder(sys.argv[1] if len(sys.argv) > 1 else None)
+    for duplicates in index.find_duplicates():
+        Logger.write(f"Duplicates: {duplicates}")
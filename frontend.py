@@ -1,5 +1,4 @@
 from pathlib import Path
-import time
 try:
     import utilities
     import spotify
@@ -24,8 +23,7 @@ def display_help():
 
 def speed(source, dest, target_bpm):
     source_audio, path = spotify.download_or_open(source)
-    analysis = analyze.load_analysis(path)
-    source_bpm = analyze.get_tempo_and_beat_indices(analysis)[0]
+    source_bpm = analyze.get_tempo_analysis(path, source_audio)["tempo"]
     new_audio = merge.shift_tempo(source_audio, merge.get_bpm_multiplier(source_bpm, target_bpm))
     try:
         os.makedirs(os.path.split(dest)[0], exist_ok=True)
@@ -75,7 +73,7 @@ def find(substring:str):
         name = substring
     else:
         raise Exception("Search string '{substring}' has too many commas, search string should be one of the following formats: name,artist,album or name,artist or name")
-    found = spotify.find_song(song_name=name, artist=artist, album=album)
+    found = spotify.find_song(song_name=name, artist=artist, album=album, first_match=True)
     for f in found:
         print(f"found {f['name']} by {f['artists'][0]['name']}: {f['external_urls']['spotify']}")
 
@@ -84,12 +82,10 @@ def get(id, output=None):
     if not output:
         if ',' in id:
             id, output = id.split(',')
-    d, path = spotify.download_music(id, custom_folder=output)
-    i = 300  # cap at 5 minutes
-    while i > 0 and d.progress_handler.overall_completed_tasks < d.progress_handler.song_count: # .download_tracker.get_song_list():  # TODO: fix this reference
-        print(i)
-        time.sleep(1)
-        i -= 1
+    # download_music returns the moment the last song is done, reporting each song as it finishes
+    d, path = spotify.download_music(id, custom_folder=output, on_result=print)
+    if d:
+        print(d)
     print(f"open: {path}")
     utilities.open_to_file(path)
 
@@ -127,6 +123,8 @@ def main():
         display_help()
     input = None
     output = None
+    if parsed_args.Profile.called:
+        utilities.Settings.AnalysisProfile = utilities.AnalysisProfiles.get(parsed_args.Profile.value)["name"]
     if parsed_args.Input.called:
         input = parsed_args.Input.value
     if parsed_args.Output.called:
@@ -143,6 +141,8 @@ def main():
         cut(input, output, parsed_args.Cut.value)
     if parsed_args.Find.called:
         find(parsed_args.Find.value)
+    if parsed_args.Analyze.called:
+        analyze.analyze_library(parsed_args.Analyze.value)
     if parsed_args.Get.called:
         get(parsed_args.Get.value, output)
     if parsed_args.VibeMatch.called:
@@ -0,0 +1,198 @@
+"""
+This file is responsible for getting new songs all the way into the database
+Each song is analyzed as soon as it finishes downloading, while later songs are still downloading,
+and its spotify audio features are fetched alongside. Bounded queues sit between the stages,
+so when analysis falls behind the downloads wait for it rather than piling up decoded audio
+
+Usage: python ingest.py <playlist/album/artist/track url> [more urls...]
+"""
+
+
+import queue
+import sys
+import threading
+import time
+try:
+    import analyze
+    import spotify
+    from database import FeaturesDatabase
+    from downloads import DownloadScheduler
+    from utilities import Logger, LogLevel, Settings
+except:
+    from VibeMatch import analyze
+    from VibeMatch import spotify
+    from VibeMatch.database import FeaturesDatabase
+    from VibeMatch.downloads import DownloadScheduler
+    from VibeMatch.utilities import Logger, LogLevel, Settings
+
+
+class IngestPipeline:
+    """
+    Analyzes downloaded songs and saves the results, in stages connected by bounded queues
+    Downloads feed the analysis workers, which feed a single database writer, while a features worker batches api requests
+    """
+    def __init__(self, workers=None, queue_size=None, fetch_features=True, custom_folder=None, database=None,
+                 analyze_file=None):
+        """
+        Builds an ingest pipeline, its workers start when it is started or entered
+        Args:
+            workers: (int) how many songs are analyzed at once
+            queue_size: (int) how many songs can wait between stages before the earlier stage blocks
+            fetch_features: (bool) whether or not to get spotify audio features for the songs too
+            custom_folder: (string) a folder other than songs/
+            database: (FeaturesDatabase) the database to save to, defaults to the shared one
+            analyze_file: (function) takes a file name, returns the analysis row. defaults to analyze.analyze_file
+        """
+        self.workers = workers if workers else Settings.IngestWorkers
+        queue_size = queue_size if queue_size else Settings.IngestQueueSize
+        self.custom_folder = custom_folder
+        self.database = database if database else FeaturesDatabase.get_instance()
+        self.analyze_file = analyze_file if analyze_file else analyze.analyze_file
+        self.analysis_queue = queue.Queue(maxsize=queue_size)
+        self.store_queue = queue.Queue(maxsize=queue_size)
+        self.features_queue = queue.Queue(maxsize=queue_size) if fetch_features else None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.counts = {"submitted": 0, "skipped": 0, "analyzed": 0, "failed": 0, "stored": 0, "features": 0}
+        self.start_time = None
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def start(self):
+        """
+        Starts the analysis, database and features workers
+        """
+        self.start_time = time.perf_counter()
+        self.threads = [threading.Thread(target=self.analysis_worker, daemon=True) for _ in range(self.workers)]
+        self.threads.append(threading.Thread(target=self.store_worker, daemon=True))
+        if self.features_queue:
+            self.threads.append(threading.Thread(target=self.features_worker, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, result):
+        """
+        Queues a finished download for analysis, blocking while the analysis queue is full
+        Can be passed straight to a DownloadScheduler as its on_result callback
+        Args:
+            result: (DownloadResult) the finished download
+        """
+        if not result.path:
+            return
+        if self.database.get_analysis_from_file_name(result.path):
+            self.count("skipped")
+            return
+        self.count("submitted")
+        self.analysis_queue.put((result.track_id, result.path))
+        if self.features_queue and result.track_id:
+            self.features_queue.put(result.track_id)
+
+    def analysis_worker(self):
+        """
+        Decodes and analyzes songs until the pipeline is closed
+        """
+        while True:
+            item = self.analysis_queue.get()
+            if item is None:
+                break
+            track_id, file_name = item
+            try:
+                row = self.analyze_file(file_name)
+                row["id"] = track_id
+                self.store_queue.put(row)
+                self.count("analyzed")
+            except Exception as e:
+                self.count("failed")
+                Logger.write(f"Unable to analyze '{file_name}': {e}", LogLevel.Error)
+
+    def get_batch(self, items):
+        """
+        Gets the next batch from a queue, waiting for at least one item but not for a full batch
+        Args:
+            items: (Queue) the queue to take from
+
+        Returns:
+            (tuple of list and bool) the batch, and whether or not the pipeline is closing
+        """
+        batch = [items.get()]
+        while batch[-1] is not None and len(batch) < Settings.IngestBatchSize and not items.empty():
+            batch.append(items.get())
+        closing = batch[-1] is None
+        return (batch[:-1] if closing else batch), closing
+
+    def store_worker(self):
+        """
+        Saves analysis rows to the database in batches until the pipeline is closed
+        """
+        closing = False
+        while not closing:
+            rows, closing = self.get_batch(self.store_queue)
+            if rows:
+                try:
+                    self.count("stored", self.database.save_analysis_to_db(rows))
+                except Exception as e:
+                    Logger.write(f"Unable to save the analysis of {len(rows)} songs: {e}", LogLevel.Error)
+
+    def features_worker(self):
+        """
+        Gets spotify audio features in batches until the pipeline is closed, they are saved to the database as they arrive
+        """
+        closing = False
+        while not closing:
+            track_ids, closing = self.get_batch(self.features_queue)
+            if track_ids:
+                try:
+                    self.count("features", len(spotify.get_multiple_audio_features(track_ids, self.custom_folder)))
+                except Exception as e:
+                    Logger.write(f"Unable to get data for {len(track_ids)} tracks: {e}", LogLevel.Error)
+
+    def close(self):
+        """
+        Waits for every queued song to make it through the pipeline, then stops the workers
+        """
+        for _ in range(self.workers):
+            self.analysis_queue.put(None)
+        for thread in self.threads[:self.workers]:
+            thread.join()
+        self.store_queue.put(None)
+        if self.features_queue:
+            self.features_queue.put(None)
+        for thread in self.threads[self.workers:]:
+            thread.join()
+        Logger.write(str(self))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __str__(self):
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0
+        return (f"Ingested {self.counts['stored']}/{self.counts['submitted']} songs ({self.counts['failed']} failed, "
+                f"{self.counts['skipped']} already analyzed, {self.counts['features']} with features) "
+                f"in {elapsed:.1f} seconds")
+
+
+def ingest(sources, custom_folder=None, threads=None, workers=None):
+    """
+    Downloads, analyzes and saves every song from the sources given, analyzing each song as soon as it is downloaded
+    Args:
+        sources: (any) one or more playlist, album, artist or track urls, track uris, or track data from spotify
+        custom_folder: (string) a folder other than songs/
+        threads: (int) the most songs downloaded at once
+        workers: (int) the most songs analyzed at once
+
+    Returns:
+        (IngestPipeline) the finished pipeline, with counts of what happened to the songs
+    """
+    with IngestPipeline(workers=workers, custom_folder=custom_folder) as pipeline:
+        DownloadScheduler(threads=threads, custom_folder=custom_folder, on_result=pipeline.submit).run(sources)
+    return pipeline
+
+
+if __name__ == "__main__":
+    ingest(sys.argv[1:])
@@ -0,0 +1,220 @@
+"""
+This file is responsible for keeping track of which songs have already been downloaded
+The library manifest maps spotify track ids to local files, along with each file's size, modification time and content hash
+It is built with one scan of the songs folder, stored in sqlite so unchanged files aren't hashed again,
+and updated after every download, so checking whether a track is already downloaded doesn't touch the disk
+"""
+
+
+import os
+import sqlite3
+import threading
+try:
+    from utilities import Logger, LogLevel, FolderDefinitions, FileFormats, Settings, get_file_hash, get_song_path
+except:
+    from VibeMatch.utilities import Logger, LogLevel, FolderDefinitions, FileFormats, Settings, get_file_hash, get_song_path
+
+
+AudioExtensions = (f".{FileFormats.M4a}", f".{FileFormats.Mp3}", f".{FileFormats.Mp4}", f".{FileFormats.Wav}")
+
+
+def normalize_path(path):
+    """
+    Normalizes a file path so that different spellings of the same file compare equal
+    Args:
+        path: (string) a relative or absolute file path
+
+    Returns:
+        (string) the normalized absolute path
+    """
+    return os.path.normcase(os.path.abspath(path))
+
+
+class LibraryManifest:
+    """
+    An index of the local song files, and which spotify tracks they are
+    """
+    _instance = None
+
+    @staticmethod
+    def get_instance():
+        if LibraryManifest._instance:
+            return LibraryManifest._instance
+        else:
+            LibraryManifest._instance = LibraryManifest()
+            return LibraryManifest._instance
+
+    def __init__(self, db_file=None, hash_files=True):
+        """
+        Builds a library manifest, folders are scanned the first time they are needed
+        Args:
+            db_file: (string) the sqlite database file to keep the manifest in
+            hash_files: (bool) whether or not to compute content hashes while scanning
+        """
+        self.con = sqlite3.connect(db_file if db_file else Settings.LibraryDatabase, check_same_thread=False)
+        self.hash_files = hash_files
+        self.lock = threading.RLock()
+        self.files = {}  # normalized path: (size, mtime, hash)
+        self.tracks = {}  # track id: normalized path
+        self.scanned = set()
+        self.create_tables()
+        self.load()
+
+    def create_tables(self):
+        """
+        Creates the manifest tables if they don't exist yet
+        """
+        cursor = self.con.cursor()
+        cursor.execute("Create Table if not exists LibraryFiles (path Varchar(512) UNIQUE, size Integer, mtime Real, " +
+                       "hash Varchar(64))")
+        cursor.execute("Create Table if not exists LibraryTracks (id Varchar(32) UNIQUE, path Varchar(512))")
+        self.con.commit()
+
+    def load(self):
+        """
+        Loads the stored manifest into memory
+        """
+        with self.lock:
+            cursor = self.con.cursor()
+            cursor.execute("Select path, size, mtime, hash From LibraryFiles")
+            self.files = {path: (size, mtime, file_hash) for path, size, mtime, file_hash in cursor.fetchall()}
+            cursor.execute("Select id, path From LibraryTracks")
+            self.tracks = dict(cursor.fetchall())
+
+    def close(self):
+        """
+        Closes the sqlite database connection
+        """
+        self.con.close()
+
+    def scan(self, folder=None):
+        """
+        Scans a folder recursively, adding new or changed files and dropping deleted ones
+        Only files whose size or modification time changed are hashed again
+        Args:
+            folder: (string) the folder to scan, defaults to the songs folder
+
+        Returns:
+            (int) how many files are in the folder
+        """
+        folder = folder if folder else FolderDefinitions.Songs
+        root = normalize_path(folder)
+        found = {}
+        for dir_path, _, file_names in os.walk(folder):
+            for file_name in file_names:
+                if not file_name.lower().endswith(AudioExtensions):
+                    continue
+                path = normalize_path(os.path.join(dir_path, file_name))
+                stat = os.stat(path)
+                known = self.files.get(path)
+                if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+                    found[path] = known
+                else:
+                    found[path] = (stat.st_size, stat.st_mtime, get_file_hash(path) if self.hash_files else None)
+        with self.lock:
+            removed = [path for path in self.files if path.startswith(root + os.sep) and path not in found]
+            for path in removed:
+                del self.files[path]
+            self.files.update(found)
+            cursor = self.con.cursor()
+            cursor.executemany("Delete From LibraryFiles where path=?", [(path,) for path in removed])
+            cursor.executemany("Insert or Replace into LibraryFiles values (?, ?, ?, ?)",
+                               [(path,) + values for path, values in found.items()])
+            self.con.commit()
+            self.scanned.add(root)
+        self.link_features()
+        Logger.write(f"Library manifest has {len(found)} files in '{folder}' ({len(removed)} removed)", LogLevel.Debug)
+        return len(found)
+
+    def ensure_scanned(self, folder=None):
+        """
+        Scans a folder if it, or a folder containing it, hasn't been scanned yet
+        Args:
+            folder: (string) the folder, defaults to the songs folder
+        """
+        root = normalize_path(folder if folder else FolderDefinitions.Songs)
+        if not any(root == scanned or root.startswith(scanned + os.sep) for scanned in self.scanned):
+            self.scan(folder)
+
+    def link_features(self):
+        """
+        Links track ids to files using the file names already saved with audio features
+        """
+        try:
+            cursor = self.con.cursor()
+            cursor.execute("Select id, file_name From Features where file_name != ''")
+            rows = cursor.fetchall()
+        except sqlite3.OperationalError:  # no features saved yet
+            return
+        with self.lock:
+            links = [(tid, normalize_path(file_name)) for tid, file_name in rows
+                     if tid not in self.tracks and normalize_path(file_name) in self.files]
+            self._link(links)
+
+    def _link(self, links):
+        with self.lock:
+            self.tracks.update(links)
+            self.con.cursor().executemany("Insert or Replace into LibraryTracks values (?, ?)", links)
+            self.con.commit()
+
+    def add(self, track_id, path):
+        """
+        Records a downloaded file, e.g. straight after it finished downloading
+        Args:
+            track_id: (string) the track uri
+            path: (string) the file path of the song
+        """
+        path = normalize_path(path)
+        if not os.path.exists(path):
+            return
+        stat = os.stat(path)
+        values = (stat.st_size, stat.st_mtime, get_file_hash(path) if self.hash_files else None)
+        with self.lock:
+            self.files[path] = values
+            self.con.cursor().execute("Insert or Replace into LibraryFiles values (?, ?, ?, ?)", (path,) + values)
+            self._link([(track_id, path)] if track_id else [])
+
+    def get_path(self, track):
+        """
+        Gets the local file of a track if it has been downloaded
+        Args:
+            track: (string|dict) a track uri, or the track data from spotify
+
+        Returns:
+            (string|None) the file path, or None if it hasn't been downloaded
+        """
+        track_id = track if isinstance(track, str) else track.get("id")
+        path = self.tracks.get(track_id)
+        if path and path in self.files:
+            return path
+        return None
+
+    def has_track(self, track, custom_folder=None):
+        """
+        Checks if a track has already been downloaded
+        Args:
+            track: (string|dict) a track uri, or the track data from spotify
+            custom_folder: (string) the folder the track would have been downloaded to, other than songs/
+
+        Returns:
+            (bool) whether or not a local file exists for the track
+        """
+        if self.get_path(track):
+            return True
+        if isinstance(track, dict) and track.get("artists") and track.get("name"):
+            path = normalize_path(get_song_path(track, custom_folder))
+            if path in self.files:
+                self._link([(track["id"], path)])
+                return True
+        return False
+
+    def get_file_info(self, path):
+        """
+        Gets the stored size, modification time and content hash of a file
+        Args:
+            path: (string) the file path
+
+        Returns:
+            (tuple|None) the size, mtime and hash, or None if the file isn't in the manifest
+        """
+        return self.files.get(normalize_path(path))
@@ -28,34 +28,48 @@ from pydub import AudioSegment, effects
 try:
     from utilities import LogLevel, Logger, FileFormats, TimeSegments, get_bpm_multiplier, play, FolderDefinitions
     from spotify import get_track_audio_features
+    from cache import open_audio
+    from decode import probe_audio
+    import analyze
 except:
     from VibeMatch.utilities import LogLevel, Logger, FileFormats, TimeSegments, get_bpm_multiplier, play, FolderDefinitions
     from VibeMatch.spotify import get_audio_features
+    from VibeMatch.cache import open_audio
+    from VibeMatch.decode import probe_audio
+    from VibeMatch import analyze
 
 
 def get_beginning(audio_segment, ms):
     """
     Gets the first specified amount of milliseconds of audio
+    Given a file name, only those milliseconds are decoded, unless the whole song is already in the decoded audio cache
     Args:
-        audio_segment: (AudioSegment) the audio to split
+        audio_segment: (AudioSegment|string) the audio to split, or its file name
         ms: (int) the millisecond position to split on
 
     Returns:
         (AudioSegment) the audio chunk
     """
+    if isinstance(audio_segment, str):
+        return open_audio(audio_segment, duration=ms / TimeSegments.Second).to_audio_segment()
     return audio_segment[:ms]
 
 
 def get_end(audio_segment, ms):
     """
-    Gets the last specified amount of milliseconds of audio
+    Gets the audio from a millisecond position to the end, or the last milliseconds of audio if the position is negative
+    Given a file name, ffmpeg seeks to the position so nothing before it is decoded
     Args:
-        audio_segment: (AudioSegment) the audio to split
-        ms: (int) the millisecond position to split on
+        audio_segment: (AudioSegment|string) the audio to split, or its file name
+        ms: (int) the millisecond position to split on, negative to count back from the end
 
     Returns:
         (AudioSegment) the audio chunk
     """
+    if isinstance(audio_segment, str):
+        info = probe_audio(audio_segment)
+        offset = ms / TimeSegments.Second if ms >= 0 else max(0.0, info.duration + ms / TimeSegments.Second)
+        return open_audio(audio_segment, info, offset=offset).to_audio_segment()
     return audio_segment[ms:]
 
 
@@ -121,6 +135,58 @@ def match_beat(source: AudioSegment, source_file: str, target_file: str):
     return shift_tempo(source, get_bpm_multiplier(source_bpm, target_bpm))
 
 
+def snap_to_grid(file_name, position, bars=None):
+    """
+    Moves a position to the nearest downbeat, or phrase start, of a song's cached beat grid
+    Args:
+        file_name: (string) the file name of the audio
+        position: (int) the position in milliseconds
+        bars: (int) the phrase length in bars to snap to a phrase start of, None to snap to any downbeat
+
+    Returns:
+        (int) the snapped position in milliseconds, the position itself if the song has no bars
+    """
+    grid = analyze.get_beat_grid(file_name)
+    t = position / TimeSegments.Second
+    seconds = grid.nearest_phrase(t, bars) if bars else grid.nearest_downbeat(t)
+    return int(round(seconds * TimeSegments.Second)) if seconds is not None else position
+
+
+def cut_on_beat(audio_segment: AudioSegment, file_name: str, position, bars=None):
+    """
+    Splits audio on the downbeat, or phrase start, nearest to a position, so both halves keep whole bars
+    Args:
+        audio_segment: (AudioSegment) the audio to split
+        file_name: (string) the file name of the audio, used to look up its beat grid
+        position: (int) roughly where to split in milliseconds
+        bars: (int) the phrase length in bars to split at a phrase start of, None to split at any downbeat
+
+    Returns:
+        (tuple of AudioSegments) the audio before and after the split
+    """
+    return split_audio(audio_segment, snap_to_grid(file_name, position, bars))
+
+
+def loop_bars(audio_segment: AudioSegment, file_name: str, position, bars=4, repeats=2):
+    """
+    Repeats whole bars of audio, starting from the downbeat nearest to a position, so the loop stays on the beat
+    Args:
+        audio_segment: (AudioSegment) the audio to loop
+        file_name: (string) the file name of the audio, used to look up its beat grid
+        position: (int) roughly where the loop starts in milliseconds
+        bars: (int) how many bars to loop
+        repeats: (int) how many times to play the bars
+
+    Returns:
+        (AudioSegment) the looped bars
+    """
+    grid = analyze.get_beat_grid(file_name)
+    assert len(grid.downbeats), f"'{file_name}' has no bars to loop"
+    start, end = grid.get_bar_times(analyze.BeatGrid.get_nearest(grid.downbeat_times, position / TimeSegments.Second), bars)
+    section = get_audio_section(audio_segment, int(round(start * TimeSegments.Second)), int(round(end * TimeSegments.Second)))
+    return section * repeats
+
+
 def export(audio: AudioSegment, out_file):
     """
     Exports an audio file to a given file name
@@ -154,8 +220,8 @@ def overlay(file1, file2, new_name=None, position=0, gain=0.0):
     Returns:
         (string) the name of the file created
     """
-    sound1 = AudioSegment.from_file(file1)
-    sound2 = AudioSegment.from_file(file2)
+    sound1 = open_audio(file1).to_audio_segment()
+    sound2 = open_audio(file2).to_audio_segment()
     blank_audio = AudioSegment.silent(len(sound2) + len(sound1) - position, sound1.frame_rate)
     sound1 = sound1 + blank_audio  # add blank audio to the first sound, which will then be overlaid with the new audio
     combined = sound1.overlay(sound2, gain_during_overlay=gain, position=position)
@@ -174,12 +240,78 @@ def crossfade(file1, file2, new_name=None, fade=0):
     Returns:
         (string) the name of the file created
     """
-    sound1 = AudioSegment.from_file(file1)
-    sound2 = AudioSegment.from_file(file2)
+    sound1 = open_audio(file1).to_audio_segment()
+    sound2 = open_audio(file2).to_audio_segment()
     combined = sound1.append(sound2, crossfade=fade)
     return export(combined, os.path.join(os.path.split(file1)[0], new_name))
 
 
+def plan_transition(source_file, target_file):
+    """
+    Plans a transition between two songs from their drops, so the target's first drop lands where the source runs out
+    The source is played out from its last breakdown after its last drop, or its outro if it has none,
+    and the target starts early enough that its first drop, or the end of its intro, comes as the source ends
+    Args:
+        source_file: (string) the file being mixed out of
+        target_file: (string) the file being mixed into
+
+    Returns:
+        (dict) position (int) ms into the source to start the target, target_start (int) ms into the target to start from,
+        fade (int) ms the two overlap, target_drop (int) ms into the target of its drop, speed (float) the multiplier
+        to match the source's tempo to the target's, and confidence (float) how sure the drops are, from 0 to 1
+    """
+    source = analyze.get_tempo_analysis(source_file)
+    target = analyze.get_tempo_analysis(target_file)
+    source_events, target_events = analyze.find_drops(source_file), analyze.find_drops(target_file)  # on the cached grids
+    source_duration = int(round(float(source["duration"]) * TimeSegments.Second))
+
+    drops = [event for event in source_events if event["type"] == "drop"]
+    breakdowns = [event for event in source_events
+                  if event["type"] == "breakdown" and (not drops or event["ms"] > drops[-1]["ms"])]
+    source_out = breakdowns[-1] if breakdowns else None
+    source_out_ms = source_out["ms"] if source_out else analyze.find_sections(source_file)["outro_ms"]
+    target_drop = next((event for event in target_events if event["type"] == "drop"), None)
+    target_drop_ms = target_drop["ms"] if target_drop else analyze.find_sections(target_file)["intro_ms"]
+
+    remaining = source_duration - source_out_ms
+    target_start = max(0, target_drop_ms - remaining)
+    if target_start:  # start the target on the next bar, so it comes in on the beat
+        downbeat = analyze.get_beat_grid(target_file).next_downbeat(target_start / TimeSegments.Second)
+        if downbeat is not None and downbeat * TimeSegments.Second <= target_drop_ms:
+            target_start = int(round(downbeat * TimeSegments.Second))
+    fade = target_drop_ms - target_start
+    confidences = [event["confidence"] for event in (source_out, target_drop) if event]
+    return {"position": source_duration - fade, "target_start": target_start, "fade": fade, "target_drop": target_drop_ms,
+            "speed": get_bpm_multiplier(float(source["tempo"]), float(target["tempo"])),
+            "confidence": round(sum(confidences) / 2, 3)}
+
+
+def transition(file1, file2, new_name=None):
+    """
+    Mixes one song into another as planned by plan_transition, matching the first song's tempo to the second's
+    Args:
+        file1: (string) the file being mixed out of
+        file2: (string) the file being mixed into
+        new_name: (string) the new file name
+
+    Returns:
+        (string) the name of the file created
+    """
+    plan = plan_transition(file1, file2)
+    Logger.write(f"Mixing '{file1}' into '{file2}' at {plan['position']}ms (confidence {plan['confidence']})")
+    sound1 = open_audio(file1).to_audio_segment()
+    sound2 = open_audio(file2).to_audio_segment()[plan["target_start"]:]
+    if abs(plan["speed"] - 1) > 0.01:
+        position, fade = int(plan["position"] / plan["speed"]), int(plan["fade"] / plan["speed"])
+        sound1 = shift_tempo(sound1, plan["speed"])
+    else:
+        position, fade = plan["position"], plan["fade"]
+    fade = max(0, min(fade, len(sound1) - position, len(sound2)))
+    combined = sound1[:position + fade].append(sound2, crossfade=fade) if fade > 0 else sound1[:position] + sound2
+    out_file = os.path.join(os.path.split(file1)[0], new_name if new_name else "transition." + FileFormats.Default)
+    return export(combined, out_file)
+
+
 if __name__ == "__main__":
     import spotify, database
     # in1 = f"{FolderDefinitions.Songs}/merged.mp4"
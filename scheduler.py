@@ -0,0 +1,357 @@
+"""
+This file is responsible for scheduling requests to the spotify rest api
+Every request goes through a single scheduler, which keeps the request rate under the api's limit across threads,
+waits for as long as the api asks when throttled, and retries transient failures with a jittered backoff
+
+The scheduler also keeps metrics on how much time was spent throttled, how many retries were needed,
+and what fraction of requests succeeded
+"""
+
+
+import random
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+try:
+    from utilities import Logger, LogLevel, Settings
+except:
+    from VibeMatch.utilities import Logger, LogLevel, Settings
+
+
+class RequestError(Exception):
+    """
+    Raised when a request could not be completed, even after retrying
+    """
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket, used to keep a sustained request rate while still allowing short bursts
+    """
+    def __init__(self, rate, capacity):
+        """
+        Builds a token bucket
+        Args:
+            rate: (float) how many tokens are added per second, i.e. the sustained request rate
+            capacity: (int) the maximum amount of tokens that can be saved up, i.e. the largest burst
+        """
+        assert rate > 0, f"Token bucket rate must be positive, got {rate}"
+        assert capacity >= 1, f"Token bucket capacity must be at least 1, got {capacity}"
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        """
+        Adds the tokens earned since the last update. Must be called while holding the lock
+        Args:
+            now: (float) the current monotonic time
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Takes a token from the bucket, waiting until one is available
+
+        Returns:
+            (float) how many seconds were spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """
+        Stops handing out tokens for a given amount of time, e.g. when the api asks us to back off
+        Args:
+            seconds: (float) how long to pause for
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0.0
+            self.updated = max(now, self.paused_until)
+
+    def set_rate(self, rate):
+        """
+        Changes the sustained rate of the bucket
+        Args:
+            rate: (float) the new amount of tokens added per second
+        """
+        with self.lock:
+            self._refill(max(time.monotonic(), self.updated))
+            self.rate = float(rate)
+
+
+class RequestMetrics:
+    """
+    Counters describing how the scheduler has been performing
+    """
+    def __init__(self):
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.throttled = 0
+        self.throttle_time = 0.0
+        self.wait_time = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        """
+        Increments the given counters
+        Args:
+            **counts: (int|float) the amount to add, keyed by counter name e.g. retries=1
+        """
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def success_rate(self):
+        """
+        Returns:
+            (float) the fraction of finished requests that succeeded, 1.0 if nothing has been requested yet
+        """
+        finished = self.successes + self.failures
+        return self.successes / finished if finished else 1.0
+
+    def as_dict(self):
+        """
+        Returns:
+            (dict) the metrics as a plain dictionary
+        """
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "throttle_time": round(self.throttle_time, 3),
+            "wait_time": round(self.wait_time, 3),
+            "success_rate": round(self.success_rate, 4),
+        }
+
+    def __str__(self):
+        return f"{self.requests} requests, {self.success_rate * 100:.1f}% succeeded, {self.retries} retries, " + \
+               f"{self.throttled} throttled ({self.throttle_time:.1f}s), {self.wait_time:.1f}s waiting on the rate limit"
+
+
+class RequestScheduler:
+    """
+    Central scheduler for http requests to the spotify api
+    """
+    _instance = None
+    RetryStatuses = {500, 502, 503, 504}
+    ThrottleStatus = 429
+
+    @staticmethod
+    def get_instance():
+        if RequestScheduler._instance:
+            return RequestScheduler._instance
+        else:
+            RequestScheduler._instance = RequestScheduler()
+            return RequestScheduler._instance
+
+    def __init__(self, rate=None, burst=None, max_retries=None, endpoint_concurrency=None, endpoint_limits=None,
+                 timeout=None, session=None):
+        """
+        Builds a request scheduler
+        Args:
+            rate: (float) the sustained requests per second allowed
+            burst: (int) how many requests can be sent at once before the rate applies
+            max_retries: (int) how many times a request is retried before giving up
+            endpoint_concurrency: (int) the default maximum of in-flight requests per endpoint
+            endpoint_limits: (dict) endpoint name to maximum in-flight requests, overriding the default
+            timeout: (float) seconds to wait on a single response
+            session: (requests.Session) the session to send requests with, mainly for connection reuse
+        """
+        self.max_rate = float(rate if rate else Settings.RequestsPerSecond)
+        self.bucket = TokenBucket(self.max_rate, burst if burst else Settings.RequestBurst)
+        self.max_retries = Settings.RequestRetries if max_retries is None else max_retries
+        self.endpoint_concurrency = endpoint_concurrency if endpoint_concurrency else Settings.EndpointConcurrency
+        self.endpoint_limits = dict(endpoint_limits) if endpoint_limits else {}
+        self.timeout = timeout if timeout else Settings.RequestTimeout
+        self.session = session if session else requests.Session()
+        self.metrics = RequestMetrics()
+        self.endpoint_metrics = {}
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_endpoint(url):
+        """
+        Gets the endpoint name used for concurrency caps and metrics
+        Args:
+            url: (string) the full request url e.g. https://api.spotify.com/v1/audio-features/651YhrvzeVfOa8yIifIhUM
+
+        Returns:
+            (string) the endpoint name e.g. audio-features
+        """
+        parts = [part for part in urlparse(url).path.split('/') if part]
+        if parts and parts[0] == "v1":
+            parts = parts[1:]
+        return parts[0] if parts else ""
+
+    @staticmethod
+    def get_retry_after(response, default=1.0):
+        """
+        Reads how long the api asked us to wait from a response
+        Args:
+            response: (requests.Response) a throttled response
+            default: (float) seconds to wait if the header is missing or unreadable
+
+        Returns:
+            (float) seconds to wait before sending another request
+        """
+        value = response.headers.get("Retry-After") if response is not None else None
+        try:
+            return max(float(value), 0.0)
+        except (TypeError, ValueError):
+            return default
+
+    def get_backoff(self, attempt):
+        """
+        Gets a jittered exponential backoff delay
+        Args:
+            attempt: (int) the attempt that failed, starting at 0
+
+        Returns:
+            (float) seconds to wait before retrying
+        """
+        ceiling = min(Settings.RequestMaxBackoff, Settings.RequestBackoff * (2 ** attempt))
+        return random.uniform(ceiling / 2, ceiling)
+
+    def _get_semaphore(self, endpoint):
+        with self.lock:
+            if endpoint not in self.semaphores:
+                limit = self.endpoint_limits.get(endpoint, self.endpoint_concurrency)
+                self.semaphores[endpoint] = threading.BoundedSemaphore(limit)
+                self.endpoint_metrics[endpoint] = RequestMetrics()
+            return self.semaphores[endpoint]
+
+    def _throttled(self, endpoint, response):
+        """
+        Backs the whole scheduler off after a 429, and lowers the sustained rate a little so it settles under the limit
+        """
+        delay = self.get_retry_after(response)
+        self.bucket.pause(delay)
+        self.bucket.set_rate(max(self.bucket.rate * Settings.RequestRateDecrease, self.max_rate / 10))
+        self.metrics.add(throttled=1, throttle_time=delay)
+        self.endpoint_metrics[endpoint].add(throttled=1, throttle_time=delay)
+        Logger.write(f"Throttled on '{endpoint}', waiting {delay:.1f}s, rate is now {self.bucket.rate:.2f}/s", LogLevel.Debug)
+
+    def _succeeded(self, endpoint):
+        """
+        Slowly raises the sustained rate back up towards the configured maximum after a success
+        """
+        if self.bucket.rate < self.max_rate:
+            self.bucket.set_rate(min(self.max_rate, self.bucket.rate + Settings.RequestRateIncrease))
+        self.metrics.add(successes=1)
+        self.endpoint_metrics[endpoint].add(successes=1)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request, waiting on the rate limit and retrying throttled or failed requests
+        Args:
+            method: (string) the http method e.g. GET
+            url: (string) the url to request
+            **kwargs: (any) passed through to requests, e.g. params, headers, data
+
+        Returns:
+            (requests.Response) the successful response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = self.get_endpoint(url)
+        semaphore = self._get_semaphore(endpoint)
+        endpoint_metrics = self.endpoint_metrics[endpoint]
+        attempt = 0
+        while True:
+            waited = self.bucket.acquire()
+            self.metrics.add(requests=1, wait_time=waited)
+            endpoint_metrics.add(requests=1, wait_time=waited)
+            response = None
+            error = None
+            with semaphore:
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as connection_error:
+                    error = connection_error
+            if response is not None and response.ok:
+                self._succeeded(endpoint)
+                return response
+            if response is not None and response.status_code == RequestScheduler.ThrottleStatus:
+                self._throttled(endpoint, response)
+                retry = True
+            else:
+                retry = error is not None or response.status_code in RequestScheduler.RetryStatuses
+            if not retry or attempt >= self.max_retries:
+                self.metrics.add(failures=1)
+                endpoint_metrics.add(failures=1)
+                reason = error if error is not None else f"{response.status_code} {response.text[:200]}"
+                raise RequestError(f"{method} {url} failed after {attempt + 1} attempts: {reason}", response)
+            attempt += 1
+            self.metrics.add(retries=1)
+            endpoint_metrics.add(retries=1)
+            if response is None or response.status_code != RequestScheduler.ThrottleStatus:
+                delay = self.get_backoff(attempt - 1)
+                reason = error if error else response.status_code
+                Logger.write(f"Retrying '{endpoint}' in {delay:.2f}s: {reason}", LogLevel.Debug)
+                time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        """
+        Sends a GET request through the scheduler
+        Args:
+            url: (string) the url to request
+            **kwargs: (any) passed through to requests, e.g. params, headers
+
+        Returns:
+            (requests.Response) the successful response
+        """
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        """
+        Sends a POST request through the scheduler
+        Args:
+            url: (string) the url to request
+            data: (dict) the form data to send
+            **kwargs: (any) passed through to requests, e.g. headers
+
+        Returns:
+            (requests.Response) the successful response
+        """
+        return self.request("POST", url, data=data, **kwargs)
+
+    def get_metrics(self, endpoint=None):
+        """
+        Gets the metrics for the whole scheduler or a single endpoint
+        Args:
+            endpoint: (string) the optional endpoint name e.g. search
+
+        Returns:
+            (RequestMetrics) the metrics object
+        """
+        if endpoint:
+            return self.endpoint_metrics.get(endpoint, RequestMetrics())
+        return self.metrics
@@ -14,26 +14,34 @@ Dependencies:
 Environment Variables:
     - CLIENT_ID: Spotify API client ID
     - CLIENT_SECRET: Spotify API client secret
+    - SPOTIFY_API_URL: (optional) a different api server to use, e.g. the local stand-in from standin.py
 """
 
 
-import math
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import os
 from pathlib import Path
 from pydub import AudioSegment
-import requests
+import threading
 import time
 try:
     from database import FeaturesDatabase
+    from scheduler import RequestScheduler
+    from crawler import CrawlOrder, LibraryCrawler
+    from cache import open_audio
+    from library import LibraryManifest
     from utilities import Logger, LogLevel, MixingSimilarityThresholds, Settings, SimilarityMaxValues, \
-        SimilarityMinValues, FolderDefinitions, get_song_path, get_path_template, FileFormats
+        SimilarityMinValues, FolderDefinitions, get_song_path
 except:
     from VibeMatch.database import FeaturesDatabase
+    from VibeMatch.scheduler import RequestScheduler
+    from VibeMatch.crawler import CrawlOrder, LibraryCrawler
+    from VibeMatch.cache import open_audio
+    from VibeMatch.library import LibraryManifest
     from VibeMatch.utilities import Logger, LogLevel, MixingSimilarityThresholds, Settings, SimilarityMaxValues, \
-        SimilarityMinValues, FolderDefinitions, get_song_path, get_path_template, FileFormats
-from spotdl.download.downloader import Downloader, DownloaderError
-from spotdl.console.download import download
-from spotdl.types.options import DownloaderOptions
+        SimilarityMinValues, FolderDefinitions, get_song_path
+from spotdl.download.downloader import DownloaderError
 from spotdl.utils.spotify import SpotifyClient, SpotifyError
 
 assert os.path.exists(".env"), "Please create a '.env' file with CLIENT_ID='your spotify api id'\nCLIENT_SECRET='your spotify api key' to use spotify functionality"
@@ -43,6 +51,27 @@ AUTH_URL = 'https://accounts.spotify.com/api/token'
 BASE_URL = 'https://api.spotify.com/v1/'
 
 
+class MaxIdsPerRequest:
+    """
+    The most ids the api accepts in a single batched request
+    """
+    AudioFeatures = 100
+    Tracks = 50
+
+
+class PageLimits:
+    """
+    The largest page size each paginated endpoint allows
+    """
+    AlbumTracks = 50
+    ArtistAlbums = 50
+    PlaylistTracks = 100
+    Search = 50
+
+
+MaxSearchOffset = 1000  # the api doesn't return search results past this offset
+
+
 class SpotifyClientWrapper:
     _instance = None
 
@@ -55,24 +84,87 @@ class SpotifyClientWrapper:
             return SpotifyClientWrapper._instance
 
 
-def get_access_token(client_id, secret):
+class AccessToken:
     """
-    Gets a spotify authorization token using id and secret token
+    Caches the api authorization token until shortly before it expires, so a new one isn't requested for every call
+    """
+    _token = None
+    _expires = 0
+    _lock = threading.Lock()
+    ExpiryMargin = 60  # seconds before expiry to request a new token
+
+    @staticmethod
+    def get():
+        """
+        Gets a valid api authorization token, requesting a new one if needed
+        Returns:
+            (string) the api authorization token
+        """
+        with AccessToken._lock:
+            if not AccessToken._token or time.monotonic() >= AccessToken._expires:
+                auth_response_data = request_access_token(CLIENT_ID, CLIENT_SECRET)
+                AccessToken._token = auth_response_data['access_token']
+                expires_in = auth_response_data.get('expires_in', 3600)
+                AccessToken._expires = time.monotonic() + max(expires_in - AccessToken.ExpiryMargin, 0)
+            return AccessToken._token
+
+    @staticmethod
+    def clear():
+        """
+        Forgets the cached token, e.g. after switching credentials or api servers
+        """
+        with AccessToken._lock:
+            AccessToken._token = None
+            AccessToken._expires = 0
+
+
+def request_access_token(client_id, secret):
+    """
+    Requests a new spotify authorization token using id and secret token
     Args:
         client_id: (string) the spotify account's user name
         secret: (string) the spotify account's auth token
 
     Returns:
-        (string) the api authorization token
+        (dict) the token response data, containing access_token and expires_in
     """
-    auth_response = requests.post(AUTH_URL, {
+    auth_response = RequestScheduler.get_instance().post(AUTH_URL, {
         'grant_type': 'client_credentials',
         'client_id': client_id,
         'client_secret': secret,
     })
+    return auth_response.json()
+
 
-    auth_response_data = auth_response.json()
-    return auth_response_data['access_token']
+def set_api_url(api_url=None):
+    """
+    Points all api requests at a different server, e.g. the local stand-in from standin.py
+    Args:
+        api_url: (string) the root url of the server e.g. http://127.0.0.1:8080, or None for the real spotify api
+    """
+    global AUTH_URL, BASE_URL
+    if api_url:
+        api_url = api_url.rstrip('/')
+        AUTH_URL = f"{api_url}/api/token"
+        BASE_URL = f"{api_url}/v1/"
+    else:
+        AUTH_URL = 'https://accounts.spotify.com/api/token'
+        BASE_URL = 'https://api.spotify.com/v1/'
+    AccessToken.clear()
+    search_exact_memoized.cache_clear()
+
+
+def get_access_token(client_id, secret):
+    """
+    Gets a spotify authorization token using id and secret token
+    Args:
+        client_id: (string) the spotify account's user name
+        secret: (string) the spotify account's auth token
+
+    Returns:
+        (string) the api authorization token
+    """
+    return request_access_token(client_id, secret)['access_token']
 
 
 def build_access_headers():
@@ -81,7 +173,7 @@ def build_access_headers():
     Returns:
         (dict) the header dict containing the authorization data
     """
-    access_token = get_access_token(CLIENT_ID, CLIENT_SECRET)
+    access_token = AccessToken.get()
     headers = {
         'Authorization': 'Bearer {token}'.format(token=access_token)
     }
@@ -99,7 +191,7 @@ def get_track_audio_features(track_id, custom_folder=None):
         (dict) the json data of a track
     """
     assert isinstance(track_id, str) and len(track_id) == 22, f"Track id {track_id} is not the correct form"
-    r = requests.get(f"{BASE_URL}audio-features/{track_id}", headers=build_access_headers())
+    r = RequestScheduler.get_instance().get(f"{BASE_URL}audio-features/{track_id}", headers=build_access_headers())
     features = r.json()
     info = get_track_info(track_id)
     features["file_name"] = get_song_path(info, custom_folder)
@@ -110,20 +202,30 @@ def get_track_audio_features(track_id, custom_folder=None):
 
 def get_multiple_audio_features(track_ids, custom_folder=None):
     """
-    Gets audio feature data such as bpm, key, etc
+    Gets audio feature data such as bpm, key, etc for many tracks, batching the requests
+    Track info for the file names is also fetched in batches rather than per track
 
     Args:
-        track_ids (_type_): _description_
-        custom_folder (_type_, optional): _description_. Defaults to None.
+        track_ids: (list of strings) the track uris
+        custom_folder: (string) a folder other than songs/
+
+    Returns:
+        (list of dicts) the audio features of the tracks that have them
     """
     assert isinstance(track_ids, list), f"Track id list '{track_ids}' is not the correct form"
-    r = requests.get(f"{BASE_URL}audio-features/{','.join(track_ids)}", headers=build_access_headers())
-    features = r.json()
-    for feature in features["audio_features"]:
-        info = get_track_info(feature["id"])
-        feature["file_name"] = get_song_path(info, custom_folder)
+    features = []
+    for i in range(0, len(track_ids), MaxIdsPerRequest.AudioFeatures):
+        batch = track_ids[i:i + MaxIdsPerRequest.AudioFeatures]
+        r = RequestScheduler.get_instance().get(f"{BASE_URL}audio-features",
+                                                params={"ids": ','.join(batch)},
+                                                headers=build_access_headers())
+        Logger.write(r, LogLevel.Debug)
+        features.extend(feature for feature in r.json()["audio_features"] if feature)
+    infos = {info["id"]: info for info in get_multiple_track_info([feature["id"] for feature in features])}
+    for feature in features:
+        info = infos.get(feature["id"])
+        feature["file_name"] = get_song_path(info, custom_folder) if info else ""
         FeaturesDatabase.get_instance().save_audio_features_to_db(feature)  # automatically save all audio features obtained to the database
-    Logger.write(r, LogLevel.Debug)
     return features
 
 
@@ -137,9 +239,9 @@ def get_audio_analysis(track_id):
         (dict) the json data of a track
     """
     assert isinstance(track_id, str) and len(track_id) == 22, f"Track id {track_id} is not the correct form"
-    r = requests.get(f"{BASE_URL}audio-analysis/{track_id}",
-                     params={"market": "US"},
-                     headers=build_access_headers())
+    r = RequestScheduler.get_instance().get(f"{BASE_URL}audio-analysis/{track_id}",
+                                            params={"market": "US"},
+                                            headers=build_access_headers())
     analysis = r.json()
     Logger.write(r, LogLevel.Debug)
     return analysis
@@ -155,9 +257,9 @@ def get_multiple_audio_analysis(track_ids):
         (dict) the json data of a track
     """
     assert isinstance(track_ids, list), f"Track id list '{track_ids}' is not the correct form"
-    r = requests.get(f"{BASE_URL}audio-analysis/{','.join(track_ids)}",
-                     params={"market": "US"},
-                     headers=build_access_headers())
+    r = RequestScheduler.get_instance().get(f"{BASE_URL}audio-analysis/{','.join(track_ids)}",
+                                            params={"market": "US"},
+                                            headers=build_access_headers())
     analysis = r.json()
     Logger.write(r, LogLevel.Debug)
     return analysis
@@ -216,14 +318,34 @@ def get_track_info(track_id):
         (dict) the json data of a track
     """
     assert isinstance(track_id, str) and len(track_id) == 22, f"Track id {track_id} is not the correct form"
-    r = requests.get(f"{BASE_URL}tracks/{track_id}",
-                     params={"market": "US"},
-                     headers=build_access_headers())
+    r = RequestScheduler.get_instance().get(f"{BASE_URL}tracks/{track_id}",
+                                            params={"market": "US"},
+                                            headers=build_access_headers())
     analysis = r.json()
     Logger.write(r, LogLevel.Debug)
     return analysis
 
 
+def get_multiple_track_info(track_ids):
+    """
+    Gets track info for many tracks, batching the requests
+    Args:
+        track_ids: (list of strings) the track uris
+
+    Returns:
+        (list of dicts) the json data of the tracks that were found
+    """
+    assert isinstance(track_ids, list), f"Track id list '{track_ids}' is not the correct form"
+    tracks = []
+    for i in range(0, len(track_ids), MaxIdsPerRequest.Tracks):
+        ids = ','.join(track_ids[i:i + MaxIdsPerRequest.Tracks])
+        r = RequestScheduler.get_instance().get(f"{BASE_URL}tracks", params={"ids": ids, "market": "US"},
+                                                headers=build_access_headers())
+        Logger.write(r, LogLevel.Debug)
+        tracks.extend(track for track in r.json()["tracks"] if track)
+    return tracks
+
+
 def get_track_name_from_feature(feature_json):
     """
     Gets a track's name from the audio feature data using the track id
@@ -236,60 +358,173 @@ def get_track_name_from_feature(feature_json):
     return get_track_info(feature_json.get('id')).get('name')
 
 
-def find_song(song_name:str=None, artist:str=None, album:str=None):
+class SearchTypes:
+    """
+    The item types that can be searched for
+    """
+    Track = "track"
+    Album = "album"
+    Artist = "artist"
+
+
+def normalize_query(text):
+    """
+    Normalizes a search string so that equivalent searches compare equal
+    Args:
+        text: (string) the search string, or None
+
+    Returns:
+        (string) the lowercase string with surrounding and repeated whitespace removed
+    """
+    return " ".join(text.lower().split()) if text else ""
+
+
+def is_exact_match(item, qtype, song_name, artist, album):
+    """
+    Checks if a search result exactly matches the (normalized) name, artist, and album searched for
+    Args:
+        item: (dict) the track, album, or artist data from the search results
+        qtype: (SearchTypes) the type of item searched for
+        song_name: (string) normalized name of the song
+        artist: (string) normalized artist of the song
+        album: (string) normalized album of the song
+
+    Returns:
+        (bool) whether or not every provided value matches
+    """
+    if qtype == SearchTypes.Artist:
+        return normalize_query(item.get("name")) == artist
+    if qtype == SearchTypes.Track and song_name and normalize_query(item.get("name")) != song_name:
+        return False
+    if artist and not any(normalize_query(a.get("name")) == artist for a in item.get("artists", [])):
+        return False
+    if album:
+        album_name = item.get("name") if qtype == SearchTypes.Album else item.get("album", {}).get("name")
+        if normalize_query(album_name) != album:
+            return False
+    return True
+
+
+class IncompleteSearch(Exception):
+    """
+    Raised from inside the memoized search when nothing was found or a page failed, so the result isn't memoized
+    """
+    def __init__(self, found):
+        """
+        Args:
+            found: (tuple of dicts) whatever matches were found
+        """
+        super().__init__("Search results not memoized")
+        self.found = found
+
+
+@lru_cache(maxsize=Settings.SearchCacheSize)
+def search_exact_memoized(qtype, song_name, artist, album, first_match=False, all_matches=False):
+    """
+    Searches for exact matches, requesting pages of results concurrently in waves
+    The search stops after the first wave with a match, or at the first match with first_match,
+    and only searches every page up to the total number of results with all_matches
+    Args:
+        qtype: (SearchTypes) the type of item to search for
+        song_name: (string) normalized name of the song
+        artist: (string) normalized artist of the song
+        album: (string) normalized album of the song
+        first_match: (bool) whether or not to stop at the single most relevant match
+        all_matches: (bool) whether or not to keep searching after the first wave with a match
+
+    Returns:
+        (tuple of dicts) the matching items, most relevant first
+
+    Raises:
+        IncompleteSearch: if nothing was found, or a page of results couldn't be fetched
+    """
+    query = " ".join(part for part in (song_name, artist, album) if part)
+    params = {'q': query, 'type': qtype, "limit": PageLimits.Search, "market": "US"}
+
+    def get_page(offset):
+        r = RequestScheduler.get_instance().get(f"{BASE_URL}search", params={**params, "offset": offset},
+                                                headers=build_access_headers())
+        data = r.json()
+        if f"{qtype}s" not in data:  # an error, or an expired token
+            Logger.write(f"Unable to search for '{query}' at offset {offset}: {data.get('error', data)}", LogLevel.Error)
+            return None
+        return data[f"{qtype}s"]
+
+    wave_size = Settings.SearchConcurrency * PageLimits.Search
+    total = MaxSearchOffset + 1  # until the first page says how many results there are
+    found = []
+    complete = True
+    with ThreadPoolExecutor(max_workers=Settings.SearchConcurrency) as pool:
+        for wave_start in range(0, MaxSearchOffset + 1, wave_size):
+            offsets = range(wave_start, min(wave_start + wave_size, total), PageLimits.Search)
+            if not len(offsets) or (found and not all_matches):  # past the last result, or done after a wave with a match
+                break
+            futures = [pool.submit(get_page, offset) for offset in offsets]
+            for future in futures:  # in offset order, so the most relevant match comes first
+                page = future.result()
+                if page is None:
+                    complete = False
+                    continue
+                total = min(total, page.get("total", 0))
+                found.extend(item for item in page.get("items", [])
+                             if item and is_exact_match(item, qtype, song_name, artist, album))
+                if first_match and found:
+                    for pending in futures:
+                        pending.cancel()
+                    return tuple(found[:1])
+    if not found or not complete:
+        raise IncompleteSearch(tuple(found))
+    return tuple(found)
+
+
+def search_exact(qtype, song_name, artist, album, first_match=False, all_matches=False):
+    """
+    Searches for exact matches, memoizing complete results per normalized query
+    Args:
+        qtype: (SearchTypes) the type of item to search for
+        song_name: (string) normalized name of the song
+        artist: (string) normalized artist of the song
+        album: (string) normalized album of the song
+        first_match: (bool) whether or not to stop at the single most relevant match
+        all_matches: (bool) whether or not to keep searching after the first wave with a match
+
+    Returns:
+        (tuple of dicts) the matching items, most relevant first
+    """
+    try:
+        return search_exact_memoized(qtype, song_name, artist, album, first_match, all_matches)
+    except IncompleteSearch as e:
+        return e.found
+
+
+def find_song(song_name:str=None, artist:str=None, album:str=None, first_match=False, all_matches=False):
     """
     Get data for a song based on title and optionally artist and/or album
+    If only an album or artist is given, the album or artist is searched for instead
     Args:
         song_name: (string) name of the song
         artist: (string) artist of the song
         album: (string) album of the song
+        first_match: (bool) whether or not to stop at the first exact match
+        all_matches: (bool) whether or not to search every page of results, rather than stopping after the first with a match
 
     Returns:
         (list) list of track data
     """
-    found = []
-    songs = []
-    offset = 0
-    qtype = "track"
-    while not len(songs) and offset <= 1000:
-        query = ""
-        if song_name:
-            song_name = song_name.strip()
-            query += f"{song_name}"
-        elif album:
-            qtype = "album"
-        elif artist:
-            qtype = "artist"
-        if artist:
-            artist = artist.strip()
-            query += f" {artist}"
-        if album:
-            album = album.strip()
-            query += f" {album}"
-        r = requests.get(f"{BASE_URL}search",
-                         params={'q': query, 'type': qtype, "limit": 50, "offset": offset, "market": "US"},
-                         headers=build_access_headers())
-        songs = r.json() 
-        if qtype == "track":
-            songs = songs.get("tracks", {}).get("items", [])
-        elif qtype == "album":
-            songs = songs.get("albums", {})[0]
-        elif qtype == "artists":
-            songs = songs.get("artists", {})[0]
-        if not len(songs):
-            if not len(found):
-                Logger.write(f"Unable to find '{song_name}'", LogLevel.Error)
-                return []
-        else:
-            if song_name:
-                songs = [song for song in songs if song.get("name", "n/a").lower() == song_name.lower()]
-            if artist:
-                songs = [song for song in songs if any(a.get("name", "n/a").lower() == artist.lower() for a in song.get("artists", "artists"))]
-            if album:
-                songs = [song for song in songs if song.get("album", {}).get("name", "n/a").lower() == album.lower()]
-            found.extend(songs)
-            offset += 50
-    Logger.write(songs, LogLevel.Debug)
+    if song_name:
+        qtype = SearchTypes.Track
+    elif album:
+        qtype = SearchTypes.Album
+    elif artist:
+        qtype = SearchTypes.Artist
+    else:
+        Logger.write("Nothing to search for, provide a song name, artist, or album", LogLevel.Error)
+        return []
+    found = list(search_exact(qtype, normalize_query(song_name), normalize_query(artist), normalize_query(album), first_match,
+                              all_matches))
+    if not len(found):
+        Logger.write(f"Unable to find '{song_name if song_name else album if album else artist}'", LogLevel.Error)
+    Logger.write(found, LogLevel.Debug)
     return found
 
 
@@ -303,9 +538,9 @@ def get_artist(artist_id):
         (dict) the artist data
     """
     assert isinstance(artist_id, str) and len(artist_id) == 22, f"Artist id {artist_id} is not the correct form"
-    r = requests.get(f"{BASE_URL}artists/{artist_id}",
-                     params={'include_groups': 'album', 'limit': 1000, "market": "US"},
-                     headers=build_access_headers())
+    r = RequestScheduler.get_instance().get(f"{BASE_URL}artists/{artist_id}",
+                                            params={'include_groups': 'album', 'limit': 1000, "market": "US"},
+                                            headers=build_access_headers())
     artist = r.json()
     Logger.write(artist)
     return artist
@@ -321,70 +556,102 @@ def get_related_artists(artist_id):
         (dict) the related artist data
     """
     assert isinstance(artist_id, str) and len(artist_id) == 22, f"Artist id {artist_id} is not the correct form"
-    r = requests.get(f"{BASE_URL}artists/{artist_id}/related-artists",
-                     params={'include_groups': 'album', 'limit': 1000, "market": "US"},
-                     headers=build_access_headers())
+    r = RequestScheduler.get_instance().get(f"{BASE_URL}artists/{artist_id}/related-artists",
+                                            params={'include_groups': 'album', 'limit': 1000, "market": "US"},
+                                            headers=build_access_headers())
     albums = r.json()
     Logger.write(albums, LogLevel.Debug)
     return albums
 
 
+def get_all_pages(url, limit, params=None, items_key=None):
+    """
+    Gets every item from a paginated api endpoint
+    The total is read from the first page, then all of the remaining pages are requested concurrently
+    Args:
+        url: (string) the endpoint url
+        limit: (int) the page size, which should be the largest the endpoint allows
+        params: (dict) extra request parameters
+        items_key: (string) the key the paging object is nested under, e.g. 'tracks' for search results
+
+    Returns:
+        (list) every item, in the order the api returned them
+    """
+    params = dict(params) if params else {}
+
+    def get_page(offset):
+        r = RequestScheduler.get_instance().get(url, params={**params, "limit": limit, "offset": offset},
+                                                headers=build_access_headers())
+        page = r.json()
+        return page[items_key] if items_key else page
+
+    first = get_page(0)
+    items = list(first["items"])
+    offsets = range(len(first["items"]), first.get("total", 0), limit) if first["items"] else []
+    if len(offsets):
+        with ThreadPoolExecutor(max_workers=min(Settings.PageConcurrency, len(offsets))) as pool:
+            for page in pool.map(get_page, offsets):
+                items.extend(page["items"])
+    return items
+
+
 def get_artist_albums(artist_id):
     """
-    Gets the album data from an artist id
+    Gets the album data from an artist id, across every page of albums
     Args:
         artist_id: (string) the artist uri
 
     Returns:
-        (dict) the album data
+        (list of dicts) the album data
     """
     assert isinstance(artist_id, str) and len(artist_id) == 22, f"Artist id {artist_id} is not the correct form"
-    r = requests.get(f"{BASE_URL}artists/{artist_id}/albums",
-                     params={'include_groups': 'album', 'limit': 50, "market": "US"},
-                     headers=build_access_headers())
-    albums = r.json()["items"]
+    albums = get_all_pages(f"{BASE_URL}artists/{artist_id}/albums", PageLimits.ArtistAlbums,
+                           params={'include_groups': 'album', "market": "US"})
     Logger.write(albums, LogLevel.Debug)
     return albums
 
 
 def get_album_tracks(album_id):
     """
-    Gets the track data from an album id
+    Gets the track data from an album id, across every page of tracks
     Args:
         album_id: (string) the album uri
 
     Returns:
-        (dict) the track data
+        (list of dicts) the track data
     """
     assert isinstance(album_id, str) and len(album_id) == 22, f"Album id {album_id} is not the correct form"
-    r = requests.get(f"{BASE_URL}albums/{album_id}/tracks",
-                     params={"market": "US"},
-                     headers=build_access_headers())
-    tracks = r.json()["items"]
+    tracks = get_all_pages(f"{BASE_URL}albums/{album_id}/tracks", PageLimits.AlbumTracks, params={"market": "US"})
     Logger.write(tracks, LogLevel.Debug)
     return tracks
 
 
+def get_albums_tracks(album_ids):
+    """
+    Gets the track data from many albums, requesting the albums concurrently
+    Args:
+        album_ids: (list of strings) the album uris
+
+    Returns:
+        (list of lists of dicts) the track data for each album, in the same order as the album ids
+    """
+    if not album_ids:
+        return []
+    with ThreadPoolExecutor(max_workers=min(Settings.PageConcurrency, len(album_ids))) as pool:
+        return list(pool.map(get_album_tracks, album_ids))
+
+
 def get_playlist_tracks(playlist):
     """
-    Gets the track data from a playlist
+    Gets the track data from a playlist, across every page of tracks
     Args:
         playlist: (string) the playlist uri
 
     Returns:
-        (dict) the track data
+        (list of dicts) the playlist items, each containing the track data under 'track'
     """
     assert isinstance(playlist, str) and len(playlist) == 22, f"Album id {playlist} is not the correct form"
-    r = requests.get(f"{BASE_URL}playlists/{playlist}/tracks",
-                     params={"market": "US"},
-                     headers=build_access_headers())
-    json_data = r.json()
-    tracks = []
-    tracks.extend(json_data["items"])
-    while json_data.get("next", None):
-        r = requests.get(json_data["next"], headers=build_access_headers())
-        json_data = r.json()
-        tracks.extend(json_data["items"])
+    tracks = get_all_pages(f"{BASE_URL}playlists/{playlist}/tracks", PageLimits.PlaylistTracks, params={"market": "US"})
     Logger.write(tracks, LogLevel.Debug)
     return tracks
 
@@ -417,9 +684,9 @@ def get_track_recommendations_from_track(track_id, n=10, need_mixable=False, que
             param_data["min_time_signature"] = max(features["time_signature"] - MixingSimilarityThresholds.TimeSignature, SimilarityMinValues.TimeSignature)
             param_data["max_tempo"] = min(features["tempo"] + MixingSimilarityThresholds.Tempo, SimilarityMaxValues.Tempo)
             param_data["min_tempo"] = max(features["tempo"] - MixingSimilarityThresholds.Tempo, SimilarityMinValues.Tempo)
-        r = requests.get(f"{BASE_URL}recommendations",
-                        params=param_data,
-                        headers=build_access_headers())
+        r = RequestScheduler.get_instance().get(f"{BASE_URL}recommendations",
+                                                params=param_data,
+                                                headers=build_access_headers())
         json_data = r.json()
     else:
         # kmeans clustering?
@@ -450,50 +717,92 @@ def extract_song_url(track_data):
             return get_track_info(track_data)["external_urls"]["spotify"]
 
 
-def download_songs(track_data, custom_folder=None):
+def resolve_tracks(track_data):
+    """
+    Gets the track objects for uris, urls, track objects, or audio features, requesting any that are missing in batches
+    Args:
+        track_data: (list) spotify-mapping data points
+
+    Returns:
+        (list of dicts) the track objects that were found
+    """
+    tracks = {}
+    missing = []
+    for song in track_data:
+        if isinstance(song, dict) and "external_urls" in song and "artists" in song:  # track object
+            tracks[song["id"]] = song
+        else:
+            try:
+                tid = song["id"] if isinstance(song, dict) else get_id_from_url(song)
+                if tid not in tracks:
+                    tracks[tid] = None
+                    missing.append(tid)
+            except Exception as e:
+                Logger.write(f"Unable to download {song}: {e}")
+    if missing:
+        tracks.update((track["id"], track) for track in get_multiple_track_info(missing))
+    return [track for track in tracks.values() if track]
+
+
+def get_download_scheduler(custom_folder=None, on_result=None):
     """
-    Downloads song(s) from uris, track objects, or urls
+    Builds a download scheduler, imported here since the downloads module depends on this one
+    Args:
+        custom_folder: (string) a folder other than songs/
+        on_result: (function) called with each DownloadResult as soon as that track is done
+
+    Returns:
+        (DownloadScheduler) a new download scheduler
+    """
+    try:
+        from downloads import DownloadScheduler
+    except ImportError:
+        from VibeMatch.downloads import DownloadScheduler
+    return DownloadScheduler(custom_folder=custom_folder, on_result=on_result)
+
+
+def is_downloaded(track_data, custom_folder=None):
+    """
+    Checks the library manifest for a song
+    Args:
+        track_data: (any) the uri, url, track object, or audio features of the song
+        custom_folder: (string) a folder other than songs/
+
+    Returns:
+        (bool) whether or not the song has already been downloaded
+    """
+    try:
+        track = track_data if isinstance(track_data, dict) else get_id_from_url(track_data)
+        return LibraryManifest.get_instance().has_track(track, custom_folder)
+    except Exception:
+        return False
+
+
+def download_songs(track_data, custom_folder=None, on_result=None):
+    """
+    Downloads song(s) from uris, track objects, or urls, returning as soon as the last one is done
+    Songs already in the library manifest are skipped without touching the disk or the api
     Also gets audio features, and saves track id to features db for reference
     Args:
         track_data: (any) one or more spotify-mapping data points to get song from
         custom_folder: (string) a folder other than songs/
+        on_result: (function) called with each DownloadResult (path, status, elapsed time, size) as soon as that song is done
     Returns:
-        tuple: (DownloadManager, str) the download manager to determine if songs are done and the last path used
+        tuple: (DownloadScheduler, str) the download scheduler holding the result of every song, and the last path used
     """
     spotify_client = SpotifyClientWrapper.get_client()
     folder = custom_folder if custom_folder else FolderDefinitions.Songs
     os.makedirs(folder, exist_ok=True)
-    downloader_options = DownloaderOptions(
-        format=FileFormats.M4a,
-        output=get_path_template(folder),
-        bitrate=Settings.Bitrate,
-    )
-    downloader = Downloader(downloader_options)
     if not isinstance(track_data, list):
         track_data = [track_data]
-    to_download = []
-    features = None
-    for song in track_data:
-        url = extract_song_url(song)
-        tid = get_id_from_url(url)
-        try:
-            try:
-                if Settings.GetFeatures:
-                    features = get_track_audio_features(tid, custom_folder)
-                to_download.append(url)
-            except Exception as e:
-                Logger.write(f"Unable to download {tid}: {e}")
-        except Exception as obj_e:
-            Logger.write(f"Unable to download {tid}: {obj_e}")
-    if len(to_download):
-        Logger.write(f"Downloading {len(to_download)} songs")
-        download(query=to_download, downloader=downloader)
-        Logger.write(f"Downloaded {len(to_download)} songs")
-        # while len(d.download_tracker.get_song_list()):
-        #     time.sleep(1)
-        return downloader, folder
-    else:
+    LibraryManifest.get_instance().ensure_scanned(folder)
+    downloaded = [song for song in track_data if is_downloaded(song, custom_folder)]
+    tracks = resolve_tracks([song for song in track_data if not is_downloaded(song, custom_folder)])
+    scheduler = get_download_scheduler(custom_folder, on_result)
+    scheduler.run(downloaded + tracks)
+    if not scheduler.queued:
         Logger.write("No songs to download. Are they already downloaded? or perhaps don't exist?", LogLevel.Error)
+    return scheduler, folder
 
 
 def get_features_of_associated_songs(track_id, n=100, layers=0, mixable=False, download=False, custom_folder=None):
@@ -530,15 +839,16 @@ def get_features_of_associated_songs(track_id, n=100, layers=0, mixable=False, d
     return associated_features
 
 
-def download_playlist(playlist:str, download=True, custom_folder=None):
+def download_playlist(playlist:str, download=True, custom_folder=None, on_result=None):
     """
     Downloads a whole playlist
     Args:
         playlist: (str) the playlist uri or url
         download: (bool) whether or not to download the files
         custom_folder: (string) a folder other than songs/
+        on_result: (function) called with each DownloadResult as soon as that song is done
     Returns:
-        (DownloadManager object) the DownloadManager used to get the tracks
+        (DownloadScheduler object) the DownloadScheduler used to get the tracks
         (str) path used to download, to show user where files went
         (list of dicts) the list of audio features from the tracks found
     """
@@ -547,35 +857,27 @@ def download_playlist(playlist:str, download=True, custom_folder=None):
         Logger.write("Unable to find any songs from playlist", LogLevel.Error)
         return
     features = []
-    to_download = []
-    for track in tracks:
-        track = track["track"]
-        try:                
-            track["file_name"] = get_song_path(track, custom_folder)
-            if not os.path.exists(track["file_name"]):
-                to_download.append(track)
-            else:
-                Logger.write(f"Skipping {track['name']} - {track['artists'][0]['name']}")
-        except Exception as e:
-            Logger.write(f"Unable to get data for {track['id']}: {e}")
+    tracks = [track["track"] for track in tracks if track.get("track")]
     if Settings.GetFeatures:
         track_features = get_multiple_audio_features([track["id"] for track in tracks], custom_folder)
         features.extend(track_features)
+    d, path = None, custom_folder if custom_folder else FolderDefinitions.Songs
     if download:
-        Logger.write(f"Skipping {len(tracks) - len(to_download)} songs")
-        d, path = download_songs(to_download, custom_folder)
+        d, path = download_songs(tracks, custom_folder, on_result)
     return d, path, features
 
 
-def download_artist(artist:str, download=True, custom_folder=None):
+def download_artist(artist:str, download=True, custom_folder=None, on_result=None):
     """
     Downloads an artists discography
+    The track lists of every album are requested concurrently, then downloaded together
     Args:
         artist: (str) the artist uri or url
         download: (bool) whether or not to download the files
         custom_folder: (string) a folder other than songs/
+        on_result: (function) called with each DownloadResult as soon as that song is done
     Returns:
-        (list of DownloadManager objects) the list of DownloadManagers used to get the albums
+        (DownloadScheduler object) the DownloadScheduler used to get the albums
         (str) path used to download, to show user where files went
         (list of dicts) the list of audio features from the tracks found
     """
@@ -583,24 +885,26 @@ def download_artist(artist:str, download=True, custom_folder=None):
     if not len(albums):
         Logger.write("Unable to find any songs from artist", LogLevel.Error)
         return
-    features = []
-    downloaders = []
-    for album in albums:
-        d, path, featureset = download_album(album["id"], download=download, custom_folder=custom_folder)
-        features.extend(featureset)
-        downloaders.extend(d)
-    return downloaders, path, features
+    track_ids = []
+    seen = set()
+    for album_tracks in get_albums_tracks([album["id"] for album in albums]):
+        for track in album_tracks:
+            if track["id"] not in seen:
+                seen.add(track["id"])
+                track_ids.append(track["id"])
+    return download_tracks(track_ids, download, custom_folder, on_result)
 
 
-def download_album(album:str, download=True, custom_folder=None):
+def download_album(album:str, download=True, custom_folder=None, on_result=None):
     """
     Downloads a whole album
     Args:
         album: (str) the album uri or url
         download: (bool) whether or not to download the files
         custom_folder: (string) a folder other than songs/
+        on_result: (function) called with each DownloadResult as soon as that song is done
     Returns:
-        (DownloadManager object) the DownloadManager used to get the album
+        (DownloadScheduler object) the DownloadScheduler used to get the album
         (str) path used to download, to show user where files went
         (list of dicts) the list of audio features from the tracks found
     """
@@ -608,30 +912,48 @@ def download_album(album:str, download=True, custom_folder=None):
     if not len(tracks):
         Logger.write("Unable to find any songs from album", LogLevel.Error)
         return
+    return download_tracks([track["id"] for track in tracks], download, custom_folder, on_result)
+
+
+def download_tracks(track_ids, download=True, custom_folder=None, on_result=None):
+    """
+    Gets the audio features of a list of tracks in batches, and optionally downloads them
+    Args:
+        track_ids: (list of strings) the track uris
+        download: (bool) whether or not to download the files
+        custom_folder: (string) a folder other than songs/
+        on_result: (function) called with each DownloadResult as soon as that song is done
+    Returns:
+        (DownloadScheduler object) the DownloadScheduler used to get the tracks, or None if not downloading
+        (str) path used to download, to show user where files went
+        (list of dicts) the list of audio features from the tracks found
+    """
     features = []
-    for track in tracks:
-        try:
-            features.append(get_track_audio_features(track["track"]["id"], custom_folder))
-        except Exception as e:
-            Logger.write(f"Unable to get data for {track['track']['id']}: {e}")
+    try:
+        features = get_multiple_audio_features(track_ids, custom_folder)
+    except Exception as e:
+        Logger.write(f"Unable to get data for {len(track_ids)} tracks: {e}")
+    d, path = None, custom_folder if custom_folder else FolderDefinitions.Songs
     if download:
-        d, path = download_songs([track["track"]["id"] for track in tracks], custom_folder)
+        d, path = download_songs(track_ids, custom_folder, on_result)
     return d, path, features
 
 
-def download_music(info, download=True, custom_folder=None):
+def download_music(info, download=True, custom_folder=None, on_result=None):
     if type(info) is str:
         if "playlist" in info:
-            d, path, features = download_playlist(info, download=download, custom_folder=custom_folder)
+            d, path, features = download_playlist(info, download=download, custom_folder=custom_folder, on_result=on_result)
         elif "artist" in info:
-            d, path, features = download_artist(info, download=download, custom_folder=custom_folder)
+            d, path, features = download_artist(info, download=download, custom_folder=custom_folder, on_result=on_result)
         elif "album" in info:
-            d, path, features = download_album(info, download=download, custom_folder=custom_folder)
+            d, path, features = download_album(info, download=download, custom_folder=custom_folder, on_result=on_result)
         else:
-            d, path = download_songs(info, custom_folder=custom_folder)
+            d, path = download_songs(info, custom_folder=custom_folder, on_result=on_result)
     elif type(info) is list:
-        for i in info:
-            d, path = download_music(i, download, custom_folder)
+        d, path = None, custom_folder if custom_folder else FolderDefinitions.Songs
+        if download:
+            d = get_download_scheduler(custom_folder, on_result)
+            d.run(info)
     else:
         return None, None
     return d, path
@@ -642,25 +964,47 @@ def download_or_open(song) -> tuple[AudioSegment, str]:
         d, path = download_music(song)
     else:
         path = f"{FolderDefinitions.Songs}/{song}"
-    return AudioSegment.from_file(path), path
-
-
-def build_library_from_track(track_id, min_tracks=1, max_tracks=1000, mixable=False, download=False, custom_folder=None):
-    to_obtain = min(max_tracks, 1000)  # at most, 100 at a time
-    layers = max(math.floor(math.sqrt(max_tracks) / to_obtain) - 1, 0)  # at least 0 layers
-    obtained = 0
-    recommendations = []
-    while obtained + to_obtain**layers <= max_tracks:
-        recommendations = get_features_of_associated_songs(track_id, n=to_obtain, layers=layers, mixable=mixable, download=download, custom_folder=custom_folder)
-        obtained += len(recommendations)
-    if obtained < min_tracks:
-        catch_up_recommendations = get_features_of_associated_songs(track_id, n=min_tracks-obtained, layers=0, mixable=mixable,
-                                                           download=download, custom_folder=custom_folder)
-        obtained += len(catch_up_recommendations)
-        recommendations.extend(catch_up_recommendations)
+    return open_audio(path).to_audio_segment(), path
+
+
+def build_library_from_track(track_id, min_tracks=1, max_tracks=1000, mixable=False, download=False, custom_folder=None,
+                             order=CrawlOrder.BreadthFirst, name=None):
+    """
+    Builds a library of songs by crawling recommendations outwards from a track
+    The crawl is stored in the database, so calling this again with the same track (or name) resumes it
+    Args:
+        track_id: (string) the track uri to start from
+        min_tracks: (int) the fewest tracks expected, an error is logged if the recommendations run out before this
+        max_tracks: (int) exactly how many tracks to find, not including the starting track
+        mixable: (bool) whether or not the music needs to be mixable
+        download: (bool) whether or not to download the files
+        custom_folder: (string) a folder other than songs/
+        order: (CrawlOrder) breadth first, or most popular tracks first
+        name: (string) the name of the crawl to resume, defaults to the track uri and folder
+
+    Returns:
+        (list of dicts) the audio features of the tracks found during this run
+    """
+    folder = custom_folder if custom_folder else FolderDefinitions.Songs
+    crawler = LibraryCrawler(track_id,
+                             recommend=lambda tid, n: get_track_recommendations_from_track(tid, n, need_mixable=mixable),
+                             fetch_features=lambda tids: get_multiple_audio_features(tids, custom_folder),
+                             download=(lambda tids: download_songs(tids, custom_folder)) if download else None,
+                             name=name if name else f"{track_id}:{folder}",
+                             order=order)
+    try:
+        recommendations = crawler.run(max_tracks, n=min(max_tracks, Settings.CrawlRecommendations))
+        if crawler.get_library_size() < min_tracks:
+            Logger.write(f"Only found {crawler.get_library_size()} of at least {min_tracks} tracks", LogLevel.Error)
+    finally:
+        crawler.close()
     return recommendations
 
 
+if os.environ.get("SPOTIFY_API_URL"):
+    set_api_url(os.environ["SPOTIFY_API_URL"])
+
+
 if __name__ == "__main__":
     Logger.set_log_level(LogLevel.Info)
     start = time.perf_counter()
@@ -696,4 +1040,5 @@ if __name__ == "__main__":
 
 
     end = time.perf_counter()
-    Logger.write(f"Finished in {end-start} seconds", LogLevel.Info)
\ No newline at end of file
+    Logger.write(f"Finished in {end-start} seconds", LogLevel.Info)
+    Logger.write(f"Requests: {RequestScheduler.get_instance().get_metrics()}", LogLevel.Info)
\ No newline at end of file
@@ -0,0 +1,580 @@
+"""
+This file is a local stand-in for the spotify rest api, for testing and benchmarking without a network or credentials
+It serves the endpoints that spotify.py uses, from recorded fixtures when there are any, and from deterministic
+generated data based on the json_schema examples otherwise
+
+Responses are paginated like the real api, and the server can add latency, throttle every nth request,
+or enforce a rate limit with 429 responses, so throughput, caching and retry behaviour can be measured repeatably
+
+Usage would be something like python standin.py [port], then spotify.set_api_url("http://127.0.0.1:port")
+or setting the SPOTIFY_API_URL environment variable before importing spotify
+"""
+
+
+import copy
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlparse
+try:
+    from json_schema import features as features_template, track_info as track_template
+    from utilities import Logger, LogLevel, FolderDefinitions
+except:
+    from VibeMatch.json_schema import features as features_template, track_info as track_template
+    from VibeMatch.utilities import Logger, LogLevel, FolderDefinitions
+
+
+Base62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+
+def make_id(seed):
+    """
+    Makes a deterministic spotify-style id
+    Args:
+        seed: (string) anything identifying the item, the same seed always gives the same id
+
+    Returns:
+        (string) a 22 character alphanumeric id
+    """
+    value = int(hashlib.sha1(seed.encode()).hexdigest(), 16)
+    chars = []
+    for _ in range(22):
+        value, remainder = divmod(value, 62)
+        chars.append(Base62[remainder])
+    return "".join(chars)
+
+
+class FixtureStore:
+    """
+    Provides the api responses served by the stand-in, from recorded json files or generated data
+    """
+    def __init__(self, folder=None, playlist_size=250, album_size=12, artist_albums=60, search_results=1000):
+        """
+        Builds a fixture store
+        Args:
+            folder: (string) the folder containing recorded fixtures, if any
+            playlist_size: (int) how many tracks generated playlists have
+            album_size: (int) how many tracks generated albums have
+            artist_albums: (int) how many albums generated artists have
+            search_results: (int) how many results generated searches have
+        """
+        self.folder = folder
+        self.playlist_size = playlist_size
+        self.album_size = album_size
+        self.artist_albums = artist_albums
+        self.search_results = search_results
+        self.generated = {}
+        self.lock = threading.Lock()
+
+    def generate(self, key, build):
+        """
+        Memoizes generated data, since the same playlist or search is paged through many times
+        Args:
+            key: (tuple) identifies the generated data
+            build: (function) builds the data if it hasn't been generated yet
+
+        Returns:
+            (any) the generated data, which is shared and shouldn't be modified
+        """
+        with self.lock:
+            data = self.generated.get(key)
+        if data is None:
+            data = build()
+            with self.lock:
+                self.generated[key] = data
+        return data
+
+    @staticmethod
+    def get_fixture_name(path, params=None):
+        """
+        Gets the file name a response is recorded under
+        Args:
+            path: (string) the api path e.g. /v1/tracks/651YhrvzeVfOa8yIifIhUM
+            params: (dict) the request parameters that change the response, if any
+
+        Returns:
+            (string) the json file name
+        """
+        name = path.strip('/').replace('/', '_')
+        if params:
+            name += "__" + hashlib.sha1(urlencode(sorted(params.items())).encode()).hexdigest()[:12]
+        return f"{name}.json"
+
+    def load(self, path, params=None):
+        """
+        Loads a recorded response, preferring one recorded with the same parameters
+        Args:
+            path: (string) the api path
+            params: (dict) the request parameters
+
+        Returns:
+            (dict|None) the recorded response, or None if there isn't one
+        """
+        if not self.folder:
+            return None
+        for name in (self.get_fixture_name(path, params), self.get_fixture_name(path)):
+            file_path = os.path.join(self.folder, name)
+            if os.path.exists(file_path):
+                with open(file_path, 'r') as f:
+                    return json.load(f)
+        return None
+
+    def record(self, path, data, params=None):
+        """
+        Saves a response so that it is served in place of generated data
+        Args:
+            path: (string) the api path
+            data: (dict) the response json
+            params: (dict) the request parameters that change the response, if any
+
+        Returns:
+            (string) the file the fixture was written to
+        """
+        assert self.folder, "No fixture folder to record to"
+        os.makedirs(self.folder, exist_ok=True)
+        file_path = os.path.join(self.folder, self.get_fixture_name(path, params))
+        with open(file_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        return file_path
+
+    def track(self, track_id):
+        """
+        Args:
+            track_id: (string) the track uri
+
+        Returns:
+            (dict) the track data
+        """
+        recorded = self.load(f"/v1/tracks/{track_id}")
+        if recorded:
+            return recorded
+        rng = random.Random(track_id)
+        track = copy.deepcopy(track_template)
+        artist_id = make_id(f"artist:{rng.randrange(500)}")
+        artist = {"external_urls": {"spotify": f"https://open.spotify.com/artist/{artist_id}"}, "id": artist_id,
+                  "name": f"Artist {artist_id[:6]}", "type": "artist", "uri": f"spotify:artist:{artist_id}"}
+        track["artists"] = [artist]
+        track["album"]["artists"] = [artist]
+        track.update({
+            "id": track_id,
+            "name": f"Track {track_id[:8]}",
+            "uri": f"spotify:track:{track_id}",
+            "href": f"https://api.spotify.com/v1/tracks/{track_id}",
+            "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+            "duration_ms": rng.randrange(120000, 480000),
+            "popularity": rng.randrange(100),
+        })
+        return track
+
+    def simple_track(self, track_id):
+        """
+        Args:
+            track_id: (string) the track uri
+
+        Returns:
+            (dict) the simplified track data used in album listings, i.e. without the album
+        """
+        track = self.track(track_id)
+        track.pop("album", None)
+        return track
+
+    def audio_features(self, track_id):
+        """
+        Args:
+            track_id: (string) the track uri
+
+        Returns:
+            (dict) the audio feature data
+        """
+        recorded = self.load(f"/v1/audio-features/{track_id}")
+        if recorded:
+            return recorded
+        rng = random.Random(f"features:{track_id}")
+        features = copy.deepcopy(features_template)
+        features.pop("file_name")  # added by us, not the api
+        features.update({
+            "danceability": round(rng.random(), 3),
+            "energy": round(rng.random(), 3),
+            "key": rng.randrange(-1, 12),
+            "loudness": round(rng.uniform(-20, 0), 3),
+            "mode": rng.randrange(2),
+            "valence": round(rng.random(), 3),
+            "tempo": round(rng.uniform(70, 180), 3),
+            "id": track_id,
+            "uri": f"spotify:track:{track_id}",
+            "track_href": f"https://api.spotify.com/v1/tracks/{track_id}",
+            "analysis_url": f"https://api.spotify.com/v1/audio-analysis/{track_id}",
+            "duration_ms": self.track(track_id)["duration_ms"],
+        })
+        return features
+
+    def audio_analysis(self, track_id):
+        """
+        Args:
+            track_id: (string) the track uri
+
+        Returns:
+            (dict) a minimal audio analysis, with the track summary and evenly spaced beats
+        """
+        recorded = self.load(f"/v1/audio-analysis/{track_id}")
+        if recorded:
+            return recorded
+        features = self.audio_features(track_id)
+        beat = 60 / features["tempo"]
+        duration = features["duration_ms"] / 1000
+        return {"track": {"duration": duration, "tempo": features["tempo"], "key": features["key"], "mode": features["mode"],
+                          "loudness": features["loudness"], "time_signature": features["time_signature"]},
+                "beats": [{"start": round(i * beat, 3), "duration": round(beat, 3), "confidence": 1.0}
+                          for i in range(int(duration / beat))]}
+
+    def album(self, album_id):
+        """
+        Args:
+            album_id: (string) the album uri
+
+        Returns:
+            (dict) the album data, with its simplified tracks
+        """
+        return copy.deepcopy(self.generate(("album", album_id), lambda: {
+            "id": album_id, "name": f"Album {album_id[:8]}", "album_type": "album", "uri": f"spotify:album:{album_id}",
+            "tracks": [self.simple_track(make_id(f"{album_id}:{i}")) for i in range(self.album_size)]}))
+
+    def playlist_items(self, playlist_id):
+        """
+        Args:
+            playlist_id: (string) the playlist uri
+
+        Returns:
+            (list of dicts) the playlist items, each containing the track data under 'track', shared between calls
+        """
+        return self.generate(("playlist", playlist_id), lambda: [{"track": self.track(make_id(f"{playlist_id}:{i}"))}
+                                                                 for i in range(self.playlist_size)])
+
+    def search_items(self, query, qtype):
+        """
+        Generates search results, where a few results are named exactly after the query
+        Args:
+            query: (string) the search string
+            qtype: (string) the type searched for, track album or artist
+
+        Returns:
+            (list of dicts) the search results, shared between calls
+        """
+        return self.generate(("search", query, qtype), lambda: self._build_search_items(query, qtype))
+
+    def _build_search_items(self, query, qtype):
+        rng = random.Random(f"search:{query}")
+        exact = {rng.randrange(self.search_results) for _ in range(3)}
+        items = []
+        for i in range(self.search_results):
+            item = self.track(make_id(f"search:{query}:{i}"))
+            item["name"] = query if i in exact else f"{query} ({i})"
+            if qtype == "album":
+                item = item["album"]
+                item["name"] = query if i in exact else f"{query} ({i})"
+            elif qtype == "artist":
+                item = dict(item["artists"][0], name=query if i in exact else f"{query} ({i})")
+            items.append(item)
+        return items
+
+    def recommendations(self, seed_track, limit):
+        """
+        Args:
+            seed_track: (string) the track uri to base recommendations on
+            limit: (int) how many tracks to recommend
+
+        Returns:
+            (list of dicts) the recommended track data
+        """
+        rng = random.Random(f"recommend:{seed_track}")
+        pool = [make_id(f"recommend:{rng.randrange(5000)}") for _ in range(limit)]
+        return [self.track(track_id) for track_id in pool]
+
+
+class StandInServer:
+    """
+    A local http server that behaves like the parts of the spotify rest api used by spotify.py
+    """
+    def __init__(self, port=0, fixtures=None, latency=0.0, latency_jitter=0.0, throttle_every=0, retry_after=1,
+                 rate_limit=None, host="127.0.0.1"):
+        """
+        Builds a stand-in server, call start() to serve requests
+        Args:
+            port: (int) the port to listen on, 0 picks a free port
+            fixtures: (FixtureStore|string) the fixture store, or a folder of recorded fixtures
+            latency: (float) seconds to wait before answering each request
+            latency_jitter: (float) up to this many extra seconds are randomly added to the latency
+            throttle_every: (int) answer every nth api request with a 429, 0 never does
+            retry_after: (float) the Retry-After seconds sent with 429 responses
+            rate_limit: (float) the most api requests per second allowed before answering with 429s, None for no limit
+            host: (string) the address to listen on
+        """
+        self.fixtures = fixtures if isinstance(fixtures, FixtureStore) else FixtureStore(fixtures)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.throttled_count = 0
+        self.recent = []
+        self.throttled_until = 0.0
+        self.server = ThreadingHTTPServer((host, port), self._build_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+        Returns:
+            (string) the root url of the server e.g. http://127.0.0.1:8080
+        """
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Starts serving requests on a background thread
+
+        Returns:
+            (StandInServer) this server
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        Logger.write(f"Spotify stand-in serving on {self.url}", LogLevel.Debug)
+        return self
+
+    def stop(self):
+        """
+        Stops serving requests and closes the socket
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def should_throttle(self):
+        """
+        Decides whether the current api request is answered with a 429, counting it either way
+
+        Returns:
+            (bool) whether or not to throttle the request
+        """
+        with self.lock:
+            self.request_count += 1
+            now = time.monotonic()
+            throttle = now < self.throttled_until
+            if self.throttle_every and self.request_count % self.throttle_every == 0:
+                throttle = True
+            if self.rate_limit and not throttle:
+                self.recent = [t for t in self.recent if now - t < 1.0]
+                if len(self.recent) >= self.rate_limit:
+                    throttle = True
+                    self.throttled_until = now + self.retry_after
+                else:
+                    self.recent.append(now)
+            if throttle:
+                self.throttled_count += 1
+            return throttle
+
+    def page(self, items, path, params, default_limit=20):
+        """
+        Builds a paging object like the api's, with the total and next link
+        Args:
+            items: (list) every item
+            path: (string) the request path, used for the next link
+            params: (dict) the request parameters
+            default_limit: (int) the page size if none was requested
+
+        Returns:
+            (dict) the paging object
+        """
+        limit = int(params.get("limit", default_limit))
+        offset = int(params.get("offset", 0))
+        next_url = None
+        if offset + limit < len(items):
+            next_url = f"{self.url}{path}?{urlencode({**params, 'offset': offset + limit, 'limit': limit})}"
+        return {"items": items[offset:offset + limit], "total": len(items), "limit": limit, "offset": offset,
+                "next": next_url, "href": f"{self.url}{path}?{urlencode(params)}"}
+
+    def respond(self, path, params):
+        """
+        Gets the response for an api request
+        Args:
+            path: (string) the request path e.g. /v1/tracks/651YhrvzeVfOa8yIifIhUM
+            params: (dict) the request parameters
+
+        Returns:
+            (tuple of int and dict) the http status and the json response
+        """
+        recorded = self.fixtures.load(path, params)
+        if recorded is not None:
+            return 200, recorded
+        parts = path.strip('/').split('/')[1:]  # drop v1
+        respond = {1: self.respond_collection, 2: self.respond_item, 3: self.respond_listing}.get(len(parts))
+        response = respond(path, parts, params) if respond else None
+        return response if response else (404, {"error": {"status": 404, "message": f"No stand-in for {path}"}})
+
+    def respond_collection(self, path, parts, params):
+        """
+        Gets the response for a request to a top level endpoint, such as a search or several tracks at once
+        Args:
+            path: (string) the request path
+            parts: (list of strings) the path after v1, split on /
+            params: (dict) the request parameters
+
+        Returns:
+            (tuple of int and dict|None) the http status and the json response, or None if there's no stand-in for it
+        """
+        store = self.fixtures
+        ids = [i for i in params.get("ids", "").split(',') if i]
+        if parts == ["audio-features"]:
+            return 200, {"audio_features": [store.audio_features(i) for i in ids]}
+        if parts == ["tracks"]:
+            return 200, {"tracks": [store.track(i) for i in ids]}
+        if parts == ["search"]:
+            qtype = params.get("type", "track")
+            items = store.search_items(params.get("q", ""), qtype)
+            return 200, {f"{qtype}s": self.page(items, path, params)}
+        if parts == ["recommendations"]:
+            seed = params.get("seed_tracks", "").split(',')[0]
+            return 200, {"tracks": store.recommendations(seed, min(int(params.get("limit", 20)), 100)), "seeds": []}
+        return None
+
+    def respond_item(self, path, parts, params):
+        """
+        Gets the response for a request for one item, such as a track or an artist
+        Args:
+            path: (string) the request path
+            parts: (list of strings) the path after v1, split on /
+            params: (dict) the request parameters
+
+        Returns:
+            (tuple of int and dict|None) the http status and the json response, or None if there's no stand-in for it
+        """
+        store = self.fixtures
+        kind, item_id = parts
+        if kind == "audio-features":
+            return 200, store.audio_features(item_id)
+        if kind == "audio-analysis":
+            return 200, store.audio_analysis(item_id)
+        if kind == "tracks":
+            return 200, store.track(item_id)
+        if kind == "artists":
+            return 200, {"id": item_id, "name": f"Artist {item_id[:6]}", "type": "artist", "uri": f"spotify:artist:{item_id}"}
+        return None
+
+    def respond_listing(self, path, parts, params):
+        """
+        Gets the response for a request for the items under one item, such as an album's tracks
+        Args:
+            path: (string) the request path
+            parts: (list of strings) the path after v1, split on /
+            params: (dict) the request parameters
+
+        Returns:
+            (tuple of int and dict|None) the http status and the json response, or None if there's no stand-in for it
+        """
+        store = self.fixtures
+        kind, item_id, listing = parts
+        if (kind, listing) == ("artists", "related-artists"):
+            return 200, {"artists": [{"id": make_id(f"{item_id}:related:{i}"), "name": f"Related {i}"} for i in range(20)]}
+        if (kind, listing) == ("artists", "albums"):
+            albums = [store.album(make_id(f"{item_id}:album:{i}")) for i in range(store.artist_albums)]
+            for album in albums:
+                album.pop("tracks")
+            return 200, self.page(albums, path, params)
+        if (kind, listing) == ("albums", "tracks"):
+            return 200, self.page(store.album(item_id)["tracks"], path, params)
+        if (kind, listing) == ("playlists", "tracks"):
+            return 200, self.page(store.playlist_items(item_id), path, params, default_limit=100)
+        return None
+
+    def _build_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                Logger.write(f"stand-in: {format % args}", LogLevel.Debug)
+
+            def send_json(self, status, data, headers=None):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers if headers else {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def delay(self):
+                if server.latency or server.latency_jitter:
+                    time.sleep(server.latency + random.uniform(0, server.latency_jitter))
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.delay()
+                if urlparse(self.path).path.rstrip('/') == "/api/token":
+                    self.send_json(200, {"access_token": "stand-in", "token_type": "Bearer", "expires_in": 3600})
+                else:
+                    self.send_json(404, {"error": "not found"})
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                params = dict(parse_qsl(parsed.query))
+                self.delay()
+                if server.should_throttle():
+                    self.send_json(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                                   {"Retry-After": str(server.retry_after)})
+                    return
+                status, data = server.respond(parsed.path, params)
+                self.send_json(status, data)
+
+        return Handler
+
+
+def record_fixtures(paths, folder=None):
+    """
+    Records real api responses as fixtures for the stand-in, this requires spotify credentials
+    Args:
+        paths: (list of strings or tuples) api paths e.g. tracks/651YhrvzeVfOa8yIifIhUM, or (path, params) tuples
+        folder: (string) the fixture folder to record to
+
+    Returns:
+        (list of strings) the files written
+    """
+    import spotify
+    from scheduler import RequestScheduler
+    store = FixtureStore(folder if folder else FolderDefinitions.Fixtures)
+    written = []
+    for entry in paths:
+        path, params = entry if isinstance(entry, tuple) else (entry, None)
+        r = RequestScheduler.get_instance().get(f"{spotify.BASE_URL}{path}", params=params,
+                                                headers=spotify.build_access_headers())
+        written.append(store.record(f"/v1/{path}", r.json(), params))
+    return written
+
+
+if __name__ == "__main__":
+    import sys
+    Logger.set_log_level(LogLevel.Debug)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    folder = FolderDefinitions.Fixtures if os.path.isdir(FolderDefinitions.Fixtures) else None
+    with StandInServer(port=port, fixtures=folder) as stand_in:
+        Logger.write(f"Set SPOTIFY_API_URL={stand_in.url} to use the stand-in, press Ctrl+C to stop", LogLevel.Info)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -26,6 +26,18 @@ else:
 
 
 
+@pytest.fixture(autouse=True)
+def pcm_cache(tmp_path):
+    """
+    Keeps the songs each test decodes in its own decoded audio cache, rather than the cache folder of the repository
+    """
+    from cache import PcmCache
+    previous = PcmCache._instance
+    PcmCache._instance = PcmCache(folder=str(tmp_path / "pcm cache"))
+    yield PcmCache._instance
+    PcmCache._instance = previous
+
+
 def import_lib(lib, explode=False):
     """
     Tries to import a library.
@@ -96,6 +108,70 @@ def get_required_libs():
     return libs
 
 
+class FakeResponse:
+    """
+    A stand-in for requests.Response, used to test request handling without a network
+    """
+    def __init__(self, status=200, data=None, headers=None):
+        self.status_code = status
+        self.ok = status < 400
+        self.headers = headers if headers else {}
+        self.data = data
+        self.text = ""
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    """
+    A stand-in for requests.Session which answers every request with a handler function
+    """
+    def __init__(self, handler):
+        """
+        Args:
+            handler: (function) takes the method, url, and request params, returns a FakeResponse
+        """
+        self.handler = handler
+        self.calls = []
+        import threading
+        self.lock = threading.Lock()
+
+    def request(self, method, url, params=None, **kwargs):
+        with self.lock:
+            self.calls.append((method, url, params))
+        if method == "POST":  # access token requests
+            return FakeResponse(data={"access_token": "token", "expires_in": 3600})
+        return self.handler(method, url, params)
+
+
+def use_fake_session(handler):
+    """
+    Points the spotify module at a fake session for the duration of a with block
+    Args:
+        handler: (function) takes the method, url, and request params, returns a FakeResponse
+
+    Returns:
+        (context manager) yields the FakeSession
+    """
+    from contextlib import contextmanager
+
+    @contextmanager
+    def fake():
+        import spotify
+        from scheduler import RequestScheduler
+        session = FakeSession(handler)
+        previous = RequestScheduler._instance
+        RequestScheduler._instance = RequestScheduler(rate=1000, burst=100, session=session)
+        spotify.AccessToken.clear()
+        try:
+            yield session
+        finally:
+            RequestScheduler._instance = previous
+            spotify.AccessToken.clear()
+    return fake()
+
+
 def test_anything_works():
     """
     Asserts that tests are working
@@ -139,27 +215,80 @@ def test_missing_libs():
     import_libs_with_paths(libs)
 
 
+def use_stand_in(**server_args):
+    """
+    Points the spotify module at a local stand-in api server for the duration of a with block
+    Args:
+        **server_args: (any) passed through to standin.StandInServer
+
+    Returns:
+        (context manager) yields the StandInServer
+    """
+    from contextlib import contextmanager
+
+    @contextmanager
+    def stand_in():
+        import spotify
+        from scheduler import RequestScheduler
+        from standin import StandInServer
+        previous_scheduler = RequestScheduler._instance
+        with StandInServer(**server_args) as server:
+            spotify.set_api_url(server.url)
+            RequestScheduler._instance = RequestScheduler(rate=1000, burst=100)
+            try:
+                yield server
+            finally:
+                RequestScheduler._instance = previous_scheduler
+                spotify.set_api_url(os.environ.get("SPOTIFY_API_URL"))
+    return stand_in()
+
+
 def test_db_connection():
     """
     Test some basic database interaction
+    Uses the local stand-in api when there are no real credentials
     """
     import spotify
+    from contextlib import nullcontext
     from database import FeaturesDatabase
     inst = FeaturesDatabase.get_instance()
     assert inst.create_features_table()
-    if not FAKED_CREDENTIALS:
+    with use_stand_in() if FAKED_CREDENTIALS else nullcontext():
         spotify.get_track_audio_features("651YhrvzeVfOa8yIifIhUM")
-        assert inst.get_audio_features(1)
+    assert inst.get_audio_features(1)
 
 
 def test_spotify():
     """
     Test some basic spotify api interaction
+    Uses the local stand-in api when there are no real credentials
     """
+    from contextlib import nullcontext
     from spotify import find_song, get_track_audio_features
-    if not FAKED_CREDENTIALS:
-        find_song(song_name="Come With Me", artist="Will Sparks")
-        get_track_audio_features("651YhrvzeVfOa8yIifIhUM")
+    with use_stand_in() if FAKED_CREDENTIALS else nullcontext():
+        assert find_song(song_name="Come With Me", artist=None if FAKED_CREDENTIALS else "Will Sparks")
+        assert get_track_audio_features("651YhrvzeVfOa8yIifIhUM")["id"] == "651YhrvzeVfOa8yIifIhUM"
+
+
+def test_standin_server():
+    """
+    Tests the spotify client against the local stand-in api, including pagination and throttling
+    """
+    import spotify
+    from scheduler import RequestScheduler
+    from standin import FixtureStore
+
+    store = FixtureStore(playlist_size=345, artist_albums=55)
+    with use_stand_in(fixtures=store, throttle_every=5, retry_after=0.05, latency=0.01) as server:
+        tracks = spotify.get_playlist_tracks("0".zfill(22))
+        assert len(tracks) == 345 and len({track["track"]["id"] for track in tracks}) == 345
+        assert len(spotify.get_artist_albums("1".zfill(22))) == 55
+        features = spotify.get_multiple_audio_features([track["track"]["id"] for track in tracks[:120]])
+        assert len(features) == 120 and all(feature["file_name"] for feature in features)
+        assert len(spotify.get_track_recommendations_from_track("2".zfill(22), 15)) == 15
+        metrics = RequestScheduler.get_instance().get_metrics()
+        assert server.throttled_count > 0 and metrics.throttled == server.throttled_count
+        assert metrics.success_rate == 1.0, "Throttled requests weren't retried"
 
 
 def test_spotify_download():
@@ -193,6 +322,1041 @@ def test_spotify_download():
         assert os.path.exists(f"{FolderDefinitions.Songs}/Hardwell - I FEEL LIKE DANCING.{FileFormats.Default}"), "Song wasn't downloaded"
 
 
+def test_request_scheduler():
+    """
+    Tests that the request scheduler honours Retry-After, retries server errors, and gives up on client errors
+    """
+    from scheduler import RequestScheduler, RequestError, TokenBucket
+
+    responses = [FakeResponse(429, headers={"Retry-After": "0.2"}), FakeResponse(503), FakeResponse(200)]
+    session = FakeSession(lambda method, url, params: responses.pop(0))
+    scheduler = RequestScheduler(rate=100, burst=1, max_retries=3, session=session)
+    scheduler.get_backoff = lambda attempt: 0
+    assert scheduler.get("https://api.spotify.com/v1/tracks/651YhrvzeVfOa8yIifIhUM").status_code == 200
+    metrics = scheduler.get_metrics()
+    assert metrics.retries == 2 and metrics.throttled == 1 and metrics.successes == 1
+    assert metrics.throttle_time >= 0.2
+    assert scheduler.get_metrics("tracks").requests == 3
+
+    scheduler = RequestScheduler(rate=100, max_retries=3, session=FakeSession(lambda method, url, params: FakeResponse(404)))
+    with pytest.raises(RequestError):
+        scheduler.get("https://api.spotify.com/v1/tracks/651YhrvzeVfOa8yIifIhUM")
+    assert scheduler.get_metrics().success_rate == 0
+
+    import time
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09, "Token bucket handed out tokens faster than its rate"
+
+
+def test_page_prefetch():
+    """
+    Tests that paginated endpoints read the total from the first page and fetch every remaining offset
+    """
+    import spotify
+
+    def playlist_page(method, url, params):
+        end = min(params["offset"] + params["limit"], 1234)
+        items = [{"track": {"id": str(i).zfill(22)}} for i in range(params["offset"], end)]
+        return FakeResponse(data={"items": items, "total": 1234})
+
+    with use_fake_session(playlist_page) as session:
+        tracks = spotify.get_playlist_tracks("0".zfill(22))
+    assert [track["track"]["id"] for track in tracks] == [str(i).zfill(22) for i in range(1234)]
+    offsets = sorted(params["offset"] for method, url, params in session.calls if method == "GET")
+    assert offsets == list(range(0, 1234, 100)), "Pages were skipped or requested more than once"
+
+
+def test_find_song():
+    """
+    Tests that searching fetches pages in concurrent waves, stops after the first wave with a match, or at the first match,
+    unless every match is asked for, and only memoizes searches that found something
+    """
+    import spotify
+
+    def search_page(method, url, params):
+        offset = params["offset"]
+        if "expired" in params["q"]:
+            return FakeResponse(data={"error": {"status": 401, "message": "The access token expired"}})
+        items = [{"id": str(i).zfill(22), "name": "Come With Me" if i in (120, 130, 700) else f"Song {i}",
+                  "artists": [{"name": "Will Sparks"}]} for i in range(offset, min(offset + params["limit"], 900))]
+        return FakeResponse(data={"tracks": {"items": items, "total": 900}})
+
+    with use_fake_session(search_page) as session:
+        wave = spotify.Settings.SearchConcurrency * spotify.PageLimits.Search
+        found = spotify.find_song(song_name=" come  with me", artist="Will Sparks")
+        assert [f["id"] for f in found] == [str(i).zfill(22) for i in (120, 130)]  # both in the first wave of pages
+        searches = [params for method, url, params in session.calls if method == "GET"]
+        assert sorted(params["offset"] for params in searches) == list(range(0, wave, spotify.PageLimits.Search)), \
+            "Search didn't stop after the first wave with a match"
+        assert spotify.find_song(song_name="Come With Me", artist="will sparks") == found
+        assert len([call for call in session.calls if call[0] == "GET"]) == len(searches), "Search wasn't memoized"
+        every = spotify.find_song(song_name="Come With Me", artist="Will Sparks", all_matches=True)
+        assert [f["id"] for f in every] == [str(i).zfill(22) for i in (120, 130, 700)], "Search didn't find every match"
+        searches = [params for method, url, params in session.calls if method == "GET"]
+        assert sorted(params["offset"] for params in searches[-900 // spotify.PageLimits.Search:]) == \
+            list(range(0, 900, spotify.PageLimits.Search))
+        first = spotify.find_song(song_name="Come With Me", artist="Will Sparks", album=None, first_match=True)
+        assert [f["id"] for f in first] == [str(120).zfill(22)]
+        first_searches = len([call for call in session.calls if call[0] == "GET"]) - len(searches)
+        assert first_searches <= spotify.Settings.SearchConcurrency, "Search didn't stop after the first wave with a match"
+        assert spotify.find_song(song_name="Not A Song") == []
+        calls = len(session.calls)
+        assert spotify.find_song(song_name="Not A Song") == []
+        assert len(session.calls) > calls, "A search that found nothing was memoized"
+        assert spotify.find_song(song_name="Come With Me expired") == []
+        calls = len(session.calls)
+        spotify.find_song(song_name="Come With Me expired")
+        assert len(session.calls) > calls, "A search that failed was memoized"
+
+
+def test_library_crawler(tmp_path):
+    """
+    Tests that the crawler deduplicates tracks, stops at the exact budget, batches fetches, and resumes
+    """
+    from crawler import CrawlOrder, LibraryCrawler
+
+    def recommend(track_id, n):  # every track recommends the next few, so neighbouring tracks overlap heavily
+        start = int(track_id)
+        return [{"id": str(start + i).zfill(22), "popularity": i} for i in range(1, n + 1)]
+
+    fetched = []
+    db_file = str(tmp_path / "crawl.db")
+    crawler = LibraryCrawler("0".zfill(22), recommend, fetch_features=lambda ids: fetched.append(ids) or [], db_file=db_file)
+    crawler.run(max_tracks=7, n=5)
+    library = crawler.get_library()
+    assert len(library) == 7 and len(set(library)) == 7, "Crawler didn't stop at the budget or found duplicates"
+    assert sum(len(batch) for batch in fetched) == 7
+    crawler.close()
+
+    resumed = LibraryCrawler("0".zfill(22), recommend, fetch_features=lambda ids: fetched.append(ids) or [], db_file=db_file)
+    resumed.run(max_tracks=12, n=5)
+    assert resumed.get_library()[:7] == library, "Crawler didn't resume the existing crawl"
+    assert len(set(resumed.get_library())) == 12
+    assert sum(len(batch) for batch in fetched) == 12, "Tracks were fetched more than once"
+    resumed.close()
+
+    by_priority = LibraryCrawler("0".zfill(22), recommend, name="priority", order=CrawlOrder.Priority, db_file=db_file)
+    by_priority.run(max_tracks=8, n=3)
+    assert by_priority.get_library()[3:6] == [str(i).zfill(22) for i in range(4, 7)], \
+        "Most popular track wasn't expanded first"
+    by_priority.close()
+
+
+def test_library_crawler_retries(tmp_path):
+    """
+    Tests that recommendations and features that fail are left pending, and fetched when the crawl is run again
+    """
+    from crawler import LibraryCrawler
+    failures = {"recommend": 1, "features": 1}
+    fetched = []
+
+    def recommend(track_id, n):
+        if failures["recommend"]:
+            failures["recommend"] -= 1
+            raise IOError("Rate limited")
+        start = int(track_id)
+        return [{"id": str(start + i).zfill(22)} for i in range(1, n + 1)]
+
+    def fetch_features(ids):
+        if failures["features"]:
+            failures["features"] -= 1
+            raise IOError("Rate limited")
+        fetched.extend(ids)
+        return []
+
+    db_file = str(tmp_path / "crawl.db")
+    crawler = LibraryCrawler("0".zfill(22), recommend, fetch_features=fetch_features, db_file=db_file)
+    crawler.run(max_tracks=4, n=2)
+    assert crawler.get_library_size() == 0, "Crawl didn't stop when recommendations failed"
+    crawler.close()
+
+    resumed = LibraryCrawler("0".zfill(22), recommend, fetch_features=fetch_features, db_file=db_file)
+    resumed.run(max_tracks=4, n=2)
+    assert resumed.get_library_size() == 4, "Seed track wasn't expanded again after its recommendations failed"
+    assert fetched == [], "Features were marked fetched after failing"
+    resumed.run(max_tracks=4, n=2)
+    assert sorted(fetched) == sorted(resumed.get_library()), "Features that failed weren't fetched again"
+    resumed.close()
+
+
+def test_library_manifest(tmp_path):
+    """
+    Tests that the library manifest finds downloaded songs, only rehashes changed files, and drops deleted ones
+    """
+    import library
+    from library import LibraryManifest
+
+    folder = tmp_path / "songs"
+    (folder / "nested").mkdir(parents=True)
+    (folder / "Will Sparks - Come With Me.m4a").write_bytes(b"song")
+    (folder / "nested" / "Hardwell - Spaceman.m4a").write_bytes(b"other song")
+    (folder / "cover.jpg").write_bytes(b"not a song")
+    track = {"id": "1".zfill(22), "name": "Come With Me", "artists": [{"name": "Will Sparks"}]}
+    missing = {"id": "2".zfill(22), "name": "Not Downloaded", "artists": [{"name": "Will Sparks"}]}
+
+    manifest = LibraryManifest(db_file=str(tmp_path / "library.db"))
+    assert manifest.scan(str(folder)) == 2, "Scan didn't find exactly the audio files"
+    assert manifest.has_track(track, str(folder)) and not manifest.has_track(missing, str(folder))
+    assert manifest.has_track(track["id"]), "Track id wasn't linked to its file"
+    manifest.close()
+
+    hashed = []
+    get_file_hash = library.get_file_hash
+    library.get_file_hash = lambda path: hashed.append(path) or get_file_hash(path)
+    try:
+        (folder / "nested" / "Hardwell - Spaceman.m4a").unlink()
+        reloaded = LibraryManifest(db_file=str(tmp_path / "library.db"))
+        assert reloaded.has_track(track["id"]), "Manifest wasn't kept between runs"
+        assert reloaded.scan(str(folder)) == 1 and hashed == [], "Unchanged files were hashed again"
+        (folder / "Will Sparks - Come With Me.m4a").write_bytes(b"remastered song")
+        reloaded.scan(str(folder))
+        assert len(hashed) == 1, "Changed file wasn't hashed again"
+        reloaded.close()
+    finally:
+        library.get_file_hash = get_file_hash
+
+
+def test_download_scheduler(tmp_path):
+    """
+    Tests that the download scheduler dedupes tracks across sources, never runs more transfers than its limit,
+    and reports a result for each track as it finishes
+    """
+    import threading
+    import time
+    import spotify
+    from downloads import DownloadScheduler, DownloadStatus
+    from library import LibraryManifest, normalize_path
+    from standin import FixtureStore
+
+    active, peak, downloaded = [0], [0], []
+    lock = threading.Lock()
+
+    def transfer(track_id):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            downloaded.append(track_id)
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        if track_id == failing:
+            raise ConnectionError("Transfer failed")
+        path = tmp_path / f"{track_id}.m4a"
+        path.write_bytes(b"song")
+        return None, path
+
+    previous = LibraryManifest._instance
+    LibraryManifest._instance = LibraryManifest(db_file=str(tmp_path / "library.db"))
+    try:
+        with use_stand_in(fixtures=FixtureStore(playlist_size=30, album_size=5, artist_albums=4), latency=0.01):
+            playlist = [item["track"]["id"] for item in spotify.get_playlist_tracks("0".zfill(22))]
+            albums = spotify.get_albums_tracks([album["id"] for album in spotify.get_artist_albums("1".zfill(22))])
+            expected = set(playlist) | {track["id"] for album in albums for track in album}
+            failing = playlist[1]
+            reported = []
+            scheduler = DownloadScheduler(threads=3, custom_folder=str(tmp_path), on_result=reported.append)
+            assert LibraryManifest._instance.scanned == {normalize_path(str(tmp_path))}, "The folder wasn't scanned"
+            scheduler.transfer = transfer
+            results = scheduler.run([f"https://open.spotify.com/playlist/{'0'.zfill(22)}", f"spotify:playlist:{'0'.zfill(22)}",
+                                     playlist[0], f"https://open.spotify.com/artist/{'1'.zfill(22)}"])
+
+            again = DownloadScheduler(threads=3, custom_folder=str(tmp_path))
+            again.transfer = transfer
+            again.add(playlist[0])
+            again.add(failing)
+            retried = list(again.iter_results())
+            again.close()
+    finally:
+        LibraryManifest._instance.close()
+        LibraryManifest._instance = previous
+    assert len(downloaded) == len(set(downloaded)) + 1, "A track was downloaded more than once"
+    assert set(downloaded) == expected and scheduler.get_throughput()["queued"] == len(expected)
+    assert peak[0] == 3, "Transfers weren't run concurrently up to the limit"
+    assert sorted(result.track_id for result in reported) == sorted(result.track_id for result in results)
+    statuses = {result.track_id: result.status for result in results}
+    assert statuses[failing] == DownloadStatus.Failed and list(statuses.values()).count(DownloadStatus.Failed) == 1
+    assert all(result.size == 4 and result.path for result in results if result.track_id != failing)
+    assert {result.track_id: result.status for result in retried} == \
+        {playlist[0]: DownloadStatus.Skipped, failing: DownloadStatus.Failed}
+
+
+def test_ingest_pipeline(tmp_path):
+    """
+    Tests that the ingest pipeline analyzes and saves songs as they arrive, applies backpressure, and skips analyzed songs
+    """
+    import threading
+    import time
+    import numpy as np
+    from database import FeaturesDatabase
+    from downloads import DownloadResult, DownloadStatus
+    from ingest import IngestPipeline
+    from library import normalize_path
+
+    previous = FeaturesDatabase._instance
+    FeaturesDatabase._instance = None
+    database = FeaturesDatabase(db_file=str(tmp_path / "ingest.db"))
+    FeaturesDatabase._instance = previous
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def analyze_file(file_name):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        if file_name == "broken.m4a":
+            raise ValueError("Unable to decode")
+        return {"file_name": file_name, "tempo": 128.0, "beats": np.arange(4) * 0.5, "duration": 2.0}
+
+    with IngestPipeline(workers=2, queue_size=1, fetch_features=False, database=database,
+                        analyze_file=analyze_file) as pipeline:
+        for i in range(10):
+            pipeline.submit(DownloadResult(str(i).zfill(22), DownloadStatus.Downloaded, f"song {i}.m4a"))
+            assert pipeline.counts["submitted"] - pipeline.counts["analyzed"] - pipeline.counts["failed"] <= 1 + 2 + 1, \
+                "Submitting didn't wait for the analysis workers"
+        pipeline.submit(DownloadResult("1".zfill(22), DownloadStatus.Failed))
+        pipeline.submit(DownloadResult(None, DownloadStatus.Downloaded, "broken.m4a"))
+    assert pipeline.counts["stored"] == 10 and pipeline.counts["failed"] == 1 and peak[0] == 2
+    saved = database.get_analysis_from_file_name("song 3.m4a")
+    assert saved["id"] == "3".zfill(22) and saved["tempo"] == 128.0 and list(saved["beats"]) == [0, 0.5, 1, 1.5]
+    assert saved["file_name"] == normalize_path("song 3.m4a")
+
+    with IngestPipeline(workers=1, fetch_features=False, database=database, analyze_file=analyze_file) as again:
+        again.submit(DownloadResult("3".zfill(22), DownloadStatus.Skipped, os.path.abspath("song 3.m4a")))
+    assert again.counts["skipped"] == 1 and again.counts["submitted"] == 0, "Analyzed song was analyzed again"
+    database.close_db()
+
+
+def test_decode_once(tmp_path):
+    """
+    Tests that audio is decoded once at its own sample rate, and shared with pydub and librosa without decoding again
+    """
+    import shutil
+    import subprocess
+    import numpy as np
+    from librosa import load
+    from analyze import load_analysis
+    from decode import DecodedAudio, load_audio, probe_audio
+
+    if not shutil.which("ffmpeg"):
+        Logger.write("Ffmpeg is not installed, skipping decode test")
+        return
+    file_name = str(tmp_path / "sine.wav")
+    subprocess.check_call(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=1.5",
+                           "-af", "pan=stereo|c0=c0|c1=0.5*c0", "-ar", "22050", file_name])
+    info = probe_audio(file_name)
+    assert (info.sample_rate, info.channels) == (22050, 2) and abs(info.duration - 1.5) < 0.01
+    decoded = load_audio(file_name, info)
+    assert decoded.samples.shape == (33075, 2) and decoded.to_audio_segment().raw_data is decoded.pcm, "Pcm was copied"
+    y, sr = load_analysis(file_name, decoded)
+    expected, expected_sr = load(file_name, sr=None)
+    assert sr == expected_sr and y.dtype == np.float32 and np.allclose(y, expected, atol=1e-4)
+    from_segment = load_analysis(file_name, decoded.to_audio_segment())
+    assert np.array_equal(from_segment[0], y)
+    assert DecodedAudio.from_audio_segment(decoded.to_audio_segment()).pcm is decoded.pcm
+
+
+def test_partial_decode(tmp_path, monkeypatch):
+    """
+    Tests that windows are decoded by ffmpeg straight to float32, seeking so the rest of the file is never decoded
+    """
+    import numpy as np
+    import soundfile
+    import cache
+    import decode
+    import merge
+
+    sr = 22050
+    song = np.random.default_rng(0).uniform(-0.5, 0.5, sr * 20).astype(np.float32)
+    file_name = str(tmp_path / "song.wav")
+    soundfile.write(file_name, song, sr, subtype="FLOAT")
+    window = decode.load_samples(file_name, offset=5, duration=2)
+    assert window.dtype == np.float32 and window.shape == (sr * 2,)
+    assert np.allclose(window, song[sr * 5:sr * 7], atol=1e-6), "Window wasn't where it was seeked to"
+    stereo = decode.load_samples(file_name, channels=2, sample_rate=11025, offset=18)
+    assert stereo.shape == (11025 * 2, 2)
+    grown = decode.read_pcm(decode.get_decode_command(file_name, "f32le", sr, 1), expected_bytes=1000)
+    assert np.array_equal(grown.view(np.float32), decode.load_samples(file_name)), "Buffer didn't grow past the expected size"
+
+    decodes = []
+    load_audio = decode.load_audio
+    monkeypatch.setattr(cache, "load_audio", lambda *args: decodes.append(args) or load_audio(*args))
+    assert abs(len(merge.get_beginning(file_name, 3000)) - 3000) <= 1 and abs(len(merge.get_end(file_name, -4000)) - 4000) <= 1
+    assert len(merge.get_end(file_name, 15000)) == 5000
+    assert all(args[4] or args[5] for args in decodes), "A whole song was decoded for a window"
+    y, rate = cache.open_librosa(file_name, offset=5, duration=2)
+    assert rate == sr and np.allclose(y, window, atol=1e-4) and len(decodes) == 3
+    cache.open_audio(file_name)
+    y, _ = cache.open_librosa(file_name, offset=5, duration=2)
+    assert len(decodes) == 4 and np.allclose(y, window, atol=1e-4), "A window of a cached song was decoded again"
+
+
+def test_analysis_cache(tmp_path):
+    """
+    Tests that analysis results are keyed by file contents and parameters, skip librosa on a hit, and are evicted by age
+    """
+    import shutil
+    import time
+    import numpy as np
+    import soundfile
+    import analyze
+    from cache import AnalysisCache
+
+    sr = 22050
+    clicks = np.zeros(sr * 6, dtype=np.float32)
+    for start in range(0, len(clicks), sr // 2):  # 120 bpm
+        clicks[start:start + 200] = 0.8
+    file_name = str(tmp_path / "clicks.wav")
+    soundfile.write(file_name, clicks, sr)
+
+    previous = AnalysisCache._instance
+    AnalysisCache._instance = cache = AnalysisCache(folder=str(tmp_path / "cache"))
+    compute = analyze.compute_tempo_analysis
+    try:
+        analysis = analyze.get_tempo_analysis(file_name)
+        assert abs(analysis["tempo"] - 120) < 3 and cache.misses == 1
+
+        def no_librosa(audio_data):
+            raise AssertionError("librosa ran on a cached file")
+        analyze.compute_tempo_analysis = no_librosa
+        shutil.copy(file_name, tmp_path / "renamed.wav")
+        for cached in (analyze.get_tempo_analysis(file_name), analyze.get_tempo_analysis(str(tmp_path / "renamed.wav"))):
+            assert cached["tempo"] == analysis["tempo"] and np.array_equal(cached["beats"], analysis["beats"])
+            assert np.array_equal(cached["onset_env"], analysis["onset_env"]) and cached["duration"] == 6
+        assert cache.hits == 2
+        assert cache.load(cache.get_key(file_name, sr, dict(analyze.TempoParameters, hop_length=256))) is None
+
+        cache.max_size = cache.size * 2.5
+        scan, scans = cache.scan, []
+        cache.scan = lambda: scans.append(1) or scan()
+        for i in range(3):
+            time.sleep(0.01)
+            cache.save(f"key{i}", beats=np.arange(1))
+        assert not scans, "The cache folder was scanned while under its size"
+        cache.save("big", beats=np.random.rand(1000))
+        assert cache.size <= cache.max_size and cache.load("key0") is None, "Least recently used result wasn't evicted"
+    finally:
+        analyze.compute_tempo_analysis = compute
+        AnalysisCache._instance = previous
+
+
+def test_pcm_cache(tmp_path, monkeypatch):
+    """
+    Tests that decoded songs are memory-mapped on a hit, invalidated when the file changes, and evicted by age,
+    counting the songs other processes cached, and that a cache that only reads doesn't cache songs
+    """
+    import os
+    import time
+    import numpy as np
+    import soundfile
+    import cache
+    from decode import load_audio
+
+    sr = 22050
+    song = np.random.default_rng(0).uniform(-0.5, 0.5, (sr * 4, 2)).astype(np.float32)
+    file_name = str(tmp_path / "song.wav")
+    soundfile.write(file_name, song, sr)
+    pcm_cache = cache.PcmCache(folder=str(tmp_path / "pcm"))
+    monkeypatch.setattr(cache.PcmCache, "_instance", pcm_cache)
+    decodes = []
+    monkeypatch.setattr(cache, "load_audio", lambda *args: decodes.append(args) or load_audio(*args))
+
+    decoded = cache.open_audio(file_name)
+    assert len(decodes) == 1 and pcm_cache.misses == 1 and isinstance(decoded.pcm, np.memmap)
+    reopened = cache.open_audio(file_name)
+    assert len(decodes) == 1 and pcm_cache.hits == 1, "A cached song was decoded again"
+    assert np.array_equal(reopened.samples, load_audio(file_name).samples)
+    assert len(reopened.to_audio_segment()) == 4000 and reopened.to_mono_float().shape == (sr * 4,)
+    section = cache.open_audio(file_name, offset=1, duration=2)
+    assert len(decodes) == 1 and np.array_equal(section.samples, reopened.samples[sr:sr * 3]), \
+        "Section wasn't cut from the cache"
+    cache.open_audio(file_name, sample_rate=11025, channels=1, offset=1, duration=2)
+    assert len(decodes) == 2 and len(pcm_cache.sizes) == 1, "A section of an uncached song was cached"
+    stale = next(iter(pcm_cache.sizes))
+
+    time.sleep(0.01)
+    soundfile.write(file_name, song[:sr], sr)  # changed, so the cached song is stale
+    assert cache.open_audio(file_name).duration == 1 and len(decodes) == 3
+    changed = next(path for path in pcm_cache.sizes if path != stale)
+    with open(changed, "r+b") as f:
+        f.truncate(100)
+    assert cache.open_audio(file_name).duration == 1 and len(decodes) == 4, "A truncated song was mapped"
+
+    os.utime(stale, (time.time() - 60, time.time() - 60))
+    pcm_cache.max_size = pcm_cache.size  # the next song pushes the least recently used one out
+    other = str(tmp_path / "other.wav")
+    soundfile.write(other, song[sr:sr * 2], sr)
+    cache.open_audio(other)
+    assert not os.path.exists(stale) and os.path.exists(changed) and pcm_cache.size <= pcm_cache.max_size
+
+    pcm_cache.clear()
+    songs = []
+    for i in range(4):
+        songs.append(str(tmp_path / f"song {i}.wav"))
+        soundfile.write(songs[-1], song[sr * i:sr * (i + 1)], sr)
+    song_size = cache.PcmHeader.size + sr * 4
+    monkeypatch.setattr(cache.Settings, "CacheScanWrites", 2)
+    first, second = [cache.PcmCache(folder=str(tmp_path / "pcm"), max_size=int(song_size * 2.5)) for _ in range(2)]
+    first.open(songs[0])  # as if in two processes, which each only see the other's songs in the folder
+    second.open(songs[1])
+    second.open(songs[2])
+    on_disk = [entry.stat().st_size for entry in os.scandir(tmp_path / "pcm") if entry.name.endswith(".pcm")]
+    assert len(on_disk) == 2 and sum(on_disk) <= second.max_size, "Songs another process cached weren't counted"
+    monkeypatch.setattr(cache.PcmCache, "_instance", cache.PcmCache(folder=str(tmp_path / "pcm"), store=False))
+    assert len(cache.open_audio(songs[3]).to_audio_segment()) == 1000
+    assert cache.open_librosa(songs[3])[0].shape == (sr,)
+    assert len(os.listdir(tmp_path / "pcm")) == 2, "A worker that only reads the cache cached a decoded song"
+
+
+def test_stream_analysis(tmp_path):
+    """
+    Tests that long files are analyzed in bounded blocks which line up with the in-memory analysis
+    """
+    import numpy as np
+    import soundfile
+    import analyze
+    import decode
+    from cache import AnalysisCache
+    from utilities import Settings
+
+    sr = 22050
+    clicks = np.zeros(sr * 60, dtype=np.float32)
+    for start in range(0, len(clicks), sr // 2):  # 120 bpm
+        clicks[start:start + 200] = 0.8
+    file_name = str(tmp_path / "mix.wav")
+    soundfile.write(file_name, clicks, sr)
+
+    blocks = list(decode.stream_audio(file_name, 10000, overlap=1000))
+    assert max(len(block) for block in blocks) == 10000
+    written, _ = soundfile.read(file_name, dtype="float32")
+    assert np.array_equal(np.concatenate([blocks[0]] + [block[1000:] for block in blocks[1:]]), written)
+
+    previous = AnalysisCache._instance, Settings.StreamBlockSeconds, Settings.StreamMinDuration
+    AnalysisCache._instance = AnalysisCache(folder=str(tmp_path / "cache"))
+    Settings.StreamBlockSeconds, Settings.StreamMinDuration = 5, 30
+    compute = analyze.compute_tempo_analysis
+    try:
+        expected = compute((clicks, sr))
+
+        def no_decode(audio_data):
+            raise AssertionError("a long file was decoded whole")
+        analyze.compute_tempo_analysis = no_decode
+        streamed = analyze.get_tempo_analysis(file_name)
+        assert streamed["tempo"] == expected["tempo"] and streamed["duration"] == 60
+        assert np.allclose(streamed["beats"], expected["beats"])
+        assert abs(len(streamed["onset_env"]) - len(expected["onset_env"])) <= 1
+        assert len(streamed["rms"]) >= len(expected["onset_env"]) - 2
+    finally:
+        analyze.compute_tempo_analysis = compute
+        AnalysisCache._instance, Settings.StreamBlockSeconds, Settings.StreamMinDuration = previous
+
+
+def test_analysis_profiles(tmp_path):
+    """
+    Tests that analysis profiles resample, mix down and window while decoding, and are kept apart in the analysis cache
+    """
+    import numpy as np
+    import pytest
+    import soundfile
+    import analyze
+    from cache import AnalysisCache
+    from utilities import AnalysisProfiles
+
+    sr = 44100
+    clicks = np.zeros((sr * 30, 2), dtype=np.float32)
+    for start in range(0, len(clicks), sr // 2):  # 120 bpm
+        clicks[start:start + 400] = 0.8
+    file_name = str(tmp_path / "stereo.wav")
+    soundfile.write(file_name, clicks, sr)
+
+    y, rate = analyze.load_analysis(file_name, profile=dict(AnalysisProfiles.Fast, duration=10))
+    assert rate == 11025 and y.ndim == 1 and len(y) == 10 * 11025
+    assert analyze.get_analysis_offset(30, AnalysisProfiles.Standard) == 0
+    assert analyze.get_analysis_offset(200, AnalysisProfiles.Fast) == 55
+    with pytest.raises(ValueError):
+        AnalysisProfiles.get("slow")
+
+    previous = AnalysisCache._instance
+    AnalysisCache._instance = cache = AnalysisCache(folder=str(tmp_path / "cache"))
+    try:
+        results = {name: analyze.get_tempo_analysis(file_name, profile=name) for name in ("fast", "standard", "full")}
+        assert cache.misses == 3, "Profiles shared a cache key"
+        for analysis in results.values():
+            assert abs(analysis["tempo"] - 120) < 5 and analysis["duration"] == 30
+        windowed = analyze.get_tempo_analysis(file_name, profile=dict(AnalysisProfiles.Fast, duration=10))
+        assert windowed["beats"].min() >= 10 and windowed["beats"].max() <= 20 and windowed["duration"] == 30
+        full = analyze.get_tempo_analysis(file_name, analyze.load_analysis(file_name), profile="full")
+        assert cache.hits == 1 and np.array_equal(full["beats"], results["full"]["beats"])
+    finally:
+        AnalysisCache._instance = previous
+
+
+def test_find_sections(tmp_path, monkeypatch):
+    """
+    Tests that the intro and outro are found on the beat where the energy changes, and are saved with the analysis,
+    but not from a windowed analysis that can't see them
+    """
+    import sqlite3
+    import time
+    import numpy as np
+    import soundfile
+    import analyze
+    from cache import AnalysisCache
+    from database import FeaturesDatabase
+    from utilities import Settings
+
+    sr = 22050
+    noise = np.random.default_rng(0)
+
+    def section(seconds, level, hiss):  # 120 bpm kicks over noise
+        y = np.zeros(sr * seconds, dtype=np.float32)
+        for start in range(0, len(y), sr // 2):
+            y[start:start + 2000] += level * np.exp(-np.arange(2000) / 300)
+        return y + hiss * noise.standard_normal(len(y)).astype(np.float32)
+    song = np.concatenate([section(16, 0.2, 0.005), section(64, 0.8, 0.1), section(16, 0.2, 0.005)])
+    analysis = analyze.compute_tempo_analysis((song, sr))
+    start = time.perf_counter()
+    sections = analyze.find_sections(analysis)
+    assert time.perf_counter() - start < 0.1, "Finding sections from cached features was slow"
+    assert abs(sections["intro_ms"] - 16000) < 1000 and abs(sections["outro_ms"] - 80000) < 1000
+    assert np.isclose(analysis["beats"] * 1000, sections["intro_ms"], atol=1).any(), "Intro wasn't on a beat"
+    assert -20 < sections["avg_db"] < -10
+    assert analyze.find_intro_ms(analysis) == sections["intro_ms"] and analyze.get_avg_db(analysis) == sections["avg_db"]
+    flat = analyze.find_sections((section(40, 0.5, 0.01), sr))
+    assert flat["intro_ms"] < 1000 and flat["outro_ms"] == 40000, "Found sections in a song without any"
+
+    file_name = str(tmp_path / "song.wav")
+    soundfile.write(file_name, song, sr)
+    previous = AnalysisCache._instance
+    AnalysisCache._instance = AnalysisCache(folder=str(tmp_path / "cache"))
+    try:
+        fast = analyze.analyze_file(file_name, profile="fast")  # a 90 second window of the 96 second song
+        assert fast["intro_ms"] is None and fast["outro_ms"] is None and fast["duration"] == 96
+        assert -20 < fast["avg_db"] < -10
+        monkeypatch.setattr(Settings, "AnalysisProfile", "fast")
+        whole = analyze.find_sections(file_name)
+        assert abs(whole["intro_ms"] - 16000) < 1000 and abs(whole["outro_ms"] - 80000) < 1000
+    finally:
+        AnalysisCache._instance = previous
+
+    con = sqlite3.connect(str(tmp_path / "old.db"))  # a database from before sections were saved
+    con.execute("Create Table Analysis (id Varchar(32), file_name VarChar(128) UNIQUE, tempo Real, beats Blob, duration Real)")
+    con.execute("Insert into Analysis values (?, ?, ?, ?, ?)", (None, "songs/old.m4a", 120.0, b"", 96.0))
+    con.commit()
+    con.close()
+    previous = FeaturesDatabase._instance
+    FeaturesDatabase._instance = None
+    database = FeaturesDatabase(db_file=str(tmp_path / "old.db"))
+    FeaturesDatabase._instance = previous
+    assert database.get_analyzed_file_names() == {os.path.abspath("songs/old.m4a")}, "Older file names weren't normalized"
+    database.save_analysis_to_db([dict(sections, file_name="song.m4a", tempo=120.0, beats=analysis["beats"], duration=96.0)])
+    saved = database.get_analysis_from_file_name(os.path.abspath("song.m4a"))
+    assert saved["intro_ms"] == sections["intro_ms"] and saved["outro_ms"] == sections["outro_ms"]
+    database.close_db()
+
+
+def test_find_drops(tmp_path, monkeypatch):
+    """
+    Tests that drops, breakdowns and build-ups are found where the bass comes in and drops out, that a transition
+    lines the next song's drop up with the end of the last and fades over the planned overlap, and that a folder is
+    searched for drops in worker processes
+    """
+    import numpy as np
+    import soundfile
+    from pydub import AudioSegment
+    import analyze
+    import merge
+    from cache import AnalysisCache
+
+    sr = 22050
+    noise = np.random.default_rng(0)
+    kick = np.sin(2 * np.pi * 55 * np.arange(4000) / sr) * np.exp(-np.arange(4000) / 1500)
+
+    def section(seconds, bass, hiss, rolls=0.0):  # 120 bpm, with bass kicks, off beat hats and rising snare rolls
+        y = np.zeros(sr * seconds, dtype=np.float32)
+        for start in range(0, len(y), sr // 2):
+            y[start:start + 4000] += bass * kick[:len(y) - start]
+            y[start + sr // 4:start + sr // 4 + 500] += 0.1 * noise.standard_normal(500) * np.exp(-np.arange(500) / 100)
+        for start in range(0, len(y) - 300, sr // 8):
+            y[start:start + 300] += rolls * start / len(y) * noise.standard_normal(300)
+        return y + hiss * noise.standard_normal(len(y)).astype(np.float32)
+    song = np.concatenate([section(32, 0.3, 0.01), section(32, 0.9, 0.05), section(16, 0, 0.01), section(16, 0, 0.02, 0.2),
+                           section(32, 0.9, 0.05), section(16, 0.3, 0.01)])
+    events = analyze.find_drops(analyze.compute_tempo_analysis((song, sr)))
+    drops = [event["ms"] for event in events if event["type"] == "drop"]
+    breakdowns = [event["ms"] for event in events if event["type"] == "breakdown"]
+    buildups = [event["ms"] for event in events if event["type"] == "buildup"]
+    assert len(drops) == 2 and abs(drops[0] - 32000) < 2000 and abs(drops[1] - 96000) < 2000, "Drops weren't within a bar"
+    assert len(breakdowns) == 2 and abs(breakdowns[0] - 64000) < 2000 and abs(breakdowns[1] - 128000) < 2000
+    assert len(buildups) == 1 and 80000 <= buildups[0] < drops[1]
+    assert all(0 < event["confidence"] < 1 for event in events)
+    assert analyze.find_drops((section(40, 0.5, 0.01), sr)) == [], "Found drops in a song without any"
+
+    source, target = str(tmp_path / "source.wav"), str(tmp_path / "target.wav")
+    soundfile.write(source, song, sr)
+    soundfile.write(target, song[sr * 16:], sr)  # the drop is 16 seconds in
+    previous = AnalysisCache._instance
+    AnalysisCache._instance = AnalysisCache(folder=str(tmp_path / "cache"))
+    try:
+        plan = merge.plan_transition(source, target)
+    finally:
+        AnalysisCache._instance = previous
+    assert abs(plan["target_drop"] - 16000) < 2000 and abs(plan["speed"] - 1) < 0.01
+    assert plan["position"] >= breakdowns[1] and plan["target_start"] + plan["fade"] == plan["target_drop"]
+    assert abs(plan["position"] + plan["fade"] - 144000) < 50, "The target's drop didn't land as the source ended"
+
+    exported, crossfades = [], []
+    append = AudioSegment.append
+    monkeypatch.setattr(merge, "plan_transition", lambda *args: dict(plan, fade=plan["fade"] // 2))
+    monkeypatch.setattr(merge, "export", lambda audio, out_file: exported.append(audio) or out_file)
+    monkeypatch.setattr(AudioSegment, "append", lambda self, seg, crossfade=100: crossfades.append(crossfade) or
+                        append(self, seg, crossfade=crossfade))
+    merge.transition(source, target)
+    assert crossfades == [plan["fade"] // 2], "The transition didn't fade over the planned overlap"
+    assert abs(len(exported[0]) - (plan["position"] + len(song) * 1000 // sr - 16000 - plan["target_start"])) < 50
+
+    monkeypatch.chdir(tmp_path)  # the workers keep their analysis cache in the working directory
+    os.makedirs("songs")
+    soundfile.write("songs/song.wav", song, sr)
+    with open("songs/broken.wav", "wb") as f:
+        f.write(b"not audio")
+    library_drops = analyze.find_library_drops("songs", workers=1)
+    assert list(library_drops) == [os.path.join("songs", "song.wav")], "A song that can't be decoded wasn't skipped"
+    found = [event["ms"] for event in library_drops[os.path.join("songs", "song.wav")] if event["type"] == "drop"]
+    assert len(found) == 2 and abs(found[0] - 32000) < 2000 and abs(found[1] - 96000) < 2000
+
+
+def test_beat_grid(tmp_path, monkeypatch):
+    """
+    Tests that downbeats and phrases are found where the sections change, and that the grid is cached for beat-aligned edits
+    """
+    import numpy as np
+    import soundfile
+    from pydub import AudioSegment
+    import analyze
+    import merge
+    from cache import AnalysisCache
+
+    sr = 22050
+    noise = np.random.default_rng(1)
+
+    def section(seconds, level, hiss):  # 120 bpm kicks over noise
+        y = np.zeros(int(sr * seconds), dtype=np.float32)
+        for start in range(0, len(y), sr // 2):
+            y[start:start + 2000] += level * np.exp(-np.arange(min(2000, len(y) - start)) / 300)
+        return y + hiss * noise.standard_normal(len(y)).astype(np.float32)
+    sections = [section(16, level, hiss) for level, hiss in [(0.2, 0.005), (0.8, 0.1)] * 4]
+    song = np.concatenate([section(1.5, 0.2, 0.005)] + sections)  # a pickup of three beats, then 8 bar sections
+    grid = analyze.estimate_beat_grid(analyze.compute_tempo_analysis((song, sr)))
+    assert np.allclose(np.diff(grid.downbeats), 4) and abs(grid.downbeat_times[0] - 1.5) < 0.1, "Downbeats weren't on the bar"
+    assert np.allclose(grid.get_phrase_times(8) - 1.5, np.arange(len(grid.phrases[8])) * 16, atol=0.1)
+    assert abs(grid.nearest_downbeat(18.2) - 17.5) < 0.1 and abs(grid.nearest_phrase(24, bars=8) - 17.5) < 0.1
+    assert abs(grid.nearest_beat(18.2) - 18) < 0.1 and grid.get_bar(0.5) == -1 and grid.get_bar(18) == 8
+    assert abs(grid.next_downbeat(17.6) - 19.5) < 0.1 and grid.next_downbeat(200) is None
+    nearest = analyze.BeatGrid.get_nearest(grid.downbeat_times, np.array([0, 18.2, 500]))
+    assert np.array_equal(nearest, [0, 8, len(grid.downbeats) - 1])
+
+    file_name = str(tmp_path / "song.wav")
+    soundfile.write(file_name, song, sr)
+    previous = AnalysisCache._instance
+    AnalysisCache._instance = cache = AnalysisCache(folder=str(tmp_path / "cache"))
+    try:
+        cached = analyze.get_beat_grid(file_name)
+        misses = cache.misses
+        again = analyze.get_beat_grid(file_name)
+        assert cache.misses == misses and np.array_equal(again.beats, cached.beats)
+        assert again.phrases.keys() == cached.phrases.keys()
+        audio = AudioSegment.from_file(file_name)
+        before, after = merge.cut_on_beat(audio, file_name, 18200)
+        assert abs(len(before) - 17500) < 100 and len(before) + len(after) == len(audio)
+        assert abs(len(merge.loop_bars(audio, file_name, 18200, bars=2, repeats=3)) - 12000) < 300
+        assert abs(merge.snap_to_grid(file_name, 30000, bars=8) - 33500) < 100
+        monkeypatch.setattr(analyze, "estimate_beat_grid", None)  # sections and drops of a file are found on its cached grid
+        analyze.find_sections(file_name)
+        analyze.find_drops(file_name)
+    finally:
+        AnalysisCache._instance = previous
+
+
+def test_loudness(tmp_path):
+    """
+    Tests integrated loudness against the BS.1770 reference tones, that silence is gated out, and that results are cached
+    """
+    import numpy as np
+    import soundfile
+    import analyze
+    from cache import AnalysisCache
+    from decode import DecodedAudio
+
+    sr = 48000
+    tone = np.sin(2 * np.pi * 997 * np.arange(sr * 10) / sr)
+    full_scale = DecodedAudio((tone * 32767).astype(np.int16).tobytes(), sr, 1)
+    assert abs(analyze.compute_loudness(full_scale)["integrated"] + 3.01) < 0.1
+    quiet = np.repeat((tone * 0.1 * 32767).astype(np.int16)[:, None], 2, axis=1)
+    loudness = analyze.compute_loudness(DecodedAudio(quiet.tobytes(), sr, 2))
+    assert abs(loudness["integrated"] + 20) < 0.1 and np.allclose(loudness["short_term"], -20, atol=0.1)
+    assert len(loudness["short_term"]) == 71 and loudness["step"] == 0.1
+    padded = np.concatenate([np.zeros_like(quiet), quiet, np.zeros_like(quiet)])
+    gated = analyze.compute_loudness(DecodedAudio(padded.tobytes(), sr, 2))
+    # blocks straddling an edge still count
+    assert abs(gated["integrated"] - loudness["integrated"]) < 0.25, "Silence wasn't gated out"
+    assert gated["short_term"].min() == -70
+
+    file_name = str(tmp_path / "tone.wav")
+    soundfile.write(file_name, quiet, sr)
+    previous = AnalysisCache._instance
+    AnalysisCache._instance = cache = AnalysisCache(folder=str(tmp_path / "cache"))
+    try:
+        first = analyze.get_loudness(file_name)
+        again = analyze.get_loudness(file_name)
+        assert cache.hits == 1 and again["integrated"] == first["integrated"] == loudness["integrated"]
+    finally:
+        AnalysisCache._instance = previous
+
+
+def test_detect_key(tmp_path):
+    """
+    Tests that chord progressions are given their key and mode, and that only the middle of a song is decoded
+    """
+    import numpy as np
+    import soundfile
+    import analyze
+    from cache import AnalysisCache
+
+    sr = 22050
+
+    def chords(*notes):  # two seconds of each chord, notes in semitones from middle C
+        t = np.arange(sr * 2) / sr
+        return np.concatenate([sum(np.sin(2 * np.pi * 440 * 2 ** ((n - 9) / 12) * t) for n in chord) / len(chord)
+                               for chord in notes]).astype(np.float32)
+    a_minor = chords([9, 12, 16], [2, 5, 9], [4, 8, 11], [9, 12, 16], [9, 11, 12, 14, 16, 17, 19])
+    g_major = chords([7, 11, 14], [0, 4, 7], [2, 6, 9], [7, 11, 14], [7, 9, 11, 12, 14, 16, 18])
+    detected = analyze.detect_key((a_minor, sr))
+    assert detected["key"] == 9 and detected["mode"] == 0 and detected["confidence"] > 0.5
+    assert analyze.detect_key((g_major, sr))["key"] == 7 and analyze.detect_key((g_major, sr))["mode"] == 1
+    assert analyze.detect_key((np.zeros(sr, dtype=np.float32), sr))["key"] == -1
+
+    file_name = str(tmp_path / "song.wav")
+    soundfile.write(file_name, np.concatenate([g_major, g_major, a_minor, g_major, g_major]), sr)  # a minor in the middle
+    previous = AnalysisCache._instance
+    AnalysisCache._instance = cache = AnalysisCache(folder=str(tmp_path / "cache"))
+    try:
+        assert analyze.get_key(file_name, window=8)["key"] == 9
+        assert analyze.get_key(file_name, window=8) == analyze.get_key(file_name, window=8) and cache.hits == 2
+        assert analyze.get_key(file_name, window=0)["key"] == 7
+    finally:
+        AnalysisCache._instance = previous
+
+
+def test_feature_extractor(monkeypatch):
+    """
+    Tests that every feature comes from one transform and matches what the separate librosa calls give
+    """
+    import librosa
+    import numpy as np
+    import pytest
+    import analyze
+
+    sr = 22050
+    y = 0.1 * np.random.default_rng(0).standard_normal(sr * 10).astype(np.float32)
+    y[::sr // 2] += 1  # 120 bpm clicks
+    stft, calls = librosa.stft, []
+    monkeypatch.setattr(librosa, "stft", lambda *args, **kwargs: calls.append(1) or stft(*args, **kwargs))
+    features = analyze.FeatureExtractor().extract((y, sr))
+    assert len(calls) == 1, "The spectrogram was computed more than once"
+    frames = len(features["onset_env"])
+    for name in ("rms", "centroid", "flux"):
+        assert features[name].shape == (frames,)
+    assert features["chroma"].shape == (12, frames) and features["harmonic"].shape == features["percussive"].shape
+    monkeypatch.setattr(librosa, "stft", stft)
+    assert np.allclose(features["onset_env"], librosa.onset.onset_strength(y=y, sr=sr, aggregate=np.median))
+    assert np.allclose(features["centroid"], librosa.feature.spectral_centroid(y=y, sr=sr)[0], rtol=1e-4)
+    assert abs(features["tempo"] - 120) < 5
+
+    only = analyze.FeatureExtractor(["tempo"]).extract((y, sr))
+    assert set(only) == {"onset_env", "tempo", "beats", "frame_rate", "duration"}
+    with pytest.raises(AssertionError):
+        analyze.FeatureExtractor(["loudness"])
+
+
+def test_vocal_separation(tmp_path, monkeypatch):
+    """
+    Tests that the repetition filter is chunked to match the whole-track filter, cached, and shared across a parameter sweep
+    """
+    import librosa
+    import numpy as np
+    import soundfile
+    import analyze
+    from cache import AnalysisCache
+    from utilities import Settings
+
+    monkeypatch.chdir(tmp_path)
+    sr = 22050
+    loop = 0.1 * np.random.default_rng(0).standard_normal(sr).astype(np.float32)
+    song = np.tile(loop, 18) + 0.2 * np.sin(2 * np.pi * 440 * np.arange(sr * 18) / sr).astype(np.float32)
+    soundfile.write("song.wav", song, sr)
+    magnitude = np.abs(librosa.stft(song))
+    whole = np.minimum(magnitude, librosa.decompose.nn_filter(magnitude, aggregate=np.median, metric="cosine",
+                                                              width=int(librosa.time_to_frames(1, sr=sr))))
+    monkeypatch.setattr(Settings, "SeparationChunk", 60)
+    assert np.allclose(analyze.get_repetition_filter(magnitude, sr, time_width=1), whole)
+    monkeypatch.setattr(Settings, "SeparationChunk", 6)
+    chunked = analyze.get_repetition_filter(magnitude, sr, time_width=1, file_name="song.wav")
+    assert chunked.shape == whole.shape and np.abs(chunked - whole).mean() < 0.2 * whole.mean()
+
+    previous = AnalysisCache._instance
+    AnalysisCache._instance = AnalysisCache()
+    try:
+        analyze.get_repetition_filter(magnitude, sr, time_width=1, file_name="song.wav")
+        nn_filter = librosa.decompose.nn_filter
+        monkeypatch.setattr(librosa.decompose, "nn_filter", None)
+        assert np.array_equal(analyze.get_repetition_filter(magnitude, sr, time_width=1, file_name="song.wav"), chunked)
+        monkeypatch.setattr(librosa.decompose, "nn_filter", nn_filter)
+    finally:
+        AnalysisCache._instance = previous
+
+    runs = analyze.sweep_vocal_separation("song.wav", time_widths=[1], margins_i=[1, 2], workers=1)
+    assert len(runs) == 2 and all(run["error"] is None and run["seconds"] > 0 for run in runs)
+    assert os.path.exists("test_foreground_cosine_1_2_10_2.wav") and os.path.exists("test_background_cosine_1_1_10_2.wav")
+
+
+def test_fingerprint_index(tmp_path):
+    """
+    Tests that re-encoded and trimmed copies of a song match it, and that a different song doesn't
+    """
+    import subprocess
+    import numpy as np
+    import soundfile
+    import fingerprint
+
+    sr = 22050
+
+    def song(seed, seconds=30):  # a random melody of quarter second notes
+        notes = np.random.default_rng(seed).integers(0, 36, seconds * 4)
+        t = np.arange(sr // 4) / sr
+        return np.concatenate([(0.5 * np.sin(2 * np.pi * 110 * 2 ** (note / 12) * t) +
+                                0.2 * np.sin(3 * np.pi * 110 * 2 ** (note / 12) * t)) * np.hanning(len(t))
+                               for note in notes]).astype(np.float32)
+    folder = tmp_path / "songs"
+    folder.mkdir()
+    original, other = song(1), song(2)
+    soundfile.write(str(folder / "original.wav"), original, sr)
+    soundfile.write(str(folder / "other.wav"), other, sr)
+    soundfile.write(str(folder / "radio edit.wav"), original[sr * 7:sr * 25], sr)
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-i", str(folder / "original.wav"), "-b:a", "96k",
+                    str(folder / "copy.m4a")],
+                   check=True)
+
+    index = fingerprint.FingerprintIndex(db_file=str(tmp_path / "fingerprints.db"))
+    assert index.index_folder(str(folder)) == 4
+    matches = {match["path"]: match for match in index.match(str(folder / "original.wav"))}
+    assert set(matches) == {str(folder / name) for name in ("original.wav", "radio edit.wav", "copy.m4a")}
+    assert abs(matches[str(folder / "radio edit.wav")]["offset"] + 7) < 0.1
+    assert index.get_duplicate(str(folder / "other.wav")) is None
+    assert index.get_duplicate(str(folder / "copy.m4a")) == str(folder / "original.wav")
+    assert index.find_duplicates() == [[str(folder / name) for name in ("copy.m4a", "original.wav", "radio edit.wav")]]
+
+    landmarks = index.get_file(str(folder / "original.wav"))[2]
+    assert index.add(str(folder / "original.wav"), landmarks=([], [])) == landmarks, "Unchanged file was fingerprinted again"
+    index.remove(str(folder / "original.wav"))
+    assert str(folder / "original.wav") not in [match["path"] for match in index.match(str(folder / "copy.m4a"))]
+    index.close()
+
+
+def test_embedding_index(tmp_path, monkeypatch, pcm_cache):
+    """
+    Tests that windows from several songs share forward passes, that copies embed alike, that the matrix is memory-mapped,
+    and that only the windows are decoded, without caching the songs
+    """
+    import numpy as np
+    import soundfile
+    import embedding
+    from utilities import Settings
+
+    sr = 22050
+    noise = np.random.default_rng(0)
+    t = np.arange(sr * 30) / sr
+    melody = 0.2 * sum(np.sin(2 * np.pi * pitch * t) * (np.sin(2 * np.pi * rate * t) > 0)
+                       for pitch, rate in [(440, 1), (660, 0.5)])
+    folder = tmp_path / "songs"
+    folder.mkdir()
+    soundfile.write(str(folder / "melody.wav"), melody, sr)
+    soundfile.write(str(folder / "quiet copy.wav"), 0.5 * melody + 0.005 * noise.standard_normal(len(t)), sr)
+    soundfile.write(str(folder / "noise.wav"), 0.3 * noise.standard_normal(len(t)), sr)
+    soundfile.write(str(folder / "short.wav"), melody[:sr * 3], sr)
+    monkeypatch.setattr(Settings, "EmbeddingCapacity", 2)  # so the matrix has to grow
+
+    batches = []
+    forward = embedding.EmbeddingModel.forward
+    monkeypatch.setattr(embedding.EmbeddingModel, "forward",
+                        lambda model, windows: batches.append(len(windows)) or forward(model, windows))
+    index = embedding.EmbeddingIndex(db_file=str(tmp_path / "embeddings.db"), matrix_file=str(tmp_path / "embeddings.npy"))
+    assert index.index_folder(str(folder), batch_size=4, threads=1) == 4
+    assert batches == [4, 4, 2], "Windows weren't batched across songs"  # three songs of 3 windows, and one of 1
+    assert not pcm_cache.sizes, "Songs were decoded whole into the decoded audio cache"
+    windows = embedding.get_windows(str(folder / "melody.wav"))
+    assert windows.shape == (3, 160000) and (np.abs(windows).max(axis=1) > 0.1).all(), "A window wasn't decoded"
+    similar = index.find_similar(str(folder / "melody.wav"))
+    assert {path for path, _ in similar[:2]} == {str(folder / "quiet copy.wav"), str(folder / "short.wav")}
+    assert similar[1][1] > 0.7 and similar[-1][0] == str(folder / "noise.wav") and similar[-1][1] < 0.5
+    assert index.index_folder(str(folder)) == 0, "Unchanged songs were embedded again"
+    saved = np.array(index.get_embedding(str(folder / "short.wav")))
+    assert abs(np.linalg.norm(saved) - 1) < 1e-5
+    index.close()
+
+    reopened = embedding.EmbeddingIndex(db_file=str(tmp_path / "embeddings.db"), matrix_file=str(tmp_path / "embeddings.npy"))
+    assert isinstance(reopened.matrix, np.memmap) and len(reopened.matrix) == 4
+    assert np.array_equal(reopened.get_embedding(str(folder / "short.wav")), saved)
+    reopened.close()
+
+
+def test_analyze_library(tmp_path, monkeypatch):
+    """
+    Tests that a whole folder is analyzed by worker processes, saved in batches, and skipped when analyzed again
+    """
+    import shutil
+    import numpy as np
+    import soundfile
+    import analyze
+    from database import FeaturesDatabase
+    from library import normalize_path
+
+    monkeypatch.chdir(tmp_path)  # the workers keep their analysis cache in the working directory
+    os.makedirs("songs/nested")
+    sr = 22050
+    for i, file_name in enumerate(["songs/a.wav", "songs/b.wav", "songs/nested/c.wav"]):
+        clicks = np.zeros(sr * 4, dtype=np.float32)
+        clicks[::sr // (2 + i)] = 0.8
+        soundfile.write(file_name, clicks, sr)
+    with open("songs/broken.wav", "wb") as f:
+        f.write(b"not audio")
+
+    previous = FeaturesDatabase._instance
+    FeaturesDatabase._instance = None
+    database = FeaturesDatabase.get_instance()
+    try:
+        counts = analyze.analyze_library("songs", workers=2)
+        assert counts["analyzed"] == 3 and counts["failed"] == 1 and counts["songs_per_second"] > 0
+        assert database.get_analyzed_file_names() == {normalize_path(file_name) for file_name in
+                                                      ("songs/a.wav", "songs/b.wav", "songs/nested/c.wav")}
+        assert analyze.analyze_library("songs", workers=1)["skipped"] == 3, "Analyzed songs were analyzed again"
+        t = np.arange(sr // 4) / sr
+        notes = np.random.default_rng(0).integers(0, 36, 24)
+        soundfile.write("songs/melody.wav", np.concatenate([np.sin(2 * np.pi * 110 * 2 ** (note / 12) * t) * np.hanning(len(t))
+                                                            for note in notes]).astype(np.float32), sr)
+        shutil.copy("songs/melody.wav", "songs/nested/melody copy.wav")
+        counts = analyze.analyze_library("songs", workers=1, skip_duplicates=True)
+        assert counts["analyzed"] == 1 and counts["skipped"] == 4, "A copy of a song was analyzed"
+    finally:
+        database.close_db()
+        FeaturesDatabase._instance = previous
+
+
 def test_note_conversion():
     """
     Tests converting notes
@@ -4,6 +4,7 @@ Primarily this contains logging and documentation utilities, but also contains d
 """
 
 
+import hashlib
 import os
 import platform
 from pydub import AudioSegment
@@ -15,6 +16,8 @@ class FolderDefinitions:
     Songs = "songs"
     Docs = "docs"
     Remover = "remover"
+    Fixtures = "fixtures"
+    Cache = "cache"
 
 
 class Arg:
@@ -81,8 +84,11 @@ class ArgParser:
     Play = Arg("play", "p", "Play audio - requires -i param for audio to play", str)
     Speed = Arg("speed", "s", "Change the input audio's speed - takes an int BPM or float multiplier", str)
     VibeMatch = Arg("match", "v", "Determine whether or not the input songs are have the same vibe", None)
+    Analyze = Arg("analyze", "n", "Analyze every song in a folder and save the results - takes a folder path e.g. songs", str)
+    Profile = Arg("profile", "r", "The tempo analysis profile - takes fast, standard or full, trading precision for speed",
+                  str)
 
-    all_args = [Add, Cut, Fade, Find, Get, Help, Input, Mixing, Mix, Output, Play, Speed, VibeMatch]
+    all_args = [Add, Analyze, Cut, Fade, Find, Get, Help, Input, Mixing, Mix, Output, Play, Profile, Speed, VibeMatch]
     instance = None
 
     def __init__(self, args):
@@ -125,6 +131,38 @@ class FileFormats:
     Default = M4a
 
 
+class AnalysisProfiles:
+    """
+    Named trade-offs between the cost and precision of tempo analysis, selected with --profile
+    sample_rate: the rate audio is resampled to while decoding, None for the file's own
+    mono: whether or not ffmpeg mixes the channels down while decoding, rather than numpy afterwards
+    hop_length: samples between onset frames, halved with the sample rate so the frame rate stays the same
+    duration: seconds analyzed from the middle of the song, None for all of it
+    """
+    Fast = {"name": "fast", "sample_rate": 11025, "mono": True, "hop_length": 256, "duration": 90}
+    Standard = {"name": "standard", "sample_rate": 22050, "mono": True, "hop_length": 512, "duration": None}
+    Full = {"name": "full", "sample_rate": None, "mono": False, "hop_length": 512, "duration": None}
+    all_profiles = [Fast, Standard, Full]
+
+    @staticmethod
+    def get(name=None):
+        """
+        Args:
+            name: (string|dict) the profile name, or a profile, defaults to Settings.AnalysisProfile
+
+        Returns:
+            (dict) the analysis profile
+        """
+        if isinstance(name, dict):
+            return name
+        name = (name if name else Settings.AnalysisProfile).lower()
+        for profile in AnalysisProfiles.all_profiles:
+            if profile["name"] == name:
+                return profile
+        raise ValueError(f"Unknown analysis profile '{name}', expected one of " +
+                         ", ".join(profile["name"] for profile in AnalysisProfiles.all_profiles))
+
+
 class TimeSegments:
     """
     A class containing the time blocks in milliseconds
@@ -298,8 +336,11 @@ def play(audio):
     if isinstance(audio, AudioSegment):
         playback.play(audio)
     elif isinstance(audio, str) and os.path.exists(audio):
-        song = AudioSegment.from_file(audio, FileFormats.Default)
-        playback.play(song)
+        try:
+            from cache import open_audio
+        except:
+            from VibeMatch.cache import open_audio
+        playback.play(open_audio(audio).to_audio_segment())
     else:
         Logger.write(f"{audio} not found")
 
@@ -318,6 +359,23 @@ def get_song_path(song, folder=None):
     return f"{folder if folder else FolderDefinitions.Songs}/{song['artists'][0]['name']} - {song['name']}.{FileFormats.Default}"
 
 
+def get_file_hash(file_path, chunk_size=1 << 20):
+    """
+    Hashes the contents of a file, reading it in chunks so large files aren't loaded into memory
+    Args:
+        file_path: (string) the file to hash
+        chunk_size: (int) how many bytes to read at a time
+
+    Returns:
+        (string) the hex digest of the file contents
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def get_path_template(folder):
     return os.path.join(os.getcwd(), folder + "/{artist} - {title}")
 
@@ -514,6 +572,55 @@ class Logger:
 class Settings:
     GetFeatures = False
     Bitrate = 128
+    RequestsPerSecond = 10  # sustained spotify api request rate, lowered automatically when throttled
+    RequestBurst = 20
+    RequestRetries = 5
+    RequestTimeout = 10  # seconds
+    RequestBackoff = 0.5  # seconds, doubled per retry
+    RequestMaxBackoff = 30  # seconds
+    RequestRateDecrease = 0.8  # multiplier applied to the request rate after a 429
+    RequestRateIncrease = 0.05  # requests per second added back after each success
+    EndpointConcurrency = 8  # in-flight requests per api endpoint
+    PageConcurrency = 8  # pages of a paginated endpoint requested at once
+    SearchConcurrency = 4  # search result pages requested at once, before checking for a match
+    SearchCacheSize = 256  # searches remembered
+    CrawlDatabase = "spotify.db"
+    CrawlBatchSize = 50  # tracks per batched features/download call
+    CrawlRecommendations = 100  # recommendations requested per expanded track, the api maximum
+    CrawlAttempts = 3  # times a track's recommendations, features or download are tried before it's skipped
+    LibraryDatabase = "spotify.db"
+    FingerprintDatabase = "spotify.db"
+    FingerprintPeaksPerSecond = 12  # spectral peaks kept per second of audio
+    FingerprintFanOut = 4  # later peaks each peak is paired with into a landmark
+    FingerprintMinScore = 20  # landmarks that must line up for two files to match
+    FingerprintMatchRatio = 0.1  # fraction of the shorter file's landmarks that must line up for two files to match
+    EmbeddingDatabase = "spotify.db"
+    EmbeddingMatrix = os.path.join(FolderDefinitions.Cache, "embeddings.npy")
+    EmbeddingWeights = None  # a file of trained embedding model weights, None for the untrained projection
+    EmbeddingBatchSize = 32  # windows per forward pass, from as many songs as it takes
+    EmbeddingThreads = os.cpu_count() or 1  # threads torch runs the embedding model on
+    EmbeddingDecoders = 4  # songs decoded at once while the embedding model runs
+    EmbeddingCapacity = 1024  # rows the embedding matrix starts with, doubled whenever it fills up
+    DownloadThreads = 8  # songs downloaded at once, across every playlist/album/artist
+    SourceConcurrency = 4  # playlists/albums/artists looked up at once while songs download
+    IngestWorkers = max(1, (os.cpu_count() or 2) - 1)  # songs analyzed at once while others download
+    IngestQueueSize = 16  # songs waiting between ingest stages before the earlier stage blocks
+    IngestBatchSize = 25  # rows per database write, and tracks per features request, while ingesting
+    AnalysisProfile = "standard"  # the AnalysisProfiles used for tempo analysis: fast, standard or full
+    LowFrequency = 150  # hz, the kick and bass are below this
+    SectionBeats = 16  # beats either side of a possible intro/outro boundary that are compared
+    SectionNovelty = 1.0  # standard deviations the energy must change by to count as a new section
+    SectionSearch = 0.5  # fraction of the song, from each end, searched for the intro/outro
+    DropNovelty = 0.5  # standard deviations the bass and energy must change by to count as a drop or breakdown
+    SeparationChunk = 60  # seconds of frames compared with each other at once when separating vocals
+    KeyWindow = 60  # seconds from the middle of a song its key is detected from
+    SilenceDb = -60  # dBFS under which frames are left out of the average loudness
+    AnalysisBatchSize = 100  # analysis rows per database write when analyzing a whole library
+    StreamMinDuration = 20 * 60  # seconds, longer files are analyzed a block at a time instead of decoded whole
+    StreamBlockSeconds = 30  # seconds of audio decoded at once when streaming
+    AnalysisCacheSize = 512 * 1024 ** 2  # bytes of cached analysis results kept before the least recently used are evicted
+    PcmCacheSize = 4 * 1024 ** 3  # bytes of decoded songs kept before the least recently used are evicted
+    CacheScanWrites = 50  # writes between reading the size of a cache folder again, for what other processes cached
 
 # Global log
 LOG = Logger(log_level=LogLevel.Info)
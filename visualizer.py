@@ -16,14 +16,15 @@ import random
 from dataclasses import dataclass
 try:
     from analyze import load_analysis, get_tempo_and_beat_indices
+    from cache import open_audio
     from utilities import Logger, FileFormats
 except ImportError:
     from VibeMatch.analyze import load_analysis, get_tempo_and_beat_indices
+    from VibeMatch.cache import open_audio
     from VibeMatch.utilities import Logger, FileFormats
 
 # import librosa
 import sounddevice as sd
-from pydub import AudioSegment
 
 @dataclass
 class AudioData:
@@ -225,12 +226,12 @@ class AudioVisualizer:
         self.loading_text = "Loading audio file..."
         self._draw_loading_screen()
         
-        # Load basic file info
-        audio_segment = AudioSegment.from_file(file_path)
+        # Load basic file info, decoding the file once for both the info and the analysis, or mapping it if it's cached
+        decoded_audio = open_audio(file_path)
         self.file_info.update({
-            'Duration': f"{audio_segment.duration_seconds:.1f} seconds",
-            'Channels': audio_segment.channels,
-            'Sample Rate': f"{audio_segment.frame_rate} Hz",
+            'Duration': f"{decoded_audio.duration:.1f} seconds",
+            'Channels': decoded_audio.channels,
+            'Sample Rate': f"{decoded_audio.sample_rate} Hz",
             'Format': Path(file_path).suffix[1:].upper()
         })
         self.loading_progress = 0.2
@@ -238,13 +239,13 @@ class AudioVisualizer:
         
         # Load and analyze audio
         self.loading_text = "Analyzing audio data..."
-        audio_data = load_analysis(file_path, audio_segment)
+        audio_data = load_analysis(file_path, decoded_audio)
         self.loading_progress = 0.5
         self._draw_loading_screen()
         
         # Get tempo and beat information
         self.loading_text = "Detecting tempo and beats..."
-        tempo, beat_frames = get_tempo_and_beat_indices(audio_data)
+        tempo, beat_frames = get_tempo_and_beat_indices(audio_data, file_path)
         self.loading_progress = 0.8
         self._draw_loading_screen()
         